@@ -30,4 +30,9 @@ setup(
         "pyzabbix==1.3.1",
         "pytz",
     ],
+    extras_require={
+        "fast": ["orjson>=3.6"],
+        "postgresql": ["psycopg2-binary>=2.8"],
+        "mysql": ["PyMySQL>=1.0"],
+    },
 )
@@ -0,0 +1,180 @@
+import datetime
+import string
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, Set, Tuple, Union
+
+
+class CompiledTemplate:
+    """
+    str.format() template parsed once and rendered many times.
+    Only simple named fields are compiled, anything else (attribute/index lookups,
+    nested format specs) falls back to str.format() to keep its exact behaviour.
+    """
+    _formatter = string.Formatter()
+
+    def __init__(self, template: str):
+        self.template = template
+        self._parts = []
+        self._compiled = True
+        for literal, field_name, format_spec, conversion in self._formatter.parse(template):
+            if field_name is not None and (not field_name.isidentifier() or '{' in (format_spec or '')):
+                self._compiled = False
+                break
+            self._parts.append((literal, field_name, format_spec or '', conversion))
+
+    def render(self, **fields) -> str:
+        if not self._compiled:
+            return self.template.format(**fields)
+        chunks = []
+        for literal, field_name, format_spec, conversion in self._parts:
+            if literal:
+                chunks.append(literal)
+            if field_name is None:
+                continue
+            value = fields[field_name]
+            if conversion:
+                value = self._formatter.convert_field(value, conversion)
+            chunks.append(format(value, format_spec))
+        return ''.join(chunks)
+
+
+@dataclass
+class _EventAcks:
+    # acknowledgeid -> rendered text
+    rendered: Dict[str, str] = field(default_factory=dict)
+    # Ids in order returned by Zabbix and message built from them
+    ack_ids: Tuple[str, ...] = ()
+    text: str = ''
+
+
+def _ack_id(ack: dict) -> str:
+    if ack.get('acknowledgeid'):
+        return str(ack['acknowledgeid'])
+    return f"{ack.get('clock')}:{ack.get('userid')}"
+
+
+class AckRenderer:
+    """
+    Incremental renderer of Zabbix acknowledges into Cachet incident messages.
+    Every acknowledge is formatted once, later cycles only join already rendered parts.
+    It also remembers which acknowledge ids were already sent to every Cachet incident,
+    so decision about incident update does not need to compare full message text.
+    """
+
+    def __init__(self, template: str, time_format: str, tz=None):
+        self.template = CompiledTemplate(template)
+        self.time_format = time_format
+        self.tz = tz
+        # eventid -> rendered acknowledges
+        self._events: Dict[str, _EventAcks] = {}
+        # acknowledgeid -> rendered text of all known events
+        self._ack_texts: Dict[str, str] = {}
+        # Cachet component id -> Zabbix event ids rendered for it
+        self._component_events: Dict[str, Set[str]] = {}
+        # Cachet incident id -> ack ids that incident message contains
+        self._sent: Dict[str, FrozenSet[str]] = {}
+        # Cachet component id -> incident ids
+        self._component_incidents: Dict[str, Set[str]] = {}
+
+    def configure(self, template: str, time_format: str, tz=None):
+        """
+        Change template of reloaded config. Acknowledges are rendered again when they are seen next time,
+        knowledge of what was sent to incidents is kept
+        """
+        if (template, time_format, tz) == (self.template.template, self.time_format, self.tz):
+            return
+        self.template = CompiledTemplate(template)
+        self.time_format = time_format
+        self.tz = tz
+        self._events = {}
+        self._ack_texts = {}
+        self._component_events = {}
+
+    def _render_ack(self, ack: dict) -> str:
+        author = ack.get('name', '') + ' ' + ack.get('surname', '')
+        ack_time = datetime.datetime.fromtimestamp(int(ack['clock']), tz=self.tz).strftime(self.time_format)
+        return self.template.render(message=ack['message'], ack_time=ack_time, author=author)
+
+    def render(self, component_id: Union[int, str], zbx_event: dict) -> Tuple[str, Tuple[str, ...]]:
+        """
+        Render acknowledges of Zabbix event.
+        Acknowledges are joined in reverse order of the Zabbix list, the last one is shown on the top.
+        @param component_id: Cachet component id that event belongs to
+        @param zbx_event: Zabbix event with acknowledges
+        @return: (rendered message, tuple of acknowledge ids)
+        """
+        acknowledges = zbx_event.get('acknowledges') or []
+        eventid = str(zbx_event.get('eventid', ''))
+        record = self._events.get(eventid)
+        if record is None:
+            record = self._events[eventid] = _EventAcks()
+            self._component_events.setdefault(str(component_id), set()).add(eventid)
+        ack_ids = tuple(map(_ack_id, acknowledges))
+        if ack_ids != record.ack_ids:
+            for ack_id, ack in zip(ack_ids, acknowledges):
+                if ack_id not in record.rendered:
+                    record.rendered[ack_id] = self._ack_texts[ack_id] = self._render_ack(ack)
+            record.ack_ids = ack_ids
+            record.text = ''.join(record.rendered[ack_id] for ack_id in reversed(ack_ids))
+        return record.text, ack_ids
+
+    def text(self, ack_ids: Iterable[str]) -> str:
+        """
+        Join already rendered acknowledges, the last one on the top
+        """
+        return ''.join(self._ack_texts[ack_id] for ack_id in reversed(tuple(ack_ids)) if ack_id in self._ack_texts)
+
+    def unsent(self, incident_id: Union[int, str], ack_ids: Iterable[str]) -> Tuple[str, ...]:
+        """
+        Acknowledge ids which were not sent to incident yet
+        """
+        sent = self._sent.get(str(incident_id), frozenset())
+        return tuple(ack_id for ack_id in ack_ids if ack_id not in sent)
+
+    def restore_sent(self, component_id: Union[int, str], incident_id: Union[int, str], ack_ids: Iterable[str],
+                     messages: Iterable[str]):
+        """
+        Find out which acknowledges incident created before start already contains
+        @param messages: incident message and messages of its updates
+        """
+        messages = list(messages)
+        sent = []
+        for ack_id in ack_ids:
+            ack_text = self._ack_texts.get(ack_id, '').strip()
+            if ack_text and any(ack_text in message for message in messages):
+                sent.append(ack_id)
+        self.mark_sent(component_id, incident_id, sent)
+
+    def is_changed(self, incident_id: Union[int, str], ack_ids: Iterable[str]):
+        """
+        Check if incident has to be updated with new acknowledges
+        @return: boolean or None if nothing is known about incident (e.g. after restart)
+        """
+        sent = self._sent.get(str(incident_id))
+        if sent is None:
+            return None
+        return sent != frozenset(ack_ids)
+
+    def mark_sent(self, component_id: Union[int, str], incident_id: Union[int, str], ack_ids: Iterable[str]):
+        self._sent[str(incident_id)] = frozenset(ack_ids)
+        self._component_incidents.setdefault(str(component_id), set()).add(str(incident_id))
+
+    def forget(self, component_id: Union[int, str]):
+        """
+        Drop everything rendered for component. Used when its incident was resolved
+        """
+        component_id = str(component_id)
+        for eventid in self._component_events.pop(component_id, ()):
+            record = self._events.pop(eventid, None)
+            for ack_id in (record.rendered if record else ()):
+                self._ack_texts.pop(ack_id, None)
+        for incident_id in self._component_incidents.pop(component_id, ()):
+            self._sent.pop(incident_id, None)
+
+    def retain(self, component_ids: Iterable[Union[int, str]]):
+        """
+        Forget components which are not watched anymore
+        """
+        keep = set(map(str, component_ids))
+        for component_id in (set(self._component_events) | set(self._component_incidents)) - keep:
+            self.forget(component_id)
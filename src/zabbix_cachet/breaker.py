@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+from typing import Callable, Union
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one backend (Zabbix or Cachet).
+        closed - requests go as usual, consecutive failures are counted;
+        open - backend is considered down, requests are not sent at all;
+        half-open - recovery_timeout has passed since opening, a cheap probe call decides
+                    if breaker is closed again or stays open for another recovery_timeout.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30,
+                 probe: Union[Callable[[], bool], None] = None):
+        """
+        @param name: name of backend for logging
+        @param failure_threshold: consecutive failures which open breaker
+        @param recovery_timeout: seconds before probing backend which is open
+        @param probe: callable which returns True if backend is available. It must not use breaker itself
+        """
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.recovery_timeout = recovery_timeout
+        self.probe = probe
+        self._lock = threading.RLock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    @property
+    def is_closed(self) -> bool:
+        return self.state == self.CLOSED
+
+    def _set_state(self, new_state: str):
+        if new_state != self._state:
+            log = logging.info if new_state == self.CLOSED else logging.warning
+            log(f'{self.name} circuit breaker: {self._state} -> {new_state}')
+            self._state = new_state
+        if new_state == self.OPEN:
+            self._opened_at = time.monotonic()
+        elif new_state == self.CLOSED:
+            self._failures = 0
+
+    def allow(self) -> bool:
+        """
+        Check if request to backend can be sent.
+        When open breaker reaches recovery_timeout the probe is called in the current thread,
+        other threads do not wait for it and get False.
+        @return: boolean
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN or time.monotonic() - self._opened_at < self.recovery_timeout:
+                return False
+            self._set_state(self.HALF_OPEN)
+        if self.probe is None:
+            # Let one request through, its result will close or open breaker
+            return True
+        try:
+            available = bool(self.probe())
+        except Exception as err:
+            logging.debug(f'{self.name} probe failed: {err}')
+            available = False
+        with self._lock:
+            self._set_state(self.CLOSED if available else self.OPEN)
+            return available
+
+    def record_success(self):
+        with self._lock:
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._set_state(self.OPEN)
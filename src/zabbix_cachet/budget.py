@@ -0,0 +1,123 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Tuple, Union
+
+from zabbix_cachet.stats import Stats, STATS
+
+# (connect, read) timeout of Zabbix and Cachet requests in seconds if config does not set it
+DEFAULT_TIMEOUT = (5.0, 30.0)
+
+
+class Deadline:
+    """
+    Time budget of one watcher cycle or sync
+    """
+
+    def __init__(self, budget: Union[float, None]):
+        """
+        @param budget: seconds. None or 0 means unlimited
+        """
+        self.budget = budget or None
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def remaining(self) -> Union[float, None]:
+        if self.budget is None:
+            return None
+        return max(0.0, self.budget - self.elapsed)
+
+    @property
+    def expired(self) -> bool:
+        return self.budget is not None and self.elapsed >= self.budget
+
+
+def timeout_from_config(backend_config: dict) -> Tuple[float, float]:
+    """
+    Get (connect, read) timeout of requests from zabbix or cachet section of config.
+    Requests never wait forever: DEFAULT_TIMEOUT is used for missing values
+    """
+    timeout = backend_config.get('timeout')
+    if not timeout:
+        return DEFAULT_TIMEOUT
+    if isinstance(timeout, dict):
+        return float(timeout.get('connect', DEFAULT_TIMEOUT[0])), float(timeout.get('read', DEFAULT_TIMEOUT[1]))
+    return float(timeout), float(timeout)
+
+
+class Watchdog(threading.Thread):
+    """
+    Watch cycles of other threads and report ones which run over their budget.
+    Overrun is logged with the current stack of stalled thread and exported as metric.
+    Watchdog also writes metrics file periodically if it is configured.
+    """
+
+    def __init__(self, stats: Stats = STATS, metrics_file: str = None, interval: float = 1,
+                 metrics_interval: float = 15):
+        super().__init__(name='Watchdog', daemon=True)
+        self.stats = stats
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.metrics_interval = metrics_interval
+        self._lock = threading.Lock()
+        # name -> (thread ident, deadline, is overrun reported)
+        self._cycles: Dict[str, list] = {}
+        self._stop_event = threading.Event()
+
+    def watch(self, name: str, deadline: Deadline):
+        """
+        Start watching cycle of the current thread
+        """
+        with self._lock:
+            self._cycles[name] = [threading.get_ident(), deadline, False]
+
+    def done(self, name: str):
+        """
+        Cycle has finished
+        """
+        with self._lock:
+            ident, deadline, reported = self._cycles.pop(name, (None, None, False))
+        if deadline is not None:
+            self.stats.set('zabbix_cachet_cycle_duration_seconds', round(deadline.elapsed, 3),
+                           'Duration of the last cycle', cycle=name)
+            if reported:
+                logging.warning(f'{name} cycle has finished in {deadline.elapsed:.1f}s '
+                                f'with budget {deadline.budget}s')
+
+    def check(self):
+        with self._lock:
+            overruns = [(name, cycle) for name, cycle in self._cycles.items() if not cycle[2] and cycle[1].expired]
+            for _, cycle in overruns:
+                cycle[2] = True
+        frames = sys._current_frames() if overruns else {}
+        for name, (ident, deadline, _) in overruns:
+            stack = ''.join(traceback.format_stack(frames[ident])) if ident in frames else 'unknown'
+            logging.warning(f'{name} cycle runs over its budget of {deadline.budget}s. It is at:\n{stack}')
+            self.stats.inc('zabbix_cachet_cycle_overruns_total', 1, 'Cycles which ran over their budget', cycle=name)
+        if overruns:
+            self.write_metrics()
+
+    def write_metrics(self):
+        if not self.metrics_file:
+            return
+        try:
+            self.stats.write(self.metrics_file)
+        except OSError as err:
+            logging.error(f'Failed to write metrics to {self.metrics_file}: {err}')
+
+    def run(self):
+        last_write = 0.0
+        while not self._stop_event.wait(self.interval):
+            self.check()
+            if time.monotonic() - last_write >= self.metrics_interval:
+                self.write_metrics()
+                last_write = time.monotonic()
+
+    def stop(self):
+        self._stop_event.set()
@@ -1,55 +1,219 @@
 import json
 import logging
+import threading
+import time
 import requests
-from operator import itemgetter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, Tuple, Union
 
 
-from zabbix_cachet.excepltions import CachetApiException
+from zabbix_cachet import codec
+from zabbix_cachet.breaker import CircuitBreaker
+from zabbix_cachet.excepltions import CachetApiException, CachetNotAvailable
+from zabbix_cachet.limiter import AdaptiveLimiter
+from zabbix_cachet.profiling import PROFILER
 
 
 def client_http_error(url, code, message):
     logging.error('ClientHttpError[%s, %s: %s]' % (url, code, message))
 
 
+class IncidentRecord:
+    """
+    Write-through record of incidents which this client created or updated, by component.
+    Cachet serves incident lists from its cache, so just after a write it can return
+    a stale list without the new incident or with its old status.
+    For ttl seconds after the last write the record wins over such a list.
+    """
+
+    def __init__(self, ttl: float = 600, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        # component id -> (time of write, incident)
+        self._incidents: Dict[str, Tuple[float, dict]] = {}
+
+    def put(self, incident: dict):
+        """
+        Remember incident as Cachet returned it after write
+        """
+        with self._lock:
+            self._incidents[str(incident['component_id'])] = (
+                self.clock(), {field: incident[field] for field in Cachet.INCIDENT_FIELDS if field in incident})
+
+    def update(self, incident_id, **fields):
+        """
+        Change fields of recorded incident without response of Cachet
+        """
+        with self._lock:
+            for component_id, (written, incident) in self._incidents.items():
+                if str(incident['id']) == str(incident_id):
+                    self._incidents[component_id] = (self.clock(), {**incident, **fields})
+
+    def reconcile(self, component_id, last_incident: Union[dict, None]) -> Union[dict, None]:
+        """
+        Merge the last incident of component read from Cachet with the record
+        @param last_incident: incident from Cachet list or None if there is no incident
+        @return: incident which is believed to be current
+        """
+        with self._lock:
+            written, incident = self._incidents.get(str(component_id), (None, None))
+            if incident is None:
+                return last_incident
+            if self.clock() - written > self.ttl:
+                del self._incidents[str(component_id)]
+                return last_incident
+        if last_incident is None or int(last_incident['id']) < int(incident['id']):
+            logging.debug(f'Cachet returned stale incidents of component {component_id}. Use written {incident}')
+            return dict(incident)
+        if int(last_incident['id']) == int(incident['id']):
+            return {**last_incident, **incident}
+        # Somebody else has created a newer incident
+        return last_incident
+
+
 class Cachet:
-    def __init__(self, server: str, token: str, verify=True):
+    # Fields of list items which are kept after decoding
+    COMPONENT_FIELDS = ('id', 'name', 'group_id', 'status')
+    INCIDENT_FIELDS = ('id', 'component_id', 'name', 'status', 'message')
+
+    def __init__(self, server: str, token: str, verify=True, per_page: int = 1000, page_workers: int = 4,
+                 incident_updates: bool = False, breaker: CircuitBreaker = None,
+                 timeout: Union[float, Tuple[float, float]] = None, incident_record_ttl: float = 600,
+                 limiter: AdaptiveLimiter = None):
         """
         Init Cachet class for further needs
+        :param per_page: page size requested from list endpoints. Server can return less
+        :param page_workers: how many pages of list endpoints are fetched in parallel
+        :param incident_updates: post new text of incidents as incident updates (Cachet 2.4+)
+                                 instead of rewriting the whole message
+        :param breaker: CircuitBreaker of Cachet. Its probe is set to ping Cachet
+        :param timeout: (connect, read) timeout of every request
+        :param incident_record_ttl: seconds written incidents win over incidents read from Cachet.
+                                    Set it bigger than Cachet cache timeout
+        :param limiter: AdaptiveLimiter of concurrent requests to Cachet shared by all threads
         """
         self.server = server + '/api/v1/'
         self.token = token
-        self.headers = {'X-Cachet-Token': self.token, 'Accept': 'application/json; indent=4'}
+        self.headers = {'X-Cachet-Token': self.token, 'Accept': 'application/json'}
+        self.json_headers = {**self.headers, 'Content-Type': 'application/json'}
         self.verify = verify
+        self.per_page = per_page
+        self.page_workers = max(1, page_workers)
+        self.incident_updates = incident_updates
+        self.timeout = timeout
+        # Writes and time spent in requests by each thread.
+        # triggers_watcher caps writes per cycle and measures propagation latency with them
+        self._io = threading.local()
+        self.incident_record = IncidentRecord(ttl=incident_record_ttl)
+        self.breaker = breaker or CircuitBreaker('Cachet')
+        self.breaker.probe = self._probe
+        self.limiter = limiter or AdaptiveLimiter('Cachet')
         self.version = self.get_version()
 
-    def _http_post(self, url, params):
+    @property
+    def writes(self) -> int:
         """
-        Make POST and return json response
+        Number of POST, PUT and DELETE requests sent by the current thread
+        """
+        return getattr(self._io, 'count', 0)
+
+    @property
+    def io_time(self) -> Tuple[float, float]:
+        """
+        Seconds spent by the current thread in (GET, POST, PUT and DELETE) requests
+        """
+        return getattr(self._io, 'read_seconds', 0.0), getattr(self._io, 'write_seconds', 0.0)
+
+    def _probe(self) -> bool:
+        """
+        Cheap check of Cachet availability for circuit breaker. Does not use breaker itself
+        """
+        r = requests.get(url=self.server + 'ping', headers=self.headers, verify=self.verify, timeout=self.timeout)
+        return r.status_code == 200
+
+    def _request(self, method, url, params):
+        """
+        Make HTTP request to Cachet API through circuit breaker
+        :param method: GET, POST, PUT or DELETE
         :param url: str
         :param params: dict
-        :return: json
+        :return: json or None if Cachet rejected request
         """
         url = self.server + url
-        logging.debug("Sending to {url}: {param}".format(url=url,
-                                                         param=json.dumps(params,
-                                                                          indent=4,
-                                                                          separators=(',', ': '))))
+        if not self.breaker.allow():
+            raise CachetNotAvailable(f"Cachet is not available (circuit breaker is {self.breaker.state}). "
+                                     f"Skip {method} {url}")
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if debug:
+            logging.debug("Sending to {url}: {param}".format(url=url,
+                                                             param=json.dumps(params,
+                                                                              indent=4,
+                                                                              separators=(',', ': '))))
+        if method == 'GET':
+            payload = {'params': params}
+        elif method == 'POST':
+            payload = {'data': params}
+        elif method == 'DELETE':
+            payload = {}
+        else:
+            payload = {'data': codec.dumps(params), 'headers': self.json_headers}
+        if method != 'GET':
+            self._io.count = self.writes + 1
+        started = time.perf_counter()
         try:
-            r = requests.post(url=url, data=params, headers=self.headers, verify=self.verify)
+            with self.limiter.slot() as slot:
+                r = requests.request(method, url=url, verify=self.verify, timeout=self.timeout,
+                                     **{'headers': self.headers, **payload})
+                slot.overloaded = r.status_code == 429 or r.status_code >= 500
         except requests.exceptions.RequestException as e:
-            raise client_http_error(url, None, e)
+            self.breaker.record_failure()
+            client_http_error(url, None, e)
+            raise CachetNotAvailable(f"Failed to connect to Cachet: {e}")
+        finally:
+            if method == 'GET':
+                self._io.read_seconds = self.io_time[0] + time.perf_counter() - started
+            else:
+                self._io.write_seconds = self.io_time[1] + time.perf_counter() - started
         # r.raise_for_status()
-        if r.status_code != 200:
-            return client_http_error(url, r.status_code, r.text)
+        if r.status_code >= 500:
+            self.breaker.record_failure()
+            client_http_error(url, r.status_code, r.reason)
+            raise CachetNotAvailable(f"Cachet returned {r.status_code}. Probably it is not available")
+        self.breaker.record_success()
+        if r.status_code == 204:
+            # DELETE returns no content
+            return {}
+        # Parse raw bytes once, do not let requests decode them to str first
         try:
-            r_json = json.loads(r.text)
+            r_json = codec.loads(r.content)
         except ValueError:
-            raise CachetApiException(f"Unable to parse json: {r.text}")
-        logging.debug("Response Body: %s", json.dumps(r_json,
-                                                      indent=4,
-                                                      separators=(',', ': ')))
+            r_json = None
+        if r.status_code != 200:
+            if isinstance(r_json, dict) and 'errors' in r_json:
+                message = r_json['errors']
+            else:
+                message = r.content.decode('utf-8', 'replace')
+            return client_http_error(url, r.status_code, message)
+        if r_json is None:
+            raise CachetApiException(f"Unable to parse json: {r.content.decode('utf-8', 'replace')}")
+        if debug:
+            logging.debug("Response Body: %s", json.dumps(r_json,
+                                                          indent=4,
+                                                          separators=(',', ': ')))
         return r_json
 
+    def _http_post(self, url, params):
+        """
+        Make POST and return json response
+        :param url: str
+        :param params: dict
+        :return: json
+        """
+        with PROFILER.phase('cachet_write'):
+            return self._request('POST', url, params)
+
     def _http_get(self, url, params=None):
         """
         Helper for HTTP GET request
@@ -59,31 +223,8 @@ class Cachet:
         """
         if params is None:
             params = {}
-        url = self.server + url
-        logging.debug("Sending to {url}: {param}".format(url=url,
-                                                         param=json.dumps(params,
-                                                                          indent=4,
-                                                                          separators=(',', ': '))))
-        try:
-            r = requests.get(url=url, headers=self.headers, params=params, verify=self.verify)
-        except requests.exceptions.RequestException as e:
-            raise client_http_error(url, None, e)
-        # r.raise_for_status()
-        if r.status_code == 502:
-            client_http_error(url, 502, "Bad Gateway")
-            raise CachetApiException(f"Failed to get Cachet version. Probably it is not available")
-        elif r.status_code != 200:
-            return client_http_error(url, r.status_code, json.loads(r.text)['errors'])
-        try:
-            r_json = json.loads(r.text)
-        except ValueError:
-            raise CachetApiException(
-                "Unable to parse json: %s" % r.text
-            )
-        logging.debug("Response Body: %s", json.dumps(r_json,
-                                                      indent=4,
-                                                      separators=(',', ': ')))
-        return r_json
+        with PROFILER.phase('cachet_fetch'):
+            return self._request('GET', url, params)
 
     def _http_put(self, url, params):
         """
@@ -92,28 +233,62 @@ class Cachet:
         :param params: dict
         :return: json
         """
-        url = self.server + url
-        logging.debug("Sending to {url}: {param}".format(url=url,
-                                                         param=json.dumps(params,
-                                                                          indent=4,
-                                                                          separators=(',', ': '))))
-        try:
-            r = requests.put(url=url, json=params, headers=self.headers, verify=self.verify)
-        except requests.exceptions.RequestException as e:
-            raise client_http_error(url, None, e)
-        # r.raise_for_status()
-        if r.status_code != 200:
-            return client_http_error(url, r.status_code, r.text)
-        try:
-            r_json = json.loads(r.text)
-        except ValueError:
-            raise CachetApiException(
-                "Unable to parse json: %s" % r.text
-            )
-        logging.debug("Response Body: %s", json.dumps(r_json,
-                                                      indent=4,
-                                                      separators=(',', ': ')))
-        return r_json
+        with PROFILER.phase('cachet_write'):
+            return self._request('PUT', url, params)
+
+    def _http_delete(self, url):
+        """
+        Make DELETE
+        :param url: str
+        :return: {} or None if Cachet rejected request
+        """
+        with PROFILER.phase('cachet_write'):
+            return self._request('DELETE', url, {})
+
+    def _paginate(self, url, params=None, fields=None) -> Iterator[dict]:
+        """
+        Stream all items of Cachet list endpoint.
+        The first page is requested with the biggest per_page, the server answers with real page size
+        and total_pages. Remaining pages are fetched in parallel but yielded in order,
+        only page_workers pages are kept in memory.
+        :param url: str
+        :param params: dict of filters
+        :param fields: keep only these fields of items, the rest of page is dropped after it is decoded
+        :return: iterator over items of all pages
+        """
+        params = dict(params or {}, per_page=self.per_page)
+        data = self._http_get(url, params=dict(params, page=1))
+        if not data:
+            raise CachetApiException(f"Failed to get list of {url}")
+        yield from codec.project(data['data'], fields) if fields else data['data']
+        pagination = data['meta']['pagination']
+        total_pages = int(pagination['total_pages'])
+        if total_pages <= 1:
+            return
+        params['per_page'] = int(pagination.get('per_page') or self.per_page)
+        pages = iter(range(2, total_pages + 1))
+        with ThreadPoolExecutor(max_workers=min(self.page_workers, total_pages - 1),
+                                thread_name_prefix='Cachet Pages') as pool:
+            window = deque()
+
+            def submit_next():
+                page = next(pages, None)
+                if page is not None:
+                    window.append(pool.submit(self._http_get, url, dict(params, page=page)))
+
+            for _ in range(self.page_workers):
+                submit_next()
+            try:
+                while window:
+                    data_page = window.popleft().result()
+                    submit_next()
+                    if not data_page:
+                        raise CachetApiException(f"Failed to get page of {url}")
+                    yield from codec.project(data_page['data'], fields) if fields else data_page['data']
+            finally:
+                # Consumer has found what it needs. Do not fetch the rest
+                for future in window:
+                    future.cancel()
 
     def get_version(self):
         """
@@ -122,6 +297,8 @@ class Cachet:
         """
         url = 'version'
         data = self._http_get(url)
+        if not data:
+            raise CachetApiException('Failed to get Cachet version')
         return data['data']
 
     def get_component(self, id):
@@ -137,30 +314,20 @@ class Cachet:
     def get_components(self, name=None):
         """
         Get all registered components or return a component details if name specified
-        Please note, it name was not defined method returns only last page of data
         :param name: Name of component to search
         :type name: str
         :return: Data =)
         :rtype: dict or list
         """
         url = 'components'
-        data = self._http_get(url)
-        total_pages = int(data['meta']['pagination']['total_pages'])
         if name:
-            components = []
-            for page in range(total_pages, 0, -1):
-                if page == 1:
-                    data_page = data
-                else:
-                    data_page = self._http_get(url, params={'page': page})
-                for component in data_page['data']:
-                    if component['name'] == name:
-                        components.append(component)
+            components = [component for component in self._paginate(url, fields=self.COMPONENT_FIELDS)
+                          if component['name'] == name]
             if len(components) < 1:
                 return {'id': 0, 'name': 'Does not exists'}
             else:
                 return components
-        return data
+        return list(self._paginate(url))
 
     def new_components(self, name, **kwargs):
         """
@@ -192,6 +359,8 @@ class Cachet:
         # params = {'name': name, 'link': link, 'description': description, 'status': status}
         logging.debug('Creating Cachet component {name}...'.format(name=params['name']))
         data = self._http_post(url, params)
+        if not data:
+            raise CachetApiException(f"Failed to create component {params['name']}")
         logging.info('Component {name} was created in group id {group_id}.'.format(name=params['name'],
                                                                                    group_id=data['data'][
                                                                                        'group_id']))
@@ -205,7 +374,10 @@ class Cachet:
         @return: boolean
         """
         url = 'components/' + str(id)
-        params = self.get_component(id)['data']
+        component = self.get_component(id)
+        if not component:
+            raise CachetApiException(f"Failed to get component ID {id}")
+        params = component['data']
         params.update(kwargs)
         data = self._http_put(url, params)
         if data:
@@ -218,24 +390,16 @@ class Cachet:
     def get_components_gr(self, name=None):
         """
         Get all registered components group or return a component group details if name specified
-        Please note, this name was not defined method returns only last page of data
         @param name: string
-        @return: dict of data
+        @return: dict of data or list of all groups
         """
         url = 'components/groups'
-        data = self._http_get(url)
-        total_pages = int(data['meta']['pagination']['total_pages'])
         if name:
-            for page in range(total_pages, 0, -1):
-                if page == 1:
-                    data_page = data
-                else:
-                    data_page = self._http_get(url, params={'page': page})
-                for group in data_page['data']:
-                    if group['name'] == name:
-                        return group
+            for group in self._paginate(url):
+                if group['name'] == name:
+                    return group
             return {'id': 0, 'name': 'Does not exists'}
-        return data
+        return list(self._paginate(url))
 
     def new_components_gr(self, name: str):
         """
@@ -251,12 +415,21 @@ class Cachet:
             params = {'name': name, 'collapsed': 2}
             logging.debug('Creating Component Group {}...'.format(params['name']))
             data = self._http_post(url, params)
+            if not data:
+                raise CachetApiException(f"Failed to create component group {params['name']}")
             if 'data' in data:
                 logging.info('Component Group {} was created ({})'.format(params['name'], data['data']['id']))
             return data['data']
         else:
             return components_gr_id
 
+    def get_incidents(self):
+        """
+        Get all incidents
+        @return: list of dict
+        """
+        return list(self._paginate('incidents'))
+
     def get_incident(self, component_id):
         """
         Get last incident for component_id
@@ -264,18 +437,22 @@ class Cachet:
         @return: dict of data
         """
         # TODO: make search by name
-        url = 'incidents'
-        data = self._http_get(url)
-        total_pages = int(data['meta']['pagination']['total_pages'])
-        for page in range(total_pages, 0, -1):
-            data = self._http_get(url, params={'page': page})
-            data_sorted = sorted(data['data'], key=itemgetter('id'), reverse=True)
-            for incident in data_sorted:
-                if str(incident['component_id']) == str(component_id):
-                    # Convert status to str
-                    incident['status'] = str(incident['status'])
-                    return incident
-        return {'id': '0', 'name': 'Does not exist', 'status': '-1'}
+        data = self._http_get('incidents', params={'component_id': component_id, 'sort': 'id', 'order': 'desc',
+                                                   'per_page': 1})
+        if not data:
+            raise CachetApiException(f"Failed to get incidents of component {component_id}")
+        incidents = codec.project(data['data'], self.INCIDENT_FIELDS)
+        if any(str(incident['component_id']) != str(component_id) for incident in incidents):
+            # Server ignored filter, search all incidents
+            incidents = [incident for incident in self._paginate('incidents', fields=self.INCIDENT_FIELDS)
+                         if str(incident['component_id']) == str(component_id)]
+        last_incident = max(incidents, key=lambda incident: int(incident['id']), default=None)
+        last_incident = self.incident_record.reconcile(component_id, last_incident)
+        if last_incident is None:
+            return {'id': '0', 'name': 'Does not exist', 'status': '-1'}
+        # Convert status to str
+        last_incident['status'] = str(last_incident['status'])
+        return last_incident
 
     def new_incidents(self, **kwargs):
         """
@@ -289,6 +466,9 @@ class Cachet:
         url = 'incidents'
         params.update(kwargs)
         data = self._http_post(url, params)
+        if not data:
+            raise CachetApiException(f"Failed to create incident {params['name']}")
+        self.incident_record.put({**params, **data['data']})
         logging.info('Incident {name} (id={incident_id}) was created for component id {component_id}.'.format(
             name=params['name'],
             incident_id=data['data']['id'],
@@ -307,5 +487,89 @@ class Cachet:
         url = 'incidents/' + str(id)
         params = kwargs
         data = self._http_put(url, params)
+        if not data:
+            raise CachetApiException(f"Failed to update incident ID {id}")
+        if 'component_id' in data['data']:
+            self.incident_record.put(data['data'])
+        else:
+            self.incident_record.update(id, **{field: value for field, value in params.items()
+                                               if field in self.INCIDENT_FIELDS})
         logging.info(f"Incident ID {id} was updated. Status - {data['data']['human_status']}")
         return data
+
+    def get_incident_updates(self, incident_id):
+        """
+        Get all updates of incident
+        @param incident_id: string
+        @return: list of dict
+        """
+        return list(self._paginate(f'incidents/{incident_id}/updates'))
+
+    def new_incident_update(self, incident_id, status, message):
+        """
+        Add an update to incident. Cachet sets incident status to the status of its last update
+        @param incident_id: string
+        @param status: incident status
+        @param message: text of update only
+        @return: dict of data
+        """
+        url = f'incidents/{incident_id}/updates'
+        params = {'status': status, 'message': message}
+        data = self._http_post(url, params)
+        if not data:
+            raise CachetApiException(f"Failed to add update to incident ID {incident_id}")
+        self.incident_record.update(incident_id, status=status)
+        logging.info(f"Update (id={data['data']['id']}) was added to incident ID {incident_id}. Status - {status}")
+        return data['data']
+
+    def new_metric_point(self, metric_id, value, timestamp):
+        """
+        Add a point to Cachet metric
+        @param metric_id: id of Cachet metric
+        @param value: float
+        @param timestamp: unix time of point
+        @return: dict of data
+        """
+        url = f'metrics/{metric_id}/points'
+        params = {'value': value, 'timestamp': timestamp}
+        data = self._http_post(url, params)
+        if not data:
+            raise CachetApiException(f"Failed to add point to metric ID {metric_id}")
+        logging.debug(f"Point {value} at {timestamp} was added to metric ID {metric_id}")
+        return data['data']
+
+    def new_schedule(self, **kwargs):
+        """
+        Create scheduled maintenance (Cachet 2.4+)
+        @param kwargs: name, message, status, scheduled_at, completed_at
+        @return: dict of data
+        """
+        data = self._http_post('schedules', kwargs)
+        if not data:
+            raise CachetApiException(f"Failed to create schedule {kwargs['name']}")
+        logging.info(f"Schedule {kwargs['name']} (id={data['data']['id']}) was created")
+        return data['data']
+
+    def upd_schedule(self, id, **kwargs):
+        """
+        Update scheduled maintenance
+        @param id: string
+        @param kwargs: name, message, status, scheduled_at, completed_at
+        @return: dict of data
+        """
+        data = self._http_put(f'schedules/{id}', kwargs)
+        if not data:
+            raise CachetApiException(f"Failed to update schedule ID {id}")
+        logging.info(f"Schedule ID {id} was updated")
+        return data['data']
+
+    def del_schedule(self, id):
+        """
+        Delete scheduled maintenance
+        @param id: string
+        @return: boolean
+        """
+        if self._http_delete(f'schedules/{id}') is None:
+            raise CachetApiException(f"Failed to delete schedule ID {id}")
+        logging.info(f"Schedule ID {id} was deleted")
+        return True
@@ -0,0 +1,42 @@
+"""
+JSON codec shared by Cachet and Zabbix clients.
+orjson is used when it is installed (pip install zabbix-cachet[fast]), stdlib json otherwise.
+"""
+import json
+from typing import Any, Iterable, List, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on environment
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Parse JSON from raw response bytes without decoding them to str first
+    :raise ValueError: if data is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Compact JSON of obj as bytes ready to be sent
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def project(items: Iterable[dict], fields: Iterable[str]) -> List[dict]:
+    """
+    Copy only needed fields of decoded objects. The whole response is still decoded,
+    but only the copies are kept after it is dropped
+    """
+    fields = tuple(fields)
+    return [{field: item[field] for field in fields if field in item} for item in items]
+
@@ -0,0 +1,123 @@
+"""
+Cheap detection of changed Zabbix IT services between full syncs.
+Audit log of IT services is polled since the last check. If it fails several times in a row while Zabbix is available
+(audit log needs Super admin role) lightweight list of service ids and names is compared instead
+and audit log is tried again from time to time.
+List of services is also remembered after every change seen in audit log, so changes made while audit log failed
+are found by comparing with it after fallback.
+"""
+import logging
+import time
+from typing import Callable, Dict, Set, Union
+
+from zabbix_cachet.zabbix import Zabbix
+
+
+class ServiceChangeDetector:
+    def __init__(self, zapi: Zabbix, clock: Callable[[], float] = time.time, auditlog_failures: int = 3,
+                 auditlog_retry: float = 3600):
+        """
+        @param auditlog_failures: failures of audit log in a row while Zabbix is available
+                                  before list of services is polled instead
+        @param auditlog_retry: seconds between attempts to return to audit log
+        """
+        self.zapi = zapi
+        self.clock = clock
+        self.auditlog_failures = max(1, int(auditlog_failures))
+        self.auditlog_retry = auditlog_retry
+        self.use_auditlog = True
+        self._auditlog_errors = 0
+        self._fallback_at = None
+        self._since = int(self.clock())
+        # Audit records of the second self._since which were already seen
+        self._seen = set()
+        self._names: Union[Dict[str, str], None] = None
+
+    def reset(self):
+        """
+        Start detecting changes from now. Call it before full sync
+        """
+        self._since = int(self.clock())
+        self._seen = set()
+        self._names = None
+        self._remember_names()
+
+    def poll(self) -> Union[Set[str], None]:
+        """
+        @return: ids of services changed since the last call or None if changes can not be detected now
+        """
+        if not self.use_auditlog and self.clock() - self._fallback_at >= self.auditlog_retry:
+            return self._retry_auditlog()
+        if self.use_auditlog:
+            changes = self._poll_auditlog()
+            if changes is not None:
+                self._auditlog_errors = 0
+                if changes:
+                    self._remember_names()
+                return changes
+            if not self.zapi.get_version():
+                return None
+            self._auditlog_errors += 1
+            if self._auditlog_errors < self.auditlog_failures:
+                logging.warning(f'Failed to read Zabbix audit log ({self._auditlog_errors} of '
+                                f'{self.auditlog_failures} failures before polling list of IT services)')
+                return None
+            logging.warning(f'Zabbix audit log is not available. Detect changes of IT services by list of them, '
+                            f'try audit log again in {self.auditlog_retry}s')
+            self.use_auditlog = False
+            self._fallback_at = self.clock()
+        return self._poll_names()
+
+    def _retry_auditlog(self) -> Union[Set[str], None]:
+        """
+        Poll list of services for changes till now and switch back to audit log from now if it is available
+        """
+        changes = self._poll_names()
+        if changes is None:
+            return None
+        self._fallback_at = self.clock()
+        self._since = int(self.clock())
+        self._seen = set()
+        audit_changes = self._poll_auditlog()
+        if audit_changes is None:
+            logging.debug('Zabbix audit log is still not available')
+            return changes
+        logging.info('Zabbix audit log is available again. Detect changes of IT services by it')
+        self.use_auditlog = True
+        self._auditlog_errors = 0
+        return changes | audit_changes
+
+    def _remember_names(self):
+        """
+        Remember list of services as it is now. If Zabbix fails, the older list is kept:
+        comparing with it finds more changes than were made, but does not miss any
+        """
+        names = self.zapi.get_service_names()
+        if names is not None:
+            self._names = names
+
+    def _poll_auditlog(self) -> Union[Set[str], None]:
+        records = self.zapi.get_service_audit(time_from=self._since)
+        if records is None:
+            return None
+        changes = set()
+        for record in records:
+            if record['auditid'] in self._seen:
+                continue
+            clock = int(record['clock'])
+            if clock > self._since:
+                self._since = clock
+                self._seen = set()
+            self._seen.add(record['auditid'])
+            changes.add(str(record['resourceid']))
+        return changes
+
+    def _poll_names(self) -> Union[Set[str], None]:
+        names = self.zapi.get_service_names()
+        if names is None:
+            return None
+        previous, self._names = self._names, names
+        if previous is None:
+            return set()
+        return {serviceid for serviceid in set(names) | set(previous)
+                if names.get(serviceid) != previous.get(serviceid)}
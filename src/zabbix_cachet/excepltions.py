@@ -21,6 +21,10 @@ class CachetApiException(ZabbixCachetException):
     pass
 
 
+class CachetNotAvailable(CachetApiException):
+    pass
+
+
 class ZabbixNotAvailable(ZabbixCachetException):
     pass
 
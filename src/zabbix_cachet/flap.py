@@ -0,0 +1,105 @@
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, Iterable, Union
+
+
+@dataclass
+class _ServiceFlaps:
+    is_ok: bool
+    # When service came to is_ok state
+    since: float
+    # Times of state changes within window
+    changes: Deque[float] = field(default_factory=deque)
+    # State which Cachet reflects. None - unknown
+    synced_ok: Union[bool, None] = None
+
+
+class FlapSuppressor:
+    """
+    Hysteresis between state of Zabbix service and Cachet incident.
+        problem_delay - seconds service has to be failed before incident is opened;
+        ok_delay - seconds service has to be OK before incident is resolved;
+        window, threshold - service which changed its state threshold times within window seconds is flapping.
+                            Incident of flapping service is opened at once and is not resolved until it calms down.
+    With default zeros every change is synced to Cachet at once.
+    """
+
+    def __init__(self, problem_delay: float = 0, ok_delay: float = 0, window: float = 0, threshold: int = 0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.configure(problem_delay, ok_delay, window, threshold)
+        self.clock = clock
+        self._services: Dict[int, _ServiceFlaps] = {}
+
+    def configure(self, problem_delay: float = 0, ok_delay: float = 0, window: float = 0, threshold: int = 0):
+        """
+        Change thresholds keeping history of services
+        """
+        self.problem_delay = problem_delay
+        self.ok_delay = ok_delay
+        self.window = window
+        self.threshold = threshold
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.problem_delay or self.ok_delay or (self.window and self.threshold))
+
+    def is_flapping(self, component_id: int) -> bool:
+        service = self._services.get(component_id)
+        if service is None or not self.threshold:
+            return False
+        self._expire(service, self.clock())
+        return len(service.changes) >= self.threshold
+
+    def _expire(self, service: _ServiceFlaps, now: float):
+        while service.changes and now - service.changes[0] > self.window:
+            service.changes.popleft()
+
+    def _observe(self, component_id: int, is_ok: bool, now: float) -> _ServiceFlaps:
+        service = self._services.get(component_id)
+        if service is None:
+            service = self._services[component_id] = _ServiceFlaps(is_ok=is_ok, since=now)
+        elif service.is_ok != is_ok:
+            service.is_ok = is_ok
+            service.since = now
+            if self.window:
+                service.changes.append(now)
+        self._expire(service, now)
+        return service
+
+    def should_sync(self, component_id: int, is_ok: bool) -> bool:
+        """
+        Observe state of service and decide if it has to be synced to Cachet in this cycle
+        @param component_id: Cachet component id
+        @param is_ok: current state of Zabbix service
+        @return: False if Cachet should keep its current state for now
+        """
+        if not self.enabled:
+            return True
+        now = self.clock()
+        service = self._observe(component_id, is_ok, now)
+        if service.synced_ok is None or service.synced_ok == is_ok:
+            return True
+        if not is_ok:
+            return self.is_flapping(component_id) or now - service.since >= self.problem_delay
+        if self.is_flapping(component_id):
+            logging.debug(f'Component {component_id} is flapping. Keep its incident open')
+            return False
+        return now - service.since >= self.ok_delay
+
+    def synced(self, component_id: int, is_ok: bool):
+        """
+        Remember which state of service Cachet reflects
+        """
+        service = self._services.get(component_id)
+        if service is not None:
+            service.synced_ok = is_ok
+
+    def retain(self, component_ids: Iterable[int]):
+        """
+        Forget services which are not in service map anymore
+        """
+        component_ids = set(component_ids)
+        for component_id in set(self._services) - component_ids:
+            del self._services[component_id]
@@ -0,0 +1,91 @@
+"""
+End-to-end propagation latency: time from Zabbix event (problem, acknowledge or recovery)
+to the moment Cachet confirmed the write which reflects it.
+Percentiles per component group are exported to Stats, the slowest propagations of a cycle are logged
+with a breakdown of where the time went.
+"""
+import logging
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List
+
+from zabbix_cachet.stats import STATS, Stats
+
+QUANTILES = (0.5, 0.9, 0.99)
+# Parts of propagation time in order they happen:
+#   poll_wait - from Zabbix event to start of the watcher cycle which saw it (includes flap suppression hold);
+#   zabbix_fetch - reading state of all services before the cycle and of this service;
+#   queued - waiting for other services of the cycle;
+#   cachet_fetch, cachet_write - Cachet requests made to sync this service
+BREAKDOWN = ('poll_wait', 'zabbix_fetch', 'queued', 'cachet_fetch', 'cachet_write')
+
+
+@dataclass(frozen=True)
+class Propagation:
+    component: str
+    group: str
+    # problem, acknowledge or recovery
+    event: str
+    seconds: float
+    breakdown: Dict[str, float]
+
+    def __str__(self):
+        parts = ', '.join(f'{name} {self.breakdown.get(name, 0):.1f}s' for name in BREAKDOWN)
+        name = f'{self.group} | {self.component}' if self.group else self.component
+        return f'{self.event} of {name} took {self.seconds:.1f}s ({parts})'
+
+
+def quantile(values: List[float], q: float) -> float:
+    """
+    Nearest-rank quantile of sorted values
+    """
+    if not values:
+        return 0
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 500, slow_threshold: float = 60, log_slowest: int = 3, stats: Stats = STATS):
+        """
+        @param window: number of the latest propagations per group which percentiles are calculated of
+        @param slow_threshold: propagations slower than this number of seconds are logged
+        @param log_slowest: how many slow propagations of a cycle are logged
+        @param stats: Stats where percentiles are exported
+        """
+        self.window = int(window)
+        self.slow_threshold = float(slow_threshold)
+        self.log_slowest = int(log_slowest)
+        self.stats = stats
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+        self._cycle: List[Propagation] = []
+
+    def record(self, propagation: Propagation):
+        with self._lock:
+            self._samples.setdefault(propagation.group, deque(maxlen=self.window)).append(propagation.seconds)
+            self._cycle.append(propagation)
+        self.stats.inc('zabbix_cachet_propagations_total', 1, 'Zabbix events propagated to Cachet',
+                       group=propagation.group, event=propagation.event)
+
+    def percentiles(self, group: str) -> Dict[float, float]:
+        with self._lock:
+            values = sorted(self._samples.get(group, ()))
+        return {q: quantile(values, q) for q in QUANTILES}
+
+    def cycle_end(self):
+        """
+        Export percentiles and log the slowest propagations of the finished cycle
+        """
+        with self._lock:
+            cycle, self._cycle = self._cycle, []
+            groups = list(self._samples)
+        for group in groups:
+            for q, value in self.percentiles(group).items():
+                self.stats.set('zabbix_cachet_propagation_seconds', value,
+                               f'Quantiles of time from Zabbix event to Cachet write over the last {self.window} '
+                               f'propagations', group=group, quantile=q)
+        slow = sorted((p for p in cycle if p.seconds >= self.slow_threshold), key=lambda p: -p.seconds)
+        for propagation in slow[:self.log_slowest]:
+            logging.warning(f'Slow propagation: {propagation}')
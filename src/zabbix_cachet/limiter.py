@@ -0,0 +1,154 @@
+"""
+Adaptive limit of concurrent requests to a backend (Cachet or Zabbix API).
+The limit follows AIMD: it grows by one after every window of successful requests with healthy latency
+and is cut by backoff when 90th percentile of latency rises over tolerance times baseline (the best median seen),
+or at once on 429/5xx responses, timeouts and connection errors.
+So throughput finds the fastest rate which backend handles without queueing or failing.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque
+
+import requests
+
+from zabbix_cachet.latency import quantile
+from zabbix_cachet.stats import STATS, Stats
+
+# Baseline latency slowly follows the current one, so a permanent change of backend speed is accepted
+BASELINE_DRIFT = 1.02
+
+
+class _Slot:
+    """
+    One request through limiter. Set overloaded if response says backend is overloaded (429, 5xx)
+    """
+
+    def __init__(self, limiter: 'AdaptiveLimiter'):
+        self.limiter = limiter
+        self.overloaded = False
+        self._started = None
+
+    def __enter__(self) -> '_Slot':
+        self.limiter.acquire()
+        self._started = self.limiter.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        latency = self.limiter.clock() - self._started
+        if exc_type is None:
+            outcome = 'overload' if self.overloaded else 'ok'
+        elif issubclass(exc_type, requests.exceptions.Timeout):
+            outcome = 'timeout'
+        elif issubclass(exc_type, requests.exceptions.HTTPError):
+            status = exc.response.status_code if exc.response is not None else 500
+            outcome = 'overload' if status == 429 or status >= 500 else 'ok'
+        elif issubclass(exc_type, requests.exceptions.ConnectionError):
+            outcome = 'error'
+        else:
+            # Application errors tell nothing about load of backend
+            outcome = None
+        self.limiter.release(latency, outcome, started=self._started)
+        return False
+
+
+class AdaptiveLimiter:
+    def __init__(self, name: str, initial: int = 8, min_limit: int = 1, max_limit: int = 64,
+                 window: int = 20, tolerance: float = 2.0, backoff: float = 0.5,
+                 clock: Callable[[], float] = time.monotonic, stats: Stats = STATS):
+        """
+        @param name: name of backend in logs and metrics
+        @param initial: limit of concurrent requests at start
+        @param min_limit: the limit never goes lower
+        @param max_limit: the limit never goes higher
+        @param window: number of successful requests the limit is adjusted after
+        @param tolerance: latency is unhealthy when its 90th percentile is tolerance times higher than baseline
+        @param backoff: limit is multiplied by it on overload
+        """
+        self.name = name
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = min(self.max_limit, max(self.min_limit, int(initial)))
+        self.window = max(1, int(window))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.clock = clock
+        self.stats = stats
+        self.in_flight = 0
+        self.baseline = None
+        self._cond = threading.Condition()
+        self._latencies: Deque[float] = deque(maxlen=self.window)
+        self._last_decrease = None
+        self._export()
+
+    @classmethod
+    def from_config(cls, name: str, concurrency_config: dict = None) -> 'AdaptiveLimiter':
+        concurrency_config = concurrency_config or {}
+        return cls(name, initial=concurrency_config.get('initial', 8), min_limit=concurrency_config.get('min', 1),
+                   max_limit=concurrency_config.get('max', 64), window=concurrency_config.get('window', 20),
+                   tolerance=concurrency_config.get('tolerance', 2.0),
+                   backoff=concurrency_config.get('backoff', 0.5))
+
+    def _export(self):
+        self.stats.set('zabbix_cachet_concurrency_limit', self.limit, 'Current limit of concurrent requests',
+                       backend=self.name)
+
+    def slot(self) -> _Slot:
+        """
+        Context manager around one request:
+            with limiter.slot() as slot:
+                response = ...
+                slot.overloaded = response.status_code == 429
+        """
+        return _Slot(self)
+
+    def acquire(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    def release(self, latency: float, outcome: str = 'ok', started: float = None):
+        """
+        @param latency: seconds the request took
+        @param outcome: ok, overload (429/5xx), timeout, error (connection failed)
+                        or None if it says nothing about backend load
+        @param started: clock() when the request was sent. Failures of requests sent before the last decrease
+                        of limit neither decrease it again nor count in latency window.
+                        None - the request is taken as sent now
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if outcome in ('overload', 'timeout', 'error'):
+                self.stats.inc('zabbix_cachet_backend_overloads_total', 1,
+                               'Requests which failed because backend was overloaded or not available',
+                               backend=self.name, reason=outcome)
+                if started is None or self._last_decrease is None or started >= self._last_decrease:
+                    self._decrease(f'{outcome} of request')
+            elif outcome == 'ok' and (started is None or self._last_decrease is None
+                                      or started >= self._last_decrease):
+                self._latencies.append(latency)
+                if len(self._latencies) >= self.window:
+                    self._adjust()
+            self._cond.notify_all()
+
+    def _decrease(self, reason: str):
+        self._last_decrease = self.clock()
+        limit = max(self.min_limit, int(self.limit * self.backoff))
+        if limit != self.limit:
+            logging.info(f'{self.name}: limit of concurrent requests {self.limit} -> {limit} because of {reason}')
+            self.limit = limit
+            self._export()
+        self._latencies.clear()
+
+    def _adjust(self):
+        latencies = sorted(self._latencies)
+        median, p90 = quantile(latencies, 0.5), quantile(latencies, 0.9)
+        self.baseline = median if self.baseline is None else min(median, self.baseline * BASELINE_DRIFT)
+        self._latencies.clear()
+        if p90 > self.baseline * self.tolerance:
+            self._decrease(f'latency p90 {p90:.3f}s over baseline {self.baseline:.3f}s')
+        elif self.limit < self.max_limit:
+            self.limit += 1
+            self._export()
+            logging.debug(f'{self.name}: limit of concurrent requests is increased to {self.limit}')
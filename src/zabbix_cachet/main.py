@@ -5,11 +5,13 @@ This script populated Cachet of Zabbix IT Services
 import sys
 import os
 import pathlib
+import signal
+import time
 import datetime
-from dataclasses import dataclass
-from typing import List, Union
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Set, Tuple, Union
 
-import time
 import threading
 import logging
 
@@ -17,10 +19,26 @@ import requests
 import yaml
 import pytz
 
+from zabbix_cachet.acks import AckRenderer
 from zabbix_cachet.cachet import Cachet
-from zabbix_cachet.excepltions import ZabbixNotAvailable, ZabbixCachetException, ZabbixServiceNotFound
+from zabbix_cachet.breaker import CircuitBreaker
+from zabbix_cachet.budget import Deadline, Watchdog, timeout_from_config
+from zabbix_cachet.excepltions import (CachetApiException, CachetNotAvailable, ZabbixNotAvailable,
+                                       ZabbixCachetException, ZabbixServiceNotFound)
+from zabbix_cachet.discovery import ServiceChangeDetector
+from zabbix_cachet.flap import FlapSuppressor
+from zabbix_cachet.latency import LatencyTracker, Propagation
+from zabbix_cachet.limiter import AdaptiveLimiter
+from zabbix_cachet.service_map import ServiceMapHandoff
+from zabbix_cachet.profiling import PROFILER
+from zabbix_cachet.reload import ConfigWatcher
+from zabbix_cachet.stats import STATS
 from zabbix_cachet.zabbix import Zabbix, ZabbixService
 
+if TYPE_CHECKING:
+    # Optional features are imported only when they are configured
+    from zabbix_cachet.zabbix_db import ZabbixDB
+
 __author__ = 'Artem Aleksandrov <qk4l()tem4uk.ru>'
 __license__ = """The MIT License (MIT)"""
 __version__ = '2.1.4'
@@ -34,6 +52,21 @@ class ConfigTemplates:
     resolving: str = ''
 
 
+@dataclass(frozen=True)
+class ConfigSections:
+    """
+    Sections of one read of config file. Config replaces them as a whole on reload
+    """
+    raw: dict
+    zabbix_config: dict
+    cachet_config: dict
+    app_settings: dict
+    metrics_config: dict
+    maintenance_config: dict
+    tz: Union[datetime.tzinfo, None]
+    templates: ConfigTemplates
+
+
 class Config:
     _instance = None
 
@@ -55,17 +88,81 @@ class Config:
             config = read_config(self.config_file)
             if not config:
                 sys.exit(1)
-            self.zabbix_config = config['zabbix']
-            self.cachet_config = config['cachet']
-            self.app_settings = config['settings']
+            self._apply(config)
+            # Increased by every reload which changed something
+            self.generation = 0
+            self.initialized = True
 
-            if self.app_settings.get('time_zone'):
-                self.tz = pytz.timezone(self.app_settings['time_zone'])
-            else:
-                self.tz = None
+    def _apply(self, config: dict):
+        # One assignment, so other threads never see sections of the old and the new config mixed
+        self.sections = ConfigSections(
+            raw=config,
+            zabbix_config=config['zabbix'],
+            cachet_config=config['cachet'],
+            app_settings=config['settings'],
+            metrics_config=config.get('metrics') or {},
+            maintenance_config=config.get('maintenance') or {},
+            tz=pytz.timezone(config['settings']['time_zone']) if config['settings'].get('time_zone') else None,
+            templates=ConfigTemplates(**config.get('templates')),
+        )
 
-            self.templates = ConfigTemplates(**config.get('templates'))
-            self.initialized = True
+    @property
+    def raw(self) -> dict:
+        return self.sections.raw
+
+    @property
+    def zabbix_config(self) -> dict:
+        return self.sections.zabbix_config
+
+    @property
+    def cachet_config(self) -> dict:
+        return self.sections.cachet_config
+
+    @property
+    def app_settings(self) -> dict:
+        return self.sections.app_settings
+
+    @property
+    def metrics_config(self) -> dict:
+        return self.sections.metrics_config
+
+    @property
+    def maintenance_config(self) -> dict:
+        return self.sections.maintenance_config
+
+    @property
+    def tz(self) -> Union[datetime.tzinfo, None]:
+        return self.sections.tz
+
+    @property
+    def templates(self) -> ConfigTemplates:
+        return self.sections.templates
+
+    def reload(self) -> Set[str]:
+        """
+        Read config file again and update this object in place.
+        Invalid config is logged and ignored
+        @return: changed keys as section.key (e.g. settings.log_level) or section
+        """
+        config = read_config(self.config_file)
+        if not config:
+            return set()
+        changed = set()
+        for section in set(config) | set(self.raw):
+            old, new = self.raw.get(section), config.get(section)
+            if isinstance(old, dict) and isinstance(new, dict):
+                changed.update(f'{section}.{key}' for key in set(old) | set(new) if old.get(key) != new.get(key))
+            elif old != new:
+                changed.add(section)
+        if not changed:
+            return changed
+        try:
+            self._apply(config)
+        except (KeyError, TypeError, pytz.UnknownTimeZoneError) as err:
+            logging.error(f'Failed to reload config file {self.config_file}: {err!r}. Keep the current one')
+            return set()
+        self.generation += 1
+        return changed
 
 
 @dataclass
@@ -79,12 +176,364 @@ class ZabbixCachetMap:
     zbx_serviceid: str = None
     # Only for Zabbix < 6.0
     zbx_triggerid: str = None
+    # Service which is shown as Cachet group of component
+    zbx_group_serviceid: str = None
+
+    @property
+    def zbx_top_serviceid(self) -> str:
+        """
+        Id of child of root service which this component was synced from
+        """
+        return self.zbx_group_serviceid or self.zbx_serviceid
 
     def __str__(self):
         return f"{self.cachet_group_name}/{self.cachet_component_name} - {self.zbx_serviceid}"
 
 
-def triggers_watcher(service_map: List[ZabbixCachetMap], zapi: Zabbix, cachet: Cachet) -> bool:
+@dataclass(frozen=True)
+class ServiceFingerprint:
+    """
+    Everything that decides what triggers_watcher does with a service.
+    If it is the same as in previous cycle there is nothing to sync to Cachet
+    """
+    zbx_status: int
+    trigger_ids: Tuple[str, ...] = ()
+    ack_ids: Tuple[str, ...] = ()
+    incident_id: Union[str, None] = None
+    incident_status: Union[str, None] = None
+
+
+@dataclass
+class ServiceState:
+    """
+    State of Zabbix service collected by triggers_watcher in one cycle
+    """
+    status: int
+    is_ok: bool
+    trigger_ids: Tuple[str, ...] = ()
+    ack_ids: Tuple[str, ...] = ()
+    inc_name: str = ''
+    inc_msg: str = ''
+    inc_status: int = 1
+    comp_status: int = 1
+    # The highest Zabbix priority of failed triggers
+    priority: int = 0
+    # Unix time and kind (problem or acknowledge) of the newest Zabbix event reflected in this state
+    event_clock: int = 0
+    event: str = ''
+    # Unix time when the cycle which collected this state started and seconds spent on reading it from Zabbix
+    collected_at: float = 0.0
+    fetch_seconds: float = 0.0
+
+    def fingerprint(self, incident_id=None, incident_status=None) -> ServiceFingerprint:
+        return ServiceFingerprint(zbx_status=self.status,
+                                  trigger_ids=self.trigger_ids,
+                                  ack_ids=self.ack_ids,
+                                  incident_id=None if incident_id is None else str(incident_id),
+                                  incident_status=None if incident_status is None else str(incident_status))
+
+
+@dataclass
+class WatcherState:
+    """
+    State of triggers_watcher which lives between cycles and service map updates
+    """
+    acks: AckRenderer
+    # Cachet component id -> fingerprint of last synced state
+    fingerprints: Dict[int, ServiceFingerprint] = field(default_factory=dict)
+    # Cachet component id -> Zabbix side of the last state written to Cachet.
+    # Unlike fingerprints it is kept when sync fails, so the change is measured from there when it is delivered
+    delivered: Dict[int, ServiceFingerprint] = field(default_factory=dict)
+    # Cachet component id -> (ZabbixCachetMap, ServiceState) which was not synced because Cachet was not available.
+    # Only the latest state of component is kept
+    backlog: Dict[int, Tuple[ZabbixCachetMap, ServiceState]] = field(default_factory=dict)
+    # Cachet component ids which did not fit into budget of previous cycle. They are checked first
+    deferred: List[int] = field(default_factory=list)
+    flaps: FlapSuppressor = field(default_factory=FlapSuppressor)
+    # Cachet component id -> Zabbix priority of its last problem. Resolving is as urgent as the problem was
+    priorities: Dict[int, int] = field(default_factory=dict)
+    # Cachet component id -> monotonic time since its change waits for sync because of write cap
+    waiting_since: Dict[int, float] = field(default_factory=dict)
+    # Cachet component id -> component with its incident as it was synced, for status snapshot
+    components: Dict[int, dict] = field(default_factory=dict)
+    latency: LatencyTracker = field(default_factory=LatencyTracker)
+    cycles: int = 0
+    skipped_total: int = 0
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'WatcherState':
+        return cls(acks=AckRenderer(config.templates.acknowledgement,
+                                    config.templates.acknowledgement_time_strftime,
+                                    config.tz),
+                   flaps=FlapSuppressor(**config.app_settings.get('flap_suppression') or {}),
+                   latency=LatencyTracker(**config.app_settings.get('propagation_latency') or {}))
+
+    def apply_config(self, config: Config):
+        """
+        Apply reloaded config keeping fingerprints, backlog and caches
+        """
+        self.acks.configure(config.templates.acknowledgement, config.templates.acknowledgement_time_strftime,
+                            config.tz)
+        self.flaps.configure(**config.app_settings.get('flap_suppression') or {})
+
+
+def zabbix_priority_to_component_status(priority: Union[int, str]) -> int:
+    """
+    Map Zabbix trigger priority to Cachet component status
+    """
+    # TODO: Rewrite it to get current severity from service.
+    # Zabbix 6.0+ fine works with it and allow to change via Dashboard
+    if int(priority) >= 4:
+        return 4
+    elif int(priority) == 3:
+        return 3
+    return 2
+
+
+def collect_service(i: ZabbixCachetMap, zapi: Union[Zabbix, 'ZabbixDB'], state: WatcherState,
+                    config: Config) -> Union[ServiceState, None]:
+    """
+    Read state of Zabbix service with its triggers and events and render Cachet incident for it
+    @param i: ZabbixCachetMap
+    @return: ServiceState or None if service should be skipped in this cycle
+    """
+    try:
+        service = zapi.get_zabbix_service(serviceid=i.zbx_serviceid)
+    except ZabbixServiceNotFound as err:
+        logging.warning(f"Skip service with serviceid {i.zbx_serviceid} because it was not found in Zabbix: {err}")
+        return None
+
+    # Service not failed
+    if service.is_status_ok:
+        return ServiceState(status=service.status, is_ok=True)
+
+    # Service failed
+    if zapi.version_major < 6:
+        triggers = zapi.get_trigger(triggerid=service.triggerid)
+        # Check if Zabbix return trigger
+        # TODO: Do we need this check?
+        if not triggers or 'value' not in triggers[0]:
+            logging.error(f'Cannot get value for trigger {service.triggerid}')
+            return None
+        if str(triggers[0]['value']) == '0':
+            logging.warning(f'Service {service.serviceid} in failed state but trigger {service.triggerid} is ok.'
+                            f'It could be race condition but if you see this often - bug.')
+            return None
+    else:
+        # All trigger in Active state because we use only_true=True argument
+        triggers = zapi.get_trigger(tags=service.problem_tags)
+    if not triggers:
+        return None
+
+    inc_name = ''
+    inc_msg = ''
+    inc_status = 2
+    comp_status = 1
+    priority = 0
+    event_clock = 0
+    event = ''
+    ack_ids = []
+    for trigger in triggers:
+        trigger_id = trigger['triggerid']
+        zbx_event = zapi.get_event(trigger_id)
+        if not zbx_event:
+            logging.warning(f'Failed to get zabbix event for trigger {trigger_id}')
+            # Mock zbx_event for further usage
+            zbx_event = {'acknowledged': '0'}
+        zbx_event_clock = int(zbx_event.get('clock', 0))
+        if zbx_event_clock > event_clock:
+            event_clock, event = zbx_event_clock, 'problem'
+        if zbx_event.get('acknowledged', '0') == '1':
+            ack_msg, event_ack_ids = state.acks.render(i.cachet_component_id, zbx_event)
+            if ack_msg:
+                inc_msg = ack_msg + inc_msg
+            ack_ids.extend(event_ack_ids)
+            for ack in zbx_event.get('acknowledges', []):
+                if int(ack['clock']) > event_clock:
+                    event_clock, event = int(ack['clock']), 'acknowledge'
+        else:
+            # Incident is Identified only when all its problems are acknowledged
+            inc_status = 1
+        comp_status = max(comp_status, zabbix_priority_to_component_status(trigger['priority']))
+        priority = max(priority, int(trigger['priority']))
+
+        if not inc_msg and config.templates.investigating:
+            if zbx_event_clock:
+                zbx_event_time = datetime.datetime.fromtimestamp(zbx_event_clock, tz=config.tz).strftime(
+                    '%b %d, %H:%M')
+            else:
+                zbx_event_time = ''
+            inc_msg = config.templates.investigating.format(
+                group=i.cachet_group_name,
+                component=i.cachet_component_name,
+                time=zbx_event_time,
+                trigger_description=trigger.get('comments', ''),
+                trigger_name=trigger.get('description', ''),
+            )
+
+        # Just in case when user set investigating template to empty string
+        if not inc_msg and trigger.get('comments'):
+            inc_msg = trigger.get('comments')
+        elif not inc_msg:
+            inc_msg = trigger.get('description')
+
+        # Incident is named after the first trigger
+        if not inc_name:
+            inc_name = trigger['description']
+            if i.cachet_group_name:
+                inc_name = i.cachet_group_name + ' | ' + inc_name
+
+    return ServiceState(status=service.status, is_ok=False,
+                        trigger_ids=tuple(str(trigger['triggerid']) for trigger in triggers),
+                        ack_ids=tuple(ack_ids),
+                        inc_name=inc_name, inc_msg=inc_msg, inc_status=inc_status, comp_status=comp_status,
+                        priority=priority, event_clock=event_clock, event=event)
+
+
+def sync_service(i: ZabbixCachetMap, service_state: ServiceState, cachet: Cachet, state: WatcherState,
+                 config: Config) -> Union[ServiceFingerprint, None]:
+    """
+    Bring Cachet component and its incident in line with state of Zabbix service
+    @param i: ZabbixCachetMap
+    @param service_state: ServiceState returned by collect_service()
+    @return: ServiceFingerprint of synced state or None if sync failed
+    """
+    if service_state.is_ok:
+        cache_component = cachet.get_component(i.cachet_component_id)
+        if not cache_component:
+            logging.error(f"Failed to get Cachet component with ID: {i.cachet_component_id}. Skip it")
+            return None
+        # component not operational mode. Resolve it.
+        if str(cache_component['data']['status']) != '1':
+            last_inc = cachet.get_incident(i.cachet_component_id)
+            resolving_msg = config.templates.resolving.format(
+                time=datetime.datetime.now(tz=config.tz).strftime('%b %d, %H:%M'),
+            )
+            if str(last_inc['id']) != '0' and cachet.incident_updates:
+                # Change statuses without resending incident body
+                cachet.upd_incident(last_inc['id'],
+                                    status=4,
+                                    component_id=i.cachet_component_id,
+                                    component_status=1)
+                if resolving_msg.strip():
+                    cachet.new_incident_update(last_inc['id'], status=4, message=resolving_msg)
+            elif str(last_inc['id']) != '0':
+                cachet.upd_incident(last_inc['id'],
+                                    status=4,
+                                    component_id=i.cachet_component_id,
+                                    component_status=1,
+                                    message=resolving_msg + last_inc['message'])
+            # Incident does not exist. Just change component status
+            else:
+                cachet.upd_components(i.cachet_component_id, status=1)
+        state.acks.forget(i.cachet_component_id)
+        return service_state.fingerprint()
+
+    last_inc = cachet.get_incident(i.cachet_component_id)
+    # Incident not registered
+    if last_inc['status'] in ('-1', '4'):
+        new_inc = cachet.new_incidents(name=service_state.inc_name, message=service_state.inc_msg,
+                                       status=service_state.inc_status, component_id=i.cachet_component_id,
+                                       component_status=service_state.comp_status)
+        state.acks.mark_sent(i.cachet_component_id, new_inc['id'], service_state.ack_ids)
+        return service_state.fingerprint(new_inc['id'], service_state.inc_status)
+
+    # Incident already registered
+    if cachet.incident_updates:
+        return _sync_incident_updates(i, service_state, last_inc, cachet, state)
+    # Only incident message can change. So check if new acknowledges have appeared
+    is_changed = state.acks.is_changed(last_inc['id'], service_state.ack_ids)
+    if is_changed is None:
+        # Incident was created before start. Compare its message once
+        is_changed = last_inc['message'].strip() != service_state.inc_msg.strip()
+    inc_status = last_inc['status']
+    if is_changed:
+        cachet.upd_incident(last_inc['id'], message=service_state.inc_msg, status=service_state.inc_status,
+                            component_status=service_state.comp_status)
+        inc_status = service_state.inc_status
+    state.acks.mark_sent(i.cachet_component_id, last_inc['id'], service_state.ack_ids)
+    return service_state.fingerprint(last_inc['id'], inc_status)
+
+
+def _sync_incident_updates(i: ZabbixCachetMap, service_state: ServiceState, last_inc: dict, cachet: Cachet,
+                           state: WatcherState) -> ServiceFingerprint:
+    """
+    Post only new acknowledges of registered incident as Cachet incident update.
+    If there is nothing new but status has changed, change status without resending incident body
+    """
+    if state.acks.is_changed(last_inc['id'], service_state.ack_ids) is None:
+        # Incident was created before start. Find out which acknowledges it already has
+        messages = [last_inc.get('message', '')]
+        messages.extend(update.get('message', '') for update in cachet.get_incident_updates(last_inc['id']))
+        state.acks.restore_sent(i.cachet_component_id, last_inc['id'], service_state.ack_ids, messages)
+    new_ack_ids = state.acks.unsent(last_inc['id'], service_state.ack_ids)
+    inc_status = last_inc['status']
+    if new_ack_ids:
+        cachet.new_incident_update(last_inc['id'], status=service_state.inc_status,
+                                   message=state.acks.text(new_ack_ids))
+        inc_status = service_state.inc_status
+    elif str(service_state.inc_status) != str(last_inc['status']):
+        cachet.upd_incident(last_inc['id'], status=service_state.inc_status,
+                            component_status=service_state.comp_status)
+        inc_status = service_state.inc_status
+    state.acks.mark_sent(i.cachet_component_id, last_inc['id'], service_state.ack_ids)
+    return service_state.fingerprint(last_inc['id'], inc_status)
+
+
+def _sync_or_backlog(i: ZabbixCachetMap, service_state: ServiceState, cachet: Cachet, state: WatcherState,
+                     config: Config):
+    """
+    Sync service to Cachet and remember its fingerprint.
+    If Cachet is not available keep service state in backlog instead
+    """
+    # Do not trust to old fingerprint if sync will fail in the middle
+    state.fingerprints.pop(i.cachet_component_id, None)
+    if cachet.breaker.allow():
+        try:
+            fingerprint = sync_service(i, service_state, cachet, state, config)
+        except CachetNotAvailable:
+            fingerprint = None
+        except CachetApiException as err:
+            logging.error(f'Failed to sync {i} to Cachet: {err}')
+            return
+        if fingerprint:
+            state.fingerprints[i.cachet_component_id] = fingerprint
+            return
+    if not cachet.breaker.is_closed:
+        state.backlog[i.cachet_component_id] = (i, service_state)
+
+
+def _deliver(i: ZabbixCachetMap, service_state: ServiceState, zapi: Union[Zabbix, 'ZabbixDB'], cachet: Cachet,
+             state: WatcherState, config: Config):
+    """
+    Sync service to Cachet (or keep it in backlog) and record propagation latency if it was written
+    """
+    writes, io_time = cachet.writes, cachet.io_time
+    with PROFILER.phase('sync'):
+        _sync_or_backlog(i, service_state, cachet, state, config)
+    if i.cachet_component_id not in state.fingerprints:
+        return
+    previous = state.delivered.get(i.cachet_component_id)
+    state.delivered[i.cachet_component_id] = service_state.fingerprint()
+    if cachet.writes > writes:
+        _record_propagation(i, service_state, previous, zapi, state,
+                            [after - before for before, after in zip(io_time, cachet.io_time)])
+
+
+def flush_backlog(zapi: Union[Zabbix, 'ZabbixDB'], cachet: Cachet, state: WatcherState, config: Config):
+    """
+    Sync all states which were kept while Cachet was not available as one batch
+    """
+    backlog, state.backlog = state.backlog, {}
+    logging.info(f'Cachet is available. Flush {len(backlog)} pending component changes')
+    for i, service_state in backlog.values():
+        _deliver(i, service_state, zapi, cachet, state, config)
+    if state.backlog:
+        logging.warning(f'Cachet is not available again. {len(state.backlog)} component changes are still pending')
+
+
+def triggers_watcher(service_map: List[ZabbixCachetMap], zapi: Union[Zabbix, 'ZabbixDB'], cachet: Cachet,
+                     state: WatcherState = None, deadline: Deadline = None) -> bool:
     """
     Check zabbix triggers and update Cachet components
     Zabbix Priority:
@@ -105,175 +554,256 @@ def triggers_watcher(service_map: List[ZabbixCachetMap], zapi: Zabbix, cachet: C
         New - Investigating
         Acknowledged - Identified
         Resolved - Fixed
+
+    Services which fingerprint did not change since previous cycle are not checked in Cachet.
+    Every settings.full_check_cycles cycle all services are checked anyway.
+    While Cachet is not available desired states of services are kept in backlog
+    and flushed when Cachet is back.
+    Services which do not fit into deadline are deferred to the next cycle and checked first there.
+    Changes of flapping or just changed services are held according to settings.flap_suppression.
+    Changed services are synced from the highest Zabbix priority and the longest waiting ones.
+    After settings.max_writes_per_cycle Cachet writes the rest waits for the next cycle,
+    where only its latest state is synced.
+    Time from Zabbix event to Cachet write is recorded for every synced change (settings.propagation_latency).
+    @param state: WatcherState which is kept between calls
+    @param deadline: Deadline of the cycle
     @return: boolean
     """
     config = Config()
-    for i in service_map:  # type: ZabbixCachetMap
-        # inc_status = 1
-        # comp_status = 1
-        # inc_name = ''
-        inc_msg = ''
+    if state is None:
+        state = WatcherState.from_config(config)
+    component_ids = {i.cachet_component_id for i in service_map}
+    state.acks.retain(component_ids)
+    state.flaps.retain(component_ids)
+    for mapping in (state.fingerprints, state.delivered, state.backlog, state.priorities, state.waiting_since,
+                    state.components):
+        for component_id in set(mapping) - component_ids:
+            del mapping[component_id]
+    if state.backlog and cachet.breaker.allow():
+        flush_backlog(zapi, cachet, state, config)
+    cycle_started = time.time()
+    if not zapi.prefetch([i.zbx_serviceid for i in service_map]):
+        logging.error('Failed to read state of services from Zabbix. Skip checking...')
+        return False
+    prefetch_seconds = time.time() - cycle_started
 
-        try:
-            service = zapi.get_zabbix_service(serviceid=i.zbx_serviceid)
-        except ZabbixServiceNotFound as err:
-            logging.warning(f"Skip service with serviceid {i.zbx_serviceid} because it was not found in Zabbix: {err}")
+    full_check_cycles = int(config.app_settings.get('full_check_cycles', 10))
+    full_check = not full_check_cycles or state.cycles % full_check_cycles == 0
+    state.cycles += 1
+    skipped = 0
+    held = 0
+    deferred = set(state.deferred)
+    ordered_map = sorted(service_map, key=lambda item: item.cachet_component_id not in deferred)
+    state.deferred = []
+    # Read all services from Zabbix first, then sync changed ones to Cachet starting from the most severe
+    changed: List[Tuple[ZabbixCachetMap, ServiceState]] = []
+    for n, i in enumerate(ordered_map):  # type: int, ZabbixCachetMap
+        if deadline and deadline.expired:
+            _defer(ordered_map[n:], deadline, state)
+            break
+        started = time.perf_counter()
+        with PROFILER.phase('collect'):
+            service_state = collect_service(i, zapi, state, config)
+        if service_state is None:
+            state.fingerprints.pop(i.cachet_component_id, None)
             continue
-
-        cache_component = cachet.get_component(i.cachet_component_id)
-        if not cache_component:
-            logging.error(f"Failed to get Cachet component with ID: {i.cachet_component_id}. Skip it")
+        service_state.collected_at = cycle_started
+        service_state.fetch_seconds = prefetch_seconds + time.perf_counter() - started
+        if not state.flaps.should_sync(i.cachet_component_id, service_state.is_ok):
+            held += 1
             continue
-        # Service not failed
-        component_status = cache_component['data']['status']
-        if service.is_status_ok:
-            # component in operational mode
-            if str(component_status) == '1':
-                continue
-            else:
-                # component not operational mode. Resolve it.
-                last_inc = cachet.get_incident(i.cachet_component_id)
-                if str(last_inc['id']) != '0':
-                    inc_msg = config.templates.resolving.format(
-                        time=datetime.datetime.now(tz=config.tz).strftime('%b %d, %H:%M'),
-                    ) + cachet.get_incident(i.cachet_component_id)['message']
-                    cachet.upd_incident(last_inc['id'],
-                                        status=4,
-                                        component_id=i.cachet_component_id,
-                                        component_status=1,
-                                        message=inc_msg)
-                # Incident does not exist. Just change component status
-                else:
-                    cachet.upd_components(i.cachet_component_id, status=1)
-            # Continue with next service. This one is ok.
+        last_fingerprint = state.fingerprints.get(i.cachet_component_id)
+        if not full_check and last_fingerprint and last_fingerprint == service_state.fingerprint(
+                last_fingerprint.incident_id, last_fingerprint.incident_status):
+            skipped += 1
             continue
+        changed.append((i, service_state))
 
-        # Service failed
-        if zapi.version_major < 6:
-            triggers = zapi.get_trigger(triggerid=service.triggerid)
-            # Check if Zabbix return trigger
-            # TODO: Do we need this check?
-            if 'value' not in triggers[0]:
-                logging.error(f'Cannot get value for trigger {service.triggerid}')
-                continue
-            if str(triggers[0]['value']) == '0':
-                logging.warning(f'Service {service.serviceid} in failed state but trigger {service.triggerid} is ok.'
-                                f'It could be race condition but if you see this often - bug.')
-                continue
-        else:
-            # All trigger in Active state because we use only_true=True argument
-            triggers = zapi.get_trigger(tags=service.problem_tags)
+    now = time.monotonic()
+    changed.sort(key=lambda item: (-_sync_priority(item[0], item[1], state),
+                                   state.waiting_since.get(item[0].cachet_component_id, now)))
+    max_writes = int(config.app_settings.get('max_writes_per_cycle', 0))
+    first_write = cachet.writes
+    for n, (i, service_state) in enumerate(changed):
+        if max_writes and cachet.writes - first_write >= max_writes:
+            shed = changed[n:]
+            for shed_i, _ in shed:
+                state.waiting_since.setdefault(shed_i.cachet_component_id, now)
+            logging.warning(f'Limit of {max_writes} Cachet writes per cycle is reached. '
+                            f'{len(shed)} less severe changes wait for the next cycle')
+            STATS.inc('zabbix_cachet_shed_services_total', len(shed),
+                      'Service changes postponed because of Cachet writes limit')
+            break
+        # At least one change is synced, otherwise slow Zabbix would block Cachet updates at all
+        if deadline and n and deadline.expired:
+            _defer([item for item, _ in changed[n:]], deadline, state)
+            break
+        if not service_state.is_ok:
+            state.priorities[i.cachet_component_id] = service_state.priority
+        _deliver(i, service_state, zapi, cachet, state, config)
+        state.waiting_since.pop(i.cachet_component_id, None)
+        if i.cachet_component_id in state.fingerprints or i.cachet_component_id in state.backlog:
+            state.flaps.synced(i.cachet_component_id, service_state.is_ok)
+            state.components[i.cachet_component_id] = _snapshot_component(
+                i, service_state, state.fingerprints.get(i.cachet_component_id))
+    state.latency.cycle_end()
+    state.skipped_total += skipped
+    STATS.inc('zabbix_cachet_skipped_services_total', skipped, 'Services skipped because they did not change')
+    if full_check:
+        logging.debug('All services were fully checked in this cycle')
+    if held:
+        logging.info(f'State changes of {held} services are held by flap suppression')
+    logging.info(f'Skipped {skipped} of {len(service_map)} unchanged services ({state.skipped_total} in total)')
+    if state.backlog:
+        logging.warning(f'Cachet is not available. {len(state.backlog)} component changes are pending')
+    return True
 
-        for trigger in triggers:
-            trigger_id = trigger['triggerid']
-            zbx_event = zapi.get_event(trigger_id)
-            inc_name = trigger['description']
-            if not zbx_event:
-                logging.warning(f'Failed to get zabbix event for trigger {trigger_id}')
-                # Mock zbx_event for further usage
-                zbx_event = {'acknowledged': '0'}
-            if zbx_event.get('acknowledged', '0') == '1':
-                inc_status = 2
-                for msg in zbx_event['acknowledges']:  # type: dict
-                    author = msg.get('name', '') + ' ' + msg.get('surname', '')
-                    ack_time = (datetime.datetime.fromtimestamp(int(msg['clock']), tz=config.tz).
-                                strftime(config.templates.acknowledgement_time_strftime))
-                    ack_msg = config.templates.acknowledgement.format(
-                        message=msg['message'],
-                        ack_time=ack_time,
-                        author=author
-                    )
-                    if ack_msg not in inc_msg:
-                        inc_msg = ack_msg + inc_msg
-            else:
-                inc_status = 1
-            # TODO: Rewrite it to get current severity from service.
-            # Zabbix 6.0+ fine works with it and allow to change via Dashboard
-            if int(trigger['priority']) >= 4:
-                comp_status = 4
-            elif int(trigger['priority']) == 3:
-                comp_status = 3
-            else:
-                comp_status = 2
 
-            if not inc_msg and config.templates.investigating:
-                zbx_event_clock = int(zbx_event.get('clock', 0))
-                if zbx_event_clock:
-                    zbx_event_time = datetime.datetime.fromtimestamp(zbx_event_clock, tz=config.tz).strftime(
-                        '%b %d, %H:%M')
-                else:
-                    zbx_event_time = ''
-                inc_msg = config.templates.investigating.format(
-                    group=i.cachet_group_name,
-                    component=i.cachet_component_name,
-                    time=zbx_event_time,
-                    trigger_description=trigger.get('comments', ''),
-                    trigger_name=trigger.get('description', ''),
-                )
+def _record_propagation(i: ZabbixCachetMap, service_state: ServiceState,
+                        previous: Union[ServiceFingerprint, None], zapi: Union[Zabbix, 'ZabbixDB'],
+                        state: WatcherState, cachet_seconds: List[float]):
+    """
+    Record latency of Zabbix event which was just written to Cachet.
+    Only changes since the previously delivered state are events, periodic full checks are not.
+    After start nothing was delivered yet: problems are recorded, recoveries are not because their triggers are unknown
+    @param previous: Zabbix side of the previously delivered state
+    @param cachet_seconds: seconds spent by this sync in Cachet reads and writes
+    """
+    confirmed_at = time.time()
+    if previous is not None and (previous.zbx_status, previous.trigger_ids, previous.ack_ids) == (
+            service_state.status, service_state.trigger_ids, service_state.ack_ids):
+        return
+    if service_state.is_ok:
+        if previous is None or not previous.trigger_ids:
+            return
+        event_clock, event = zapi.get_recovery_clock(list(previous.trigger_ids)), 'recovery'
+    else:
+        event_clock, event = service_state.event_clock, service_state.event
+    if not event_clock:
+        return
+    seconds = max(0.0, confirmed_at - event_clock)
+    breakdown = {'poll_wait': max(0.0, service_state.collected_at - event_clock),
+                 'zabbix_fetch': service_state.fetch_seconds,
+                 'cachet_fetch': cachet_seconds[0],
+                 'cachet_write': cachet_seconds[1]}
+    breakdown['queued'] = max(0.0, seconds - sum(breakdown.values()))
+    state.latency.record(Propagation(component=i.cachet_component_name, group=i.cachet_group_name,
+                                     event=event, seconds=seconds, breakdown=breakdown))
 
-            # Just in case when user set investigating template to empty string
-            if not inc_msg and trigger.get('comments'):
-                inc_msg = trigger.get('comments')
-            elif not inc_msg:
-                inc_msg = trigger.get('description')
 
-            if i.cachet_group_name:
-                inc_name = i.cachet_group_name + ' | ' + inc_name
+def _snapshot_component(i: ZabbixCachetMap, service_state: ServiceState,
+                        fingerprint: Union[ServiceFingerprint, None]) -> dict:
+    incident = None
+    if not service_state.is_ok:
+        incident = {'id': int(fingerprint.incident_id) if fingerprint and fingerprint.incident_id else None,
+                    'name': service_state.inc_name,
+                    'status': int(service_state.inc_status),
+                    'message': service_state.inc_msg}
+    return {'id': i.cachet_component_id,
+            'name': i.cachet_component_name,
+            'group': i.cachet_group_name,
+            'status': 1 if service_state.is_ok else service_state.comp_status,
+            'incident': incident}
+
+
+def _sync_priority(i: ZabbixCachetMap, service_state: ServiceState, state: WatcherState) -> int:
+    if service_state.is_ok:
+        return state.priorities.get(i.cachet_component_id, 0)
+    return service_state.priority
 
-            last_inc = cachet.get_incident(i.cachet_component_id)
-            # Incident not registered
-            if last_inc['status'] in ('-1', '4'):
-                cachet.new_incidents(name=inc_name, message=inc_msg, status=inc_status,
-                                     component_id=i.cachet_component_id, component_status=comp_status)
-
-            # Incident already registered
-            elif last_inc['status'] not in ('-1', '4'):
-                # Only incident message can change. So check if this have happened
-                if last_inc['message'].strip() != inc_msg.strip():
-                    cachet.upd_incident(last_inc['id'], message=inc_msg, status=inc_status,
-                                        component_status=comp_status)
-    return True
+
+def _defer(services: List[ZabbixCachetMap], deadline: Deadline, state: WatcherState):
+    """
+    Check services first in the next cycle because the current one is out of budget
+    """
+    state.deferred.extend(i.cachet_component_id for i in services)
+    logging.warning(f'Cycle budget of {deadline.budget}s is exhausted. '
+                    f'{len(services)} services are deferred to the next cycle')
+    STATS.inc('zabbix_cachet_deferred_services_total', len(services),
+              'Services deferred to the next cycle because of cycle budget')
 
 
-def triggers_watcher_worker(service_map, interval, tr_event: threading.Event, zapi: Zabbix, cachet: Cachet):
+def triggers_watcher_worker(handoff: ServiceMapHandoff, interval, zapi: Union[Zabbix, 'ZabbixDB'], cachet: Cachet,
+                            watchdog: Watchdog = None, started: float = None):
     """
     Worker for triggers_watcher. Run it continuously with specific interval
-    @param service_map: list of tuples
+    Service map is taken from handoff before each cycle, so new map is used without restarting the worker
+    @param handoff: ServiceMapHandoff object
     @param interval: interval in seconds
-    @param tr_event: treading.Event object
-    @param zapi: Zabbix object
+    @param zapi: Zabbix object or ZabbixDB to read state of services from Zabbix database
     @param cachet: Cachet object
+    @param watchdog: Watchdog which reports cycles running over settings.cycle_budget
+    @param started: time.monotonic() of process start to report time to the first cycle
     @return:
     """
     logging.info('start trigger watcher')
-    while not tr_event.is_set():
-        logging.info('Check status of Zabbix triggers')
+    config = Config()
+    generation = config.generation
+    state = WatcherState.from_config(config)
+    exporter = None
+    if config.app_settings.get('snapshot_dir'):
+        from zabbix_cachet.snapshot import SnapshotExporter
+        exporter = SnapshotExporter(config.app_settings['snapshot_dir'],
+                                    config.app_settings.get('snapshot_title', 'Status'))
+    while not handoff.stopped:
+        if config.generation != generation:
+            generation = config.generation
+            state.apply_config(config)
+            interval = config.app_settings['update_inc_interval']
+        map_version, service_map = handoff.snapshot()
+        if not map_version:
+            # Worker is started before the first sync. Wait for its first partial map
+            handoff.wait(interval, seen_version=map_version)
+            continue
+        logging.info(f'Check status of Zabbix triggers (service map v{map_version})')
+        deadline = Deadline(config.app_settings.get('cycle_budget') or interval)
+        if watchdog:
+            watchdog.watch('triggers_watcher', deadline)
+        PROFILER.cycle_start()
         # Do not run if Zabbix is not available
         if zapi.get_version():
             try:
-                triggers_watcher(service_map, zapi=zapi, cachet=cachet)
+                triggers_watcher(service_map, zapi=zapi, cachet=cachet, state=state, deadline=deadline)
+                if exporter:
+                    exporter.export(list(state.components.values()))
             except Exception as e:
                 logging.error('triggers_watcher() raised an Exception. Something gone wrong')
                 logging.error(e, exc_info=True)
         else:
             logging.error('Zabbix is not available. Skip checking...')
-        time.sleep(interval)
+        PROFILER.cycle_end()
+        if watchdog:
+            watchdog.done('triggers_watcher')
+        if started is not None:
+            time_to_first_cycle = time.monotonic() - started
+            started = None
+            logging.info(f'The first cycle of trigger watcher finished {time_to_first_cycle:.1f}s after start')
+            STATS.set('zabbix_cachet_time_to_first_cycle_seconds', time_to_first_cycle,
+                      'Seconds from start to the end of the first trigger watcher cycle')
+        # Wake up earlier if service map was changed during the cycle or sleep
+        handoff.wait(interval, seen_version=map_version)
     logging.info('end trigger watcher')
 
 
-def init_cachet(services: List[ZabbixService], zapi: Zabbix, cachet: Cachet) -> List[ZabbixCachetMap]:
+def init_cachet(services: List[ZabbixService], zapi: Zabbix, cachet: Cachet,
+                deadline: Deadline = None) -> List[ZabbixCachetMap]:
     """
     Init Cachet by syncing Zabbix service to it
     Also func create mapping batten Cachet components and Zabbix IT services
     :param services: list of ZabbixService
     :param cachet: Cachet object
     :param zapi: Zabbix object
+    :param deadline: stop syncing when it expires. Check deadline.expired to find out if map is partial
     @return: list of tuples
     """
     # Zabbix Triggers to Cachet components id map
     data = []
 
-    for zbx_service in services:
+    for n, zbx_service in enumerate(services):
+        if deadline and deadline.expired:
+            logging.warning(f'Sync budget of {deadline.budget}s is exhausted. '
+                            f'{len(services) - n} services will be synced next time')
+            break
         zbx_triggerid = None
         cachet_group_id = None
         cachet_group_name = ''
@@ -301,7 +831,8 @@ def init_cachet(services: List[ZabbixService], zapi: Zabbix, cachet: Cachet) ->
                     cachet_group_name=cachet_group_name,
                     cachet_component_id=component['id'],
                     cachet_component_name=component['name'],
-                    zbx_triggerid=dependency.triggerid
+                    zbx_triggerid=dependency.triggerid,
+                    zbx_group_serviceid=zbx_service.serviceid,
                 )
                 data.append(zxb2cachet_i)
         else:
@@ -333,6 +864,218 @@ def init_cachet(services: List[ZabbixService], zapi: Zabbix, cachet: Cachet) ->
     return data
 
 
+def bootstrap_cachet(handoff: ServiceMapHandoff, zapi: Zabbix, cachet: Cachet, root_name: str,
+                     deadline: Deadline = None, publish_interval: float = 5) -> List[ZabbixCachetMap]:
+    """
+    The first sync of Zabbix services with Cachet. Top level services are read and synced one by one
+    and partial map is handed over to triggers_watcher at most every publish_interval seconds,
+    so watching starts before the whole tree is read
+    :param root_name: settings.root_service
+    :param deadline: stop syncing when it expires, like init_cachet() does
+    :param publish_interval: seconds between handovers of partial map
+    @return: list of ZabbixCachetMap
+    """
+    service_map = []
+    last_publish = None
+    for zbx_service in zapi.iter_itservices(root_name):
+        if deadline and deadline.expired:
+            logging.warning(f'Sync budget of {deadline.budget}s is exhausted. '
+                            f'The rest of services will be synced next time')
+            break
+        service_map.extend(init_cachet([zbx_service], zapi, cachet))
+        if service_map and (last_publish is None or time.monotonic() - last_publish >= publish_interval):
+            map_version = handoff.publish(service_map)
+            last_publish = time.monotonic()
+            logging.info(f'Partial service map v{map_version} of {len(service_map)} components '
+                         f'was handed over to triggers_watcher worker')
+    return service_map
+
+
+def connect_backends(config: Config) -> Tuple[Zabbix, Cachet, Union[Zabbix, 'ZabbixDB']]:
+    """
+    Connect to Zabbix, Cachet and Zabbix database (if configured) in parallel,
+    so bootstrap takes as long as the slowest backend instead of all of them in a row
+    @return: Zabbix, Cachet and Zabbix object or ZabbixDB for triggers_watcher
+    """
+    def connect_zabbix():
+        return Zabbix(config.zabbix_config['server'], config.zabbix_config['user'], config.zabbix_config['pass'],
+                      config.zabbix_config['https-verify'],
+                      breaker=CircuitBreaker('Zabbix', **config.zabbix_config.get('circuit_breaker', {})),
+                      timeout=timeout_from_config(config.zabbix_config),
+                      limiter=AdaptiveLimiter.from_config('Zabbix', config.zabbix_config.get('concurrency')))
+
+    def connect_cachet():
+        return Cachet(config.cachet_config['server'], config.cachet_config['token'],
+                      config.cachet_config['https-verify'],
+                      timeout=timeout_from_config(config.cachet_config),
+                      per_page=config.cachet_config.get('per_page', 1000),
+                      page_workers=config.cachet_config.get('page_workers', 4),
+                      incident_updates=config.cachet_config.get('incident_updates', False),
+                      incident_record_ttl=config.cachet_config.get('incident_record_ttl', 600),
+                      breaker=CircuitBreaker('Cachet', **config.cachet_config.get('circuit_breaker', {})),
+                      limiter=AdaptiveLimiter.from_config('Cachet', config.cachet_config.get('concurrency')))
+
+    def connect_zabbix_db():
+        from zabbix_cachet.zabbix_db import ZabbixDB
+        return ZabbixDB.from_config(
+            config.zabbix_config['db'],
+            breaker=CircuitBreaker('Zabbix DB', **config.zabbix_config.get('circuit_breaker', {})))
+
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix='Connect') as pool:
+        zapi_future = pool.submit(connect_zabbix)
+        cachet_future = pool.submit(connect_cachet)
+        db_future = pool.submit(connect_zabbix_db) if config.zabbix_config.get('db') else None
+        zapi, cachet = zapi_future.result(), cachet_future.result()
+        watcher_zapi = db_future.result() if db_future else zapi
+    logging.info('Zabbix ver: {}. Cachet ver: {}'.format(zapi.version, cachet.version))
+    if watcher_zapi is not zapi:
+        logging.info(f'Read state of services from Zabbix {watcher_zapi.version} database')
+    return zapi, cachet, watcher_zapi
+
+
+def resync_services(changed: Set[str], service_map: List[ZabbixCachetMap], zapi: Zabbix,
+                    cachet: Cachet) -> List[ZabbixCachetMap]:
+    """
+    Sync to Cachet only children of root service which contain changed services
+    :param changed: ids of changed Zabbix services
+    :param service_map: current list of ZabbixCachetMap
+    @return: new list of ZabbixCachetMap
+    """
+    known = {}
+    for i in service_map:
+        known[i.zbx_serviceid] = i.zbx_top_serviceid
+        if i.zbx_group_serviceid:
+            known[i.zbx_group_serviceid] = i.zbx_group_serviceid
+    tops = {known[serviceid] for serviceid in changed if serviceid in known}
+    unknown = [serviceid for serviceid in changed if serviceid not in known]
+    parents = zapi.get_service_parents(unknown) if unknown else {}
+    if parents is None:
+        return service_map
+    # New services are either children of root or children of its children
+    grandparents = {}
+    if parents:
+        grandparents = zapi.get_service_parents(sorted({p for ids in parents.values() for p in ids})) or {}
+    for serviceid, parent_ids in parents.items():
+        if _is_top(parent_ids, zapi.root_serviceid):
+            tops.add(serviceid)
+        tops.update(p for p in parent_ids if _is_top(grandparents.get(p, ['']), zapi.root_serviceid))
+    if not tops:
+        return service_map
+    # Changed service could be moved away from root or deleted
+    top_parents = zapi.get_service_parents(sorted(tops))
+    if top_parents is None:
+        return service_map
+    logging.info(f'Resync {len(tops)} changed Zabbix services with Cachet')
+    new_map = [i for i in service_map if i.zbx_top_serviceid not in tops]
+    for serviceid in sorted(tops):
+        if not _is_top(top_parents.get(serviceid, ['']), zapi.root_serviceid):
+            continue
+        try:
+            service = zapi.get_zabbix_service(serviceid)
+        except ZabbixServiceNotFound:
+            continue
+        new_map.extend(init_cachet([service], zapi, cachet))
+    return new_map
+
+
+def watch_service_changes(handoff: ServiceMapHandoff, detector: ServiceChangeDetector, interval, timeout,
+                          service_map: List[ZabbixCachetMap], zapi: Zabbix, cachet: Cachet,
+                          root_name: str = None,
+                          timeout_setting: str = 'update_comp_interval') -> List[ZabbixCachetMap]:
+    """
+    Till the next full sync poll Zabbix for changed services and resync only them.
+    After config reload polls and the next full sync are rescheduled with new intervals
+    and change of settings.root_service syncs only added and removed top level services
+    :param interval: seconds between polls. 0 - just wait for the next full sync
+    :param timeout: seconds till the next full sync
+    :param root_name: settings.root_service which service_map was synced from
+    :param timeout_setting: setting which timeout is taken from after config reload
+    @return: the latest service map
+    """
+    config = Config()
+    generation = config.generation
+    started = time.monotonic()
+    next_sync = started + timeout
+    while not handoff.stopped:
+        remaining = next_sync - time.monotonic()
+        if remaining <= 0:
+            break
+        handoff.wait(min(interval, remaining) if interval else remaining)
+        if config.generation != generation:
+            generation = config.generation
+            interval = config.app_settings.get('discovery_interval', 60)
+            next_sync = started + config.app_settings[timeout_setting]
+            if root_name is not None and config.app_settings['root_service'] != root_name:
+                try:
+                    new_map = switch_root(config.app_settings['root_service'], service_map, zapi, cachet)
+                except ZabbixCachetException as err:
+                    logging.error(f'Failed to switch root service: {err}. Keep watching the previous root')
+                    new_map = None
+                if new_map is not None:
+                    root_name = config.app_settings['root_service']
+                    detector.reset()
+                    if new_map != service_map:
+                        service_map = new_map
+                        map_version = handoff.publish(service_map)
+                        logging.info(f'Service map v{map_version} was handed over to triggers_watcher worker')
+            continue
+        if not interval or time.monotonic() >= next_sync:
+            continue
+        changed = detector.poll()
+        if not changed:
+            continue
+        logging.debug(f'Zabbix services {sorted(changed)} were changed')
+        try:
+            new_map = resync_services(changed, service_map, zapi, cachet)
+        except ZabbixCachetException as err:
+            logging.error(f'Failed to resync changed services: {err}')
+            continue
+        if new_map != service_map:
+            service_map = new_map
+            map_version = handoff.publish(service_map)
+            logging.info(f'Service map v{map_version} was handed over to triggers_watcher worker')
+    return service_map
+
+
+def switch_root(root_name: str, service_map: List[ZabbixCachetMap], zapi: Zabbix,
+                cachet: Cachet) -> Union[List[ZabbixCachetMap], None]:
+    """
+    Sync only top level services which were added or removed by change of settings.root_service.
+    Components of services which are under both roots keep their mapping
+    :param root_name: new settings.root_service
+    @return: new list of ZabbixCachetMap or None if new root was not found or Zabbix failed.
+             Raises ZabbixCachetException if Cachet failed
+    """
+    root_service = zapi.get_service(root_name)
+    if len(root_service) != 1:
+        logging.error(f'Can not find uniq "{root_name}" service in Zabbix. Keep watching the previous root')
+        return None
+    top_ids = zapi.get_child_ids(root_service[0]['serviceid'])
+    if top_ids is None:
+        logging.error(f'Failed to read children of "{root_name}" service. Keep watching the previous root')
+        return None
+    new_map = [i for i in service_map if i.zbx_top_serviceid in top_ids]
+    kept = {i.zbx_top_serviceid for i in new_map}
+    removed = {i.zbx_top_serviceid for i in service_map} - top_ids
+    added = sorted(top_ids - kept)
+    logging.info(f'Root service is changed to {root_name}: sync {len(added)} added top level services, '
+                 f'stop watching {len(removed)} removed ones')
+    for serviceid in added:
+        try:
+            service = zapi.get_zabbix_service(serviceid)
+        except ZabbixServiceNotFound:
+            continue
+        new_map.extend(init_cachet([service], zapi, cachet))
+    zapi.root_serviceid = root_service[0]['serviceid']
+    return new_map
+
+
+def _is_top(parent_ids: List[str], root_serviceid: Union[str, None]) -> bool:
+    if root_serviceid:
+        return root_serviceid in parent_ids
+    return not parent_ids
+
+
 def read_config(config_f):
     """
     Read config file
@@ -347,6 +1090,7 @@ def read_config(config_f):
 
 
 def main():
+    started = time.monotonic()
     exit_status = 0
     config = Config()
 
@@ -361,27 +1105,76 @@ def main():
     logging.getLogger("requests").setLevel(log_level_requests)
     logging.info(f'Zabbix Cachet v.{__version__} started (config: {config.config_file})')
     inc_update_t = threading.Thread()
-    event = threading.Event()
+    handoff = ServiceMapHandoff()
+    watchdog = Watchdog(metrics_file=config.app_settings.get('metrics_file'))
+    watchdog.start()
+    metrics_forwarder = None
+    maintenance_sync = None
+    PROFILER.configure(output_dir=config.app_settings.get('profile_dir'))
+    if hasattr(signal, 'SIGUSR1'):
+        # kill -USR1 <pid> profiles the next cycles of trigger watcher
+        signal.signal(signal.SIGUSR1, PROFILER.signal_handler(config.app_settings.get('profile_cycles', 3)))
+    config_watcher = ConfigWatcher(config, handoff, config.app_settings.get('config_poll_interval', 10))
+    if hasattr(signal, 'SIGHUP'):
+        # kill -HUP <pid> reloads config file
+        signal.signal(signal.SIGHUP, config_watcher.signal_handler)
+    config_watcher.start()
     try:
-        zapi = Zabbix(config.zabbix_config['server'], config.zabbix_config['user'], config.zabbix_config['pass'],
-                      config.zabbix_config['https-verify'])
-        cachet = Cachet(config.cachet_config['server'], config.cachet_config['token'],
-                        config.cachet_config['https-verify'])
-        logging.info('Zabbix ver: {}. Cachet ver: {}'.format(zapi.version, cachet.version))
+        zapi, cachet, watcher_zapi = connect_backends(config)
+        if config.metrics_config.get('items'):
+            from zabbix_cachet.metrics import MetricsForwarder
+            metrics_forwarder = MetricsForwarder.from_config(config.metrics_config, zapi, cachet)
+            metrics_forwarder.start(config.metrics_config.get('interval', 60))
+        if config.maintenance_config.get('enabled'):
+            from zabbix_cachet.maintenance import MaintenanceSync
+            maintenance_sync = MaintenanceSync.from_config(config.maintenance_config, zapi, cachet, config.tz)
+            maintenance_sync.start(handoff, config.maintenance_config.get('interval', 300))
         zbxtr2cachet = ''
+        detector = ServiceChangeDetector(zapi)
         while True:
+            discovery_interval = config.app_settings.get('discovery_interval', 60)
+            root_name = config.app_settings['root_service']
+            sync_deadline = Deadline(config.app_settings.get('sync_budget') or
+                                     config.app_settings['update_comp_interval'])
+            watchdog.watch('sync', sync_deadline)
+            if not inc_update_t.is_alive():
+                # Started before the first sync, it watches partial maps while the sync goes on
+                inc_update_t = threading.Thread(name='Trigger Watcher',
+                                                target=triggers_watcher_worker,
+                                                args=(handoff, config.app_settings['update_inc_interval'],
+                                                      watcher_zapi, cachet, watchdog, started))
+                inc_update_t.daemon = True
+                inc_update_t.start()
+                started = None
             try:
-                logging.debug('Getting list of Zabbix IT Services ...')
-                it_services = zapi.get_itservices(config.app_settings['root_service'])
-                logging.debug('Zabbix IT Services: {}'.format(it_services))
-                # Create Cachet components and components groups
-                logging.debug('Syncing Zabbix with Cachet...')
-                zbxtr2cachet_new = init_cachet(it_services, zapi, cachet)
+                if discovery_interval:
+                    detector.reset()
+                if not zbxtr2cachet:
+                    logging.debug('Syncing Zabbix with Cachet service by service...')
+                    zbxtr2cachet_new = bootstrap_cachet(handoff, zapi, cachet, root_name,
+                                                        deadline=sync_deadline,
+                                                        publish_interval=config.app_settings['update_inc_interval'])
+                else:
+                    logging.debug('Getting list of Zabbix IT Services ...')
+                    it_services = zapi.get_itservices(root_name)
+                    logging.debug('Zabbix IT Services: {}'.format(it_services))
+                    # Create Cachet components and components groups
+                    logging.debug('Syncing Zabbix with Cachet...')
+                    zbxtr2cachet_new = init_cachet(it_services, zapi, cachet, deadline=sync_deadline)
             except ZabbixNotAvailable:
-                time.sleep(config.app_settings['update_comp_interval'])
+                watchdog.done('sync')
+                handoff.wait(config.app_settings['update_comp_interval'])
                 continue
             except ZabbixCachetException:
                 zbxtr2cachet_new = False
+            watchdog.done('sync')
+            sync_interval_setting = 'update_comp_interval'
+            if zbxtr2cachet_new and sync_deadline.expired:
+                # Keep watching components which were not reached by partial sync and finish it sooner
+                synced_ids = {i.cachet_component_id for i in zbxtr2cachet_new}
+                zbxtr2cachet_new = zbxtr2cachet_new + [i for i in zbxtr2cachet or []
+                                                       if i.cachet_component_id not in synced_ids]
+                sync_interval_setting = 'update_inc_interval'
             if not zbxtr2cachet_new:
                 logging.error('Sorry, can not create Zabbix <> Cachet mapping for you. Please check above errors')
                 # Exit if it's an initial run
@@ -391,29 +1184,26 @@ def main():
                     zbxtr2cachet_new = zbxtr2cachet
             else:
                 logging.info('Successfully synced Cachet components with Zabbix Services')
-            # Restart triggers_watcher_worker
+            # Hand over new map to triggers_watcher_worker
             if zbxtr2cachet != zbxtr2cachet_new:
                 zbxtr2cachet = zbxtr2cachet_new
-                logging.info('Restart triggers_watcher worker')
-                # TODO: Could failed
+                map_version = handoff.publish(zbxtr2cachet)
+                logging.info(f'Service map v{map_version} was handed over to triggers_watcher worker')
                 logging.debug(f'List of watching triggers {zbxtr2cachet}')
-                event.set()
-                # Wait until tread die
-                while inc_update_t.is_alive():
-                    time.sleep(1)
-                event.clear()
-                inc_update_t = threading.Thread(name='Trigger Watcher',
-                                                target=triggers_watcher_worker,
-                                                args=(zbxtr2cachet, config.app_settings['update_inc_interval'], event,
-                                                      zapi, cachet))
-                inc_update_t.daemon = True
-                inc_update_t.start()
-            time.sleep(config.app_settings['update_comp_interval'])
-    except requests.exceptions.ConnectionError as err:
+            zbxtr2cachet = watch_service_changes(handoff, detector, discovery_interval,
+                                                 config.app_settings[sync_interval_setting], zbxtr2cachet, zapi,
+                                                 cachet, root_name=root_name,
+                                                 timeout_setting=sync_interval_setting)
+    except (requests.exceptions.ConnectionError, CachetNotAvailable) as err:
         logging.error(f"Failed to connect: {err}")
         exit_status = 1
     except KeyboardInterrupt:
-        event.set()
+        handoff.stop()
+        watchdog.stop()
+        if metrics_forwarder:
+            metrics_forwarder.stop()
+        if maintenance_sync:
+            maintenance_sync.stop()
         logging.info('Shutdown requested. See you.')
     except Exception as error:
         logging.exception(error)
@@ -0,0 +1,228 @@
+"""
+Sync of Zabbix maintenance windows of hosts behind mapped services to Cachet scheduled maintenances (Cachet 2.4+).
+Cachet schedule id and fingerprint of every synced window are kept in a state file,
+so each pass only creates, updates or deletes schedules which have changed. Cachet schedules are never listed.
+Only one time periods of maintenance are synced. Recurring (daily, weekly, monthly) periods are skipped.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Set, Tuple
+
+from zabbix_cachet import codec
+from zabbix_cachet.cachet import Cachet
+from zabbix_cachet.excepltions import CachetApiException, CachetNotAvailable
+from zabbix_cachet.service_map import ServiceMapHandoff
+from zabbix_cachet.zabbix import Zabbix
+
+# Cachet schedule statuses
+SCHEDULE_UPCOMING = 0
+SCHEDULE_IN_PROGRESS = 1
+SCHEDULE_COMPLETE = 2
+# Zabbix time period types
+TIMEPERIOD_ONE_TIME = 0
+# Format of scheduled_at and completed_at which Cachet accepts
+CACHET_TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+
+def maintenance_windows(maintenance: dict) -> List[Tuple[str, int, int]]:
+    """
+    One time windows of Zabbix maintenance limited by its active period
+    @return: list of (key, start, end) in unix time. Key is unique among all maintenances
+    """
+    active_since = int(maintenance['active_since'])
+    active_till = int(maintenance['active_till'])
+    windows = []
+    for period in maintenance['timeperiods']:
+        if int(period['timeperiod_type']) != TIMEPERIOD_ONE_TIME:
+            continue
+        start = max(int(period['start_date']), active_since)
+        end = min(int(period['start_date']) + int(period['period']), active_till)
+        if start < end:
+            windows.append((f"{maintenance['maintenanceid']}:{period['start_date']}", start, end))
+    return windows
+
+
+class MaintenanceSync:
+    def __init__(self, zapi: Zabbix, cachet: Cachet, state_file: str = None, tz: datetime.tzinfo = None,
+                 clock: Callable[[], float] = time.time):
+        """
+        @param zapi: Zabbix object
+        @param cachet: Cachet object
+        @param state_file: JSON file where ids and fingerprints of synced schedules are kept between restarts.
+                           Without it all schedules are created again after restart
+        @param tz: time zone of Cachet times. Local time zone if None
+        @param clock: current unix time
+        """
+        self.zapi = zapi
+        self.cachet = cachet
+        self.state_file = state_file
+        self.tz = tz
+        self.clock = clock
+        # window key -> {'schedule_id': ..., 'fingerprint': ...}
+        self.records: Dict[str, dict] = self._load()
+        # component name -> (host ids, host group ids) of the service map version
+        self._hosts: Dict[str, Tuple[Set[str], Set[str]]] = {}
+        self._map_version = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, maintenance_config: dict, zapi: Zabbix, cachet: Cachet,
+                    tz: datetime.tzinfo = None) -> 'MaintenanceSync':
+        return cls(zapi, cachet, state_file=maintenance_config.get('state_file'), tz=tz)
+
+    def _load(self) -> Dict[str, dict]:
+        if not self.state_file:
+            return {}
+        try:
+            with open(self.state_file, 'rb') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            logging.error(f'Failed to read maintenance state from {self.state_file}: {err}. '
+                          f'Schedules will be created again')
+            return {}
+
+    def _save(self):
+        if not self.state_file:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.zabbix-cachet-maintenance')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(codec.dumps(self.records))
+            os.replace(tmp_path, self.state_file)
+        except OSError as err:
+            os.unlink(tmp_path)
+            logging.error(f'Failed to write maintenance state to {self.state_file}: {err}')
+
+    def refresh_hosts(self, map_version: int, service_map: List) -> bool:
+        """
+        Read hosts behind mapped services once per version of service map
+        @param service_map: list of ZabbixCachetMap
+        @return: False if Zabbix failed
+        """
+        if map_version == self._map_version:
+            return True
+        service_hosts = self.zapi.get_service_hosts([i.zbx_serviceid for i in service_map])
+        if service_hosts is None:
+            return False
+        self._hosts = {}
+        for i in service_map:
+            if i.zbx_serviceid in service_hosts:
+                hosts, groups = self._hosts.setdefault(i.cachet_component_name, (set(), set()))
+                hosts.update(service_hosts[i.zbx_serviceid][0])
+                groups.update(service_hosts[i.zbx_serviceid][1])
+        self._map_version = map_version
+        return True
+
+    def _format_time(self, clock: int) -> str:
+        return datetime.datetime.fromtimestamp(clock, tz=self.tz).strftime(CACHET_TIME_FORMAT)
+
+    def desired(self, maintenances: List[dict]) -> Dict[str, dict]:
+        """
+        Cachet schedules of maintenance windows which affect mapped components
+        @return: window key -> schedule params
+        """
+        now = self.clock()
+        schedules = {}
+        for maintenance in maintenances:
+            hostids = {host['hostid'] for host in maintenance['hosts']}
+            groupids = {group['groupid'] for group in maintenance['groups']}
+            components = sorted(name for name, (hosts, groups) in self._hosts.items()
+                                if hosts & hostids or groups & groupids)
+            if not components:
+                continue
+            message = maintenance.get('description', '').strip()
+            message = (message + '\n\n' if message else '') + 'Affected components: ' + ', '.join(components)
+            for key, start, end in maintenance_windows(maintenance):
+                if now < start:
+                    status = SCHEDULE_UPCOMING
+                elif now < end:
+                    status = SCHEDULE_IN_PROGRESS
+                else:
+                    status = SCHEDULE_COMPLETE
+                schedules[key] = {'name': maintenance['name'], 'message': message, 'status': status,
+                                  'scheduled_at': self._format_time(start), 'completed_at': self._format_time(end)}
+        return schedules
+
+    def sync(self, map_version: int, service_map: List) -> bool:
+        """
+        Create, update or delete Cachet schedules whose maintenance windows have changed since the last pass
+        @return: False if Zabbix or Cachet failed
+        """
+        if not self.refresh_hosts(map_version, service_map):
+            return False
+        hostids = sorted({hostid for hosts, _ in self._hosts.values() for hostid in hosts})
+        groupids = sorted({groupid for _, groups in self._hosts.values() for groupid in groups})
+        maintenances = self.zapi.get_maintenances(hostids, groupids) if hostids or groupids else []
+        if maintenances is None:
+            return False
+        schedules = self.desired(maintenances)
+        changes = 0
+        try:
+            for key in sorted(set(self.records) - set(schedules)):
+                try:
+                    self.cachet.del_schedule(self.records[key]['schedule_id'])
+                except CachetNotAvailable:
+                    raise
+                except CachetApiException as err:
+                    # Already deleted in Cachet
+                    logging.warning(f'{err}. Forget it')
+                del self.records[key]
+                changes += 1
+            for key, params in sorted(schedules.items()):
+                fingerprint = hashlib.sha1(codec.dumps(params)).hexdigest()
+                record = self.records.get(key)
+                if record and record['fingerprint'] == fingerprint:
+                    continue
+                schedule = None
+                if record:
+                    try:
+                        schedule = self.cachet.upd_schedule(record['schedule_id'], **params)
+                    except CachetNotAvailable:
+                        raise
+                    except CachetApiException as err:
+                        logging.warning(f'{err}. Create it again')
+                if schedule is None:
+                    schedule = self.cachet.new_schedule(**params)
+                self.records[key] = {'schedule_id': schedule['id'], 'fingerprint': fingerprint}
+                changes += 1
+        except CachetApiException as err:
+            logging.error(f'Failed to sync maintenances to Cachet: {err}')
+            return False
+        finally:
+            if changes:
+                self._save()
+        logging.info(f'Synced {len(schedules)} maintenance windows with Cachet schedules, {changes} changed')
+        return True
+
+    def _run(self, handoff: ServiceMapHandoff, interval: float):
+        while not self._stop.is_set() and not handoff.stopped:
+            map_version, service_map = handoff.snapshot()
+            if map_version:
+                try:
+                    self.sync(map_version, service_map)
+                except Exception as e:
+                    logging.error('Maintenance sync raised an Exception. Something gone wrong')
+                    logging.error(e, exc_info=True)
+            self._stop.wait(interval)
+
+    def start(self, handoff: ServiceMapHandoff, interval: float):
+        """
+        Sync maintenances of services of the current service map every interval seconds
+        """
+        logging.info(f'Sync Zabbix maintenances to Cachet schedules every {interval}s')
+        self._thread = threading.Thread(name='Maintenance Sync', target=self._run, args=(handoff, interval),
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,246 @@
+"""
+Forward values of Zabbix items to Cachet metrics.
+Reader reads history of all configured items in bulk since high-water mark of each metric,
+downsamples it to resolution of the metric and puts points to a bounded queue.
+Sender takes points from the queue in batches and posts them to Cachet.
+When Cachet is slow or down the queue fills up and reader stops moving high-water marks,
+so points are read again later instead of piling up in memory.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+from zabbix_cachet.cachet import Cachet
+from zabbix_cachet.excepltions import CachetApiException, CachetNotAvailable, InvalidConfig
+from zabbix_cachet.stats import STATS
+from zabbix_cachet.zabbix import Zabbix
+
+AGGREGATIONS = {
+    'avg': lambda values: sum(values) / len(values),
+    'min': min,
+    'max': max,
+    'sum': sum,
+    'last': lambda values: values[-1],
+}
+# Zabbix value types which can be sent to Cachet: numeric float and numeric unsigned
+NUMERIC_VALUE_TYPES = (0, 3)
+
+
+@dataclass(frozen=True)
+class MetricMap:
+    itemid: str
+    metric_id: int
+    # Seconds. Values of item are aggregated to one point per resolution
+    resolution: int = 60
+    aggregation: str = 'avg'
+
+    @classmethod
+    def from_config(cls, item: dict) -> 'MetricMap':
+        try:
+            metric = cls(itemid=str(item['itemid']), metric_id=int(item['metric_id']),
+                         resolution=int(item.get('resolution', 60)), aggregation=item.get('aggregation', 'avg'))
+        except (KeyError, TypeError, ValueError) as err:
+            raise InvalidConfig(f'Invalid metric {item}: {err!r}')
+        if metric.resolution <= 0:
+            raise InvalidConfig(f'Resolution of metric {item} must be positive')
+        if metric.aggregation not in AGGREGATIONS:
+            raise InvalidConfig(f'Unknown aggregation of metric {item}. Use one of {", ".join(AGGREGATIONS)}')
+        return metric
+
+
+@dataclass(frozen=True)
+class MetricPoint:
+    metric_id: int
+    timestamp: int
+    value: float
+
+
+def downsample(history: Iterable[dict], resolution: int, aggregation: str, until: int) -> List[Tuple[int, float]]:
+    """
+    Aggregate values of one item to buckets of resolution seconds.
+    Only buckets which have ended by until are returned, the current one is still filling up
+    @param history: history records sorted by clock
+    @return: list of (bucket start, aggregated value)
+    """
+    buckets: Dict[int, List[float]] = {}
+    for record in history:
+        clock = int(record['clock'])
+        bucket = clock - clock % resolution
+        if bucket + resolution > until:
+            continue
+        buckets.setdefault(bucket, []).append(float(record['value']))
+    aggregate = AGGREGATIONS[aggregation]
+    return [(bucket, aggregate(values)) for bucket, values in sorted(buckets.items())]
+
+
+class MetricsForwarder:
+    def __init__(self, metrics: List[MetricMap], zapi: Zabbix, cachet: Cachet, queue_size: int = 10000,
+                 batch_size: int = 100, workers: int = 2, enqueue_timeout: float = 1, retry_interval: float = 5):
+        """
+        @param metrics: list of MetricMap
+        @param queue_size: max points waiting to be sent
+        @param batch_size: points taken from queue at once
+        @param workers: parallel requests to Cachet while a batch is sent
+        @param enqueue_timeout: seconds reader waits for free place in full queue
+        @param retry_interval: seconds between attempts to send batch while Cachet is not available
+        """
+        self.metrics = metrics
+        self.zapi = zapi
+        self.cachet = cachet
+        self.queue: 'queue.Queue[MetricPoint]' = queue.Queue(maxsize=queue_size)
+        self.batch_size = max(1, int(batch_size))
+        self.workers = max(1, int(workers))
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_interval = retry_interval
+        # Metric -> unix time up to which its history was put to the queue
+        self.high_water: Dict[MetricMap, int] = {}
+        self.value_types: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    @classmethod
+    def from_config(cls, metrics_config: dict, zapi: Zabbix, cachet: Cachet) -> 'MetricsForwarder':
+        metrics = [MetricMap.from_config(item) for item in metrics_config.get('items') or []]
+        return cls(metrics, zapi, cachet,
+                   queue_size=metrics_config.get('queue_size', 10000),
+                   batch_size=metrics_config.get('batch_size', 100),
+                   workers=metrics_config.get('workers', 2))
+
+    def _load_value_types(self):
+        """
+        history.get needs value type of items. Read it once for new items
+        """
+        missing = sorted({metric.itemid for metric in self.metrics} - set(self.value_types))
+        if not missing:
+            return
+        for item in self.zapi.get_items(missing):
+            value_type = int(item['value_type'])
+            if value_type not in NUMERIC_VALUE_TYPES:
+                logging.error(f"Zabbix item {item['itemid']} is not numeric. It can not be sent to Cachet metric")
+                self.metrics = [metric for metric in self.metrics if metric.itemid != item['itemid']]
+                continue
+            self.value_types[item['itemid']] = value_type
+
+    def collect(self, now: int = None) -> int:
+        """
+        Read new history of all items and put downsampled points to the queue
+        @param now: unix time
+        @return: number of enqueued points
+        """
+        now = int(now or time.time())
+        self._load_value_types()
+        by_type: Dict[int, List[MetricMap]] = {}
+        for metric in self.metrics:
+            if metric.itemid not in self.value_types:
+                continue
+            # Start with the last full bucket
+            self.high_water.setdefault(metric, now - now % metric.resolution - metric.resolution)
+            by_type.setdefault(self.value_types[metric.itemid], []).append(metric)
+        enqueued = 0
+        for value_type, metrics in by_type.items():
+            itemids = sorted({metric.itemid for metric in metrics})
+            history = self.zapi.get_history(itemids, value_type,
+                                            time_from=min(self.high_water[metric] for metric in metrics),
+                                            time_till=now)
+            if history is None:
+                # Zabbix failed, the same history will be read next time
+                continue
+            item_history: Dict[str, List[dict]] = {}
+            for record in history:
+                item_history.setdefault(str(record['itemid']), []).append(record)
+            for metric in metrics:
+                records = [record for record in item_history.get(metric.itemid, [])
+                           if int(record['clock']) >= self.high_water[metric]]
+                for bucket, value in downsample(records, metric.resolution, metric.aggregation, now):
+                    try:
+                        self.queue.put(MetricPoint(metric.metric_id, bucket, value), timeout=self.enqueue_timeout)
+                    except queue.Full:
+                        logging.warning(f'Metrics queue is full ({self.queue.maxsize} points). '
+                                        f'Postpone reading of Zabbix history')
+                        STATS.inc('zabbix_cachet_metric_queue_full_total', 1,
+                                  'Times reader of Zabbix history waited for Cachet')
+                        return enqueued
+                    self.high_water[metric] = bucket + metric.resolution
+                    enqueued += 1
+                # Nothing more can appear in buckets which have ended
+                self.high_water[metric] = max(self.high_water[metric], now - now % metric.resolution)
+        STATS.set('zabbix_cachet_metric_queue_size', self.queue.qsize(), 'Points waiting to be sent to Cachet')
+        logging.debug(f'{enqueued} metric points were queued')
+        return enqueued
+
+    def _next_batch(self, timeout: float = 1) -> List[MetricPoint]:
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def send_batch(self, pool: ThreadPoolExecutor, batch: List[MetricPoint]):
+        """
+        Post batch of points. While Cachet is not available the batch is held and retried,
+        so the queue fills up and reader is slowed down
+        """
+        pending = batch
+        while pending and not self._stop.is_set():
+            if not self.cachet.breaker.allow():
+                self._stop.wait(self.retry_interval)
+                continue
+            futures = [(point, pool.submit(self.cachet.new_metric_point, point.metric_id, point.value,
+                                           point.timestamp)) for point in pending]
+            failed = []
+            rejected = 0
+            for point, future in futures:
+                try:
+                    future.result()
+                except CachetNotAvailable:
+                    failed.append(point)
+                except CachetApiException as err:
+                    logging.error(f'Cachet rejected {point}: {err}')
+                    rejected += 1
+            STATS.inc('zabbix_cachet_metric_points_dropped_total', rejected, 'Points rejected by Cachet')
+            STATS.inc('zabbix_cachet_metric_points_sent_total', len(pending) - len(failed) - rejected,
+                      'Points sent to Cachet metrics')
+            pending = failed
+            if pending:
+                self._stop.wait(self.retry_interval)
+
+    def _reader(self, interval: float):
+        while not self._stop.is_set():
+            try:
+                self.collect()
+            except Exception as e:
+                logging.error('Reading of Zabbix history raised an Exception. Something gone wrong')
+                logging.error(e, exc_info=True)
+            self._stop.wait(interval)
+
+    def _sender(self):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Cachet Metrics') as pool:
+            while not self._stop.is_set():
+                batch = self._next_batch()
+                if batch:
+                    self.send_batch(pool, batch)
+
+    def start(self, interval: float):
+        """
+        Start reader and sender threads
+        @param interval: seconds between reads of Zabbix history
+        """
+        logging.info(f'Forward {len(self.metrics)} Zabbix items to Cachet metrics every {interval}s')
+        self._threads = [
+            threading.Thread(name='Metrics Reader', target=self._reader, args=(interval,), daemon=True),
+            threading.Thread(name='Metrics Sender', target=self._sender, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,210 @@
+"""
+On-demand profiling of trigger watcher cycles in production.
+Send SIGUSR1 to zabbix-cachet and the next settings.profile_cycles cycles are profiled:
+    *.collapsed - wall-clock samples of watcher thread in collapsed stacks format
+                  (flamegraph.pl, speedscope, inferno);
+    *.tracemalloc.txt - tracemalloc snapshot diff between consecutive cycles;
+    *.phases.txt - time of Zabbix fetch, Cachet fetch, collecting (rendering of Zabbix state),
+                   sync (comparing it with Cachet) and Cachet writes per cycle.
+Phases are accounted in watcher thread only. Pages of Cachet lists fetched by page_workers threads
+are not attributed to cachet_fetch, waiting for them counts to the enclosing phase of watcher thread.
+While profiling is off hooks are a single attribute check.
+"""
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import nullcontext
+from typing import Dict, List, Union
+
+PHASES = ('zabbix_fetch', 'collect', 'cachet_fetch', 'sync', 'cachet_write')
+
+_NULL_CONTEXT = nullcontext()
+
+
+class _PhaseTimer:
+    """
+    Measure exclusive time of phase: time of nested phases is not counted twice
+    """
+    __slots__ = ('profiler', 'name', 'started', 'nested')
+
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.profiler._phase_stack.append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self.started
+        stack = self.profiler._phase_stack
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.profiler._add_phase(self.name, elapsed - self.nested)
+        return False
+
+
+class Profiler:
+    def __init__(self):
+        self.output_dir = tempfile.gettempdir()
+        self.sample_interval = 0.005
+        # Cycles requested by signal. Signal handler only sets it, session is started by watcher thread
+        self._requested = 0
+        self._active = False
+        self._thread_ident = None
+        self._remaining = 0
+        self._cycle = 0
+        self._prefix = ''
+        self._cycle_started = 0.0
+        self._samples = Counter()
+        self._sampler: Union[threading.Thread, None] = None
+        self._sampler_stop = threading.Event()
+        self._snapshot: Union[tracemalloc.Snapshot, None] = None
+        self._phase_stack: List[_PhaseTimer] = []
+        self._phases: Dict[str, float] = {}
+        self._phase_report: List[str] = []
+        self._started_tracing = False
+
+    def configure(self, output_dir: str = None, sample_interval: float = None):
+        if output_dir:
+            self.output_dir = output_dir
+        if sample_interval:
+            self.sample_interval = sample_interval
+
+    def request(self, cycles: int):
+        """
+        Profile next cycles of watcher. Safe to call from signal handler
+        """
+        self._requested = max(1, int(cycles))
+
+    def signal_handler(self, cycles: int):
+        def handler(signum, frame):
+            self.request(cycles)
+        return handler
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    def phase(self, name: str):
+        """
+        Context manager which accounts time of phase of the profiled cycle
+        """
+        if not self._active or threading.get_ident() != self._thread_ident:
+            return _NULL_CONTEXT
+        return _PhaseTimer(self, name)
+
+    def _add_phase(self, name: str, elapsed: float):
+        self._phases[name] = self._phases.get(name, 0.0) + elapsed
+
+    def cycle_start(self):
+        """
+        Called by watcher thread before each cycle
+        """
+        if self._active:
+            self._phases = {}
+            self._cycle_started = time.perf_counter()
+            return
+        if not self._requested:
+            return
+        self._remaining, self._requested = self._requested, 0
+        self._thread_ident = threading.get_ident()
+        self._cycle = 0
+        self._prefix = os.path.join(self.output_dir,
+                                    'zabbix-cachet-{}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+        self._samples = Counter()
+        self._phase_report = []
+        self._phases = {}
+        logging.info(f'Profile {self._remaining} watcher cycles to {self._prefix}.*')
+        # Do not stop tracing which was started by somebody else
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        self._snapshot = tracemalloc.take_snapshot()
+        self._sampler_stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name='Profiler', daemon=True)
+        self._sampler.start()
+        self._active = True
+        self._cycle_started = time.perf_counter()
+
+    def cycle_end(self):
+        """
+        Called by watcher thread after each cycle
+        """
+        if not self._active:
+            return
+        self._cycle += 1
+        duration = time.perf_counter() - self._cycle_started
+        self._report_phases(duration)
+        self._report_memory()
+        self._remaining -= 1
+        if self._remaining <= 0:
+            self._finish()
+
+    def _sample(self):
+        ident = self._thread_ident
+        while not self._sampler_stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(ident)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self._samples[';'.join(reversed(stack))] += 1
+
+    def _report_phases(self, duration: float):
+        accounted = sum(self._phases.values())
+        self._phase_report.append(f'cycle {self._cycle}: {duration:.3f}s')
+        phases = [(name, self._phases.get(name, 0.0))
+                  for name in PHASES + tuple(sorted(set(self._phases) - set(PHASES)))]
+        phases.append(('other', max(0.0, duration - accounted)))
+        for name, elapsed in phases:
+            share = elapsed / duration * 100 if duration else 0
+            self._phase_report.append(f'  {name:<14}{elapsed:10.3f}s {share:6.1f}%')
+        logging.info('Phases of profiled cycle {}: {}'.format(
+            self._cycle, ', '.join(f'{name}={elapsed:.3f}s' for name, elapsed in self._phases.items())))
+        self._phases = {}
+
+    def _report_memory(self):
+        snapshot = tracemalloc.take_snapshot()
+        diff = snapshot.compare_to(self._snapshot, 'lineno')
+        self._snapshot = snapshot
+        try:
+            with open(f'{self._prefix}.tracemalloc.txt', 'a') as f:
+                f.write(f'cycle {self._cycle}: top allocations growth\n')
+                for stat in diff[:30]:
+                    f.write(f'  {stat}\n')
+        except OSError as err:
+            logging.error(f'Failed to write tracemalloc diff: {err}')
+
+    def _finish(self):
+        self._active = False
+        self._sampler_stop.set()
+        self._sampler.join()
+        if self._started_tracing:
+            tracemalloc.stop()
+        self._snapshot = None
+        try:
+            with open(f'{self._prefix}.collapsed', 'w') as f:
+                for stack, count in self._samples.most_common():
+                    f.write(f'{stack} {count}\n')
+            with open(f'{self._prefix}.phases.txt', 'w') as f:
+                f.write('\n'.join(self._phase_report) + '\n')
+        except OSError as err:
+            logging.error(f'Failed to write profiling results: {err}')
+            return
+        logging.info(f'Profiling is finished. Results are in {self._prefix}.*')
+
+
+PROFILER = Profiler()
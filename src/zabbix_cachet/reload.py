@@ -0,0 +1,85 @@
+"""
+Hot reload of config file on SIGHUP or when the file changes.
+Only changed parts are applied: log levels here at once, everything else by the threads which use it
+when they notice new Config.generation (they are woken up through ServiceMapHandoff.wake()).
+"""
+import logging
+import os
+import threading
+from typing import Set, Union
+
+from zabbix_cachet.service_map import ServiceMapHandoff
+
+# Sections whose changes are applied only after restart: clients and their threads are built once
+RESTART_SECTIONS = ('zabbix', 'cachet', 'metrics', 'maintenance')
+
+
+def apply_log_levels(app_settings: dict):
+    logging.getLogger().setLevel(logging.getLevelName(app_settings['log_level']))
+    logging.getLogger('requests').setLevel(logging.getLevelName(app_settings['log_level_requests']))
+
+
+class ConfigWatcher:
+    def __init__(self, config, handoff: ServiceMapHandoff, poll_interval: float = 10):
+        """
+        @param config: Config object which is reloaded in place
+        @param handoff: ServiceMapHandoff whose waiters are woken up after reload
+        @param poll_interval: seconds between checks of config file modification time. 0 - only on SIGHUP
+        """
+        self.config = config
+        self.handoff = handoff
+        self.poll_interval = poll_interval
+        self._requested = threading.Event()
+        self._mtime = self._read_mtime()
+        self._thread = None
+
+    def _read_mtime(self) -> Union[float, None]:
+        try:
+            return os.stat(self.config.config_file).st_mtime
+        except OSError:
+            return None
+
+    def signal_handler(self, signum, frame):
+        """
+        Handler of SIGHUP. It only sets a flag, reload runs in watcher thread
+        """
+        self._requested.set()
+
+    def check(self, force: bool = False) -> Set[str]:
+        """
+        Reload config if it was requested or the file was modified and apply what can be applied here
+        @return: changed keys
+        """
+        mtime = self._read_mtime()
+        if not force and mtime == self._mtime:
+            return set()
+        self._mtime = mtime
+        changed = self.config.reload()
+        if not changed:
+            logging.info(f'Config file {self.config.config_file} was read again, nothing has changed')
+            return changed
+        logging.info(f'Config was reloaded. Changed: {", ".join(sorted(changed))}')
+        if changed & {'settings.log_level', 'settings.log_level_requests'}:
+            apply_log_levels(self.config.app_settings)
+        restart = sorted(key for key in changed if key.split('.')[0] in RESTART_SECTIONS)
+        if restart:
+            logging.warning(f'Changes of {", ".join(restart)} take effect after restart')
+        self.handoff.wake()
+        return changed
+
+    def _run(self):
+        while not self.handoff.stopped:
+            self._requested.wait(self.poll_interval or None)
+            force = self._requested.is_set()
+            self._requested.clear()
+            if self.handoff.stopped:
+                break
+            try:
+                self.check(force=force)
+            except Exception as e:
+                logging.error('Config reload raised an Exception. Something gone wrong')
+                logging.error(e, exc_info=True)
+
+    def start(self):
+        self._thread = threading.Thread(name='Config Watcher', target=self._run, daemon=True)
+        self._thread.start()
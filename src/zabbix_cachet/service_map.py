@@ -0,0 +1,78 @@
+import threading
+from typing import List, Tuple
+
+
+class ServiceMapHandoff:
+    """
+    Thread-safe, versioned holder of Zabbix <> Cachet service map.
+    main() publishes a new map after each sync and a long-lived Trigger Watcher
+    picks it up between cycles, so the watcher thread is never restarted.
+    All sleeps wake up at once on shutdown, on wake() (config reload) or (for the watcher) on a map change.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._service_map = []
+        self._version = 0
+        self._stopped = False
+        self._wakeups = 0
+
+    @property
+    def version(self) -> int:
+        with self._cond:
+            return self._version
+
+    @property
+    def stopped(self) -> bool:
+        with self._cond:
+            return self._stopped
+
+    def publish(self, service_map: List) -> int:
+        """
+        Replace current service map and wake up everybody who waits for it
+        @param service_map: list of ZabbixCachetMap
+        @return: version of published map
+        """
+        with self._cond:
+            self._service_map = list(service_map)
+            self._version += 1
+            self._cond.notify_all()
+            return self._version
+
+    def snapshot(self) -> Tuple[int, List]:
+        """
+        Get current service map with its version. Returned list is never modified in place
+        @return: (version, list of ZabbixCachetMap)
+        """
+        with self._cond:
+            return self._version, self._service_map
+
+    def stop(self):
+        """
+        Request shutdown of all waiters
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def wake(self):
+        """
+        Wake up all waiters without changing the map, e.g. to apply reloaded config
+        """
+        with self._cond:
+            self._wakeups += 1
+            self._cond.notify_all()
+
+    def wait(self, timeout: float, seen_version: int = None) -> bool:
+        """
+        Sleep up to timeout seconds.
+        @param timeout: seconds
+        @param seen_version: wake up as soon as published version differs from this one
+        @return: True if woke up because of shutdown, wake() or new map version
+        """
+        with self._cond:
+            wakeups = self._wakeups
+            return self._cond.wait_for(
+                lambda: (self._stopped or self._wakeups != wakeups
+                         or (seen_version is not None and self._version != seen_version)),
+                timeout)
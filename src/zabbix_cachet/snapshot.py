@@ -0,0 +1,110 @@
+"""
+Static snapshot of components and incidents which zabbix-cachet synced to Cachet.
+It is written after each cycle of trigger watcher as versioned JSON and minimal HTML
+with pre-gzipped variants, so nginx (gzip_static on) or CDN can serve status page reads without Cachet.
+"""
+import datetime
+import gzip
+import hashlib
+import html
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, List
+
+from zabbix_cachet import codec
+
+COMPONENT_STATUSES = {1: 'Operational', 2: 'Performance Issues', 3: 'Partial Outage', 4: 'Major Outage'}
+INCIDENT_STATUSES = {0: 'Scheduled', 1: 'Investigating', 2: 'Identified', 3: 'Watching', 4: 'Fixed'}
+
+
+def _write_atomic(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.zabbix-cachet-snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+class SnapshotExporter:
+    def __init__(self, directory: str, title: str = 'Status'):
+        """
+        @param directory: where status.json and index.html are written
+        @param title: title of HTML page
+        """
+        self.directory = directory
+        self.title = title
+        self.version = self._last_version()
+        self._digest = None
+
+    def _last_version(self) -> int:
+        """
+        Continue numbering of the previous run, so readers can rely on growing version
+        """
+        try:
+            with open(os.path.join(self.directory, 'status.json'), 'rb') as f:
+                return int(json.load(f).get('version', 0))
+        except (OSError, ValueError, AttributeError):
+            return 0
+
+    def export(self, components: List[dict]) -> bool:
+        """
+        Write snapshot if components have changed since the last export
+        @param components: list of dicts with id, name, group, status and incident (dict or None)
+        @return: True if snapshot was written
+        """
+        components = sorted(components, key=lambda c: (c['group'], c['name'], c['id']))
+        digest = hashlib.sha1(codec.dumps(components)).hexdigest()
+        if digest == self._digest:
+            return False
+        version = self.version + 1
+        document = {
+            'version': version,
+            'generated_at': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'components': components,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for name, data in (('status.json', codec.dumps(document)),
+                               ('index.html', self.render_html(document).encode('utf-8'))):
+                path = os.path.join(self.directory, name)
+                # gzip first, so the plain file never points to older compressed variant
+                _write_atomic(path + '.gz', gzip.compress(data, mtime=0))
+                _write_atomic(path, data)
+        except OSError as err:
+            logging.error(f'Failed to write status snapshot to {self.directory}: {err}')
+            return False
+        self.version = version
+        self._digest = digest
+        logging.debug(f'Status snapshot v{version} was written to {self.directory}')
+        return True
+
+    def render_html(self, document: dict) -> str:
+        groups: Dict[str, List[dict]] = {}
+        for component in document['components']:
+            groups.setdefault(component['group'], []).append(component)
+        lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">',
+                 f'<title>{html.escape(self.title)}</title></head><body>',
+                 f'<h1>{html.escape(self.title)}</h1>',
+                 f'<p>Updated {document["generated_at"]}</p>']
+        for group, components in groups.items():
+            if group:
+                lines.append(f'<h2>{html.escape(group)}</h2>')
+            lines.append('<ul>')
+            for component in components:
+                lines.append(f'<li data-status="{component["status"]}">{html.escape(component["name"])}: '
+                             f'{COMPONENT_STATUSES.get(component["status"], "Unknown")}')
+                incident = component['incident']
+                if incident:
+                    lines.append(f'<p><b>{html.escape(incident["name"])}</b> - '
+                                 f'{INCIDENT_STATUSES.get(incident["status"], "Unknown")}</p>'
+                                 f'<pre>{html.escape(incident["message"])}</pre>')
+                lines.append('</li>')
+            lines.append('</ul>')
+        lines.append('</body></html>')
+        return '\n'.join(lines) + '\n'
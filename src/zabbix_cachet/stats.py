@@ -0,0 +1,84 @@
+"""
+Process wide metrics of zabbix-cachet.
+They are exported in Prometheus text format to settings.metrics_file (node_exporter textfile collector)
+"""
+import os
+import tempfile
+import threading
+from typing import Dict, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._values: Dict[str, Dict[Labels, float]] = {}
+
+    def _register(self, name: str, metric_type: str, help_text: str):
+        if name not in self._meta:
+            self._meta[name] = (metric_type, help_text)
+            self._values[name] = {}
+
+    @staticmethod
+    def _labels(labels: dict) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, help_text: str = '', **labels):
+        """
+        Increase counter
+        """
+        with self._lock:
+            self._register(name, 'counter', help_text)
+            key = self._labels(labels)
+            self._values[name][key] = self._values[name].get(key, 0) + value
+
+    def set(self, name: str, value: float, help_text: str = '', **labels):
+        """
+        Set gauge
+        """
+        with self._lock:
+            self._register(name, 'gauge', help_text)
+            self._values[name][self._labels(labels)] = value
+
+    def get(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._values.get(name, {}).get(self._labels(labels), 0)
+
+    def render(self) -> str:
+        """
+        Metrics in Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in sorted(self._meta.items()):
+                if help_text:
+                    lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in sorted(self._values[name].items()):
+                    if labels:
+                        label_str = ','.join(f'{key}="{label_value}"' for key, label_value in labels)
+                        lines.append(f'{name}{{{label_str}}} {value:g}')
+                    else:
+                        lines.append(f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """
+        Atomically write metrics to file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.zabbix-cachet-metrics')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+
+STATS = Stats()
@@ -2,29 +2,193 @@ import sys
 import logging
 
 from dataclasses import dataclass, field
-from typing import List, Dict, Union
+from typing import Iterator, List, Dict, Set, Tuple, Union
 
 import requests
 
 import urllib3
 from pyzabbix import ZabbixAPI, ZabbixAPIException
+from pyzabbix.api import ZABBIX_6_4_0
 
+from zabbix_cachet import codec
+from zabbix_cachet.breaker import CircuitBreaker
 from zabbix_cachet.excepltions import InvalidConfig, ZabbixNotAvailable, ZabbixCachetException, ZabbixServiceNotFound
+from zabbix_cachet.limiter import AdaptiveLimiter
+from zabbix_cachet.profiling import PROFILER
+
+
+class ZabbixJsonRpc(ZabbixAPI):
+    """
+    pyzabbix ZabbixAPI which encodes requests and parses raw response bytes with zabbix_cachet.codec
+    instead of stdlib json. Mirrors ZabbixAPI.do_request() of pyzabbix 1.3.1.
+    """
+
+    # Set by Zabbix, shared by all threads
+    limiter: AdaptiveLimiter = None
+
+    def do_request(self, method: str, params=None) -> dict:
+        with PROFILER.phase('zabbix_fetch'):
+            if self.limiter is None:
+                return self._do_request(method, params)
+            with self.limiter.slot():
+                return self._do_request(method, params)
+
+    def _do_request(self, method: str, params=None) -> dict:
+        payload = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params or {},
+            "id": self.id,
+        }
+        headers = {}
+        # We don't have to pass the auth token if asking for
+        # the apiinfo.version or user.checkAuthentication
+        anonymous_methods = {
+            "apiinfo.version",
+            "user.checkAuthentication",
+            "user.login",
+        }
+        if self.auth and method not in anonymous_methods:
+            if self.version and self.version >= ZABBIX_6_4_0:
+                headers["Authorization"] = f"Bearer {self.auth}"
+            else:
+                payload["auth"] = self.auth
+
+        logging.debug("Sending: %s", payload)
+        resp = self.session.post(
+            self.url,
+            data=codec.dumps(payload),
+            headers=headers,
+            timeout=self.timeout,
+        )
+        logging.debug("Response Code: %s", resp.status_code)
+        resp.raise_for_status()
+        if not resp.content:
+            raise ZabbixAPIException("Received empty response")
+        try:
+            response = codec.loads(resp.content)
+        except ValueError as exception:
+            raise ZabbixAPIException(f"Unable to parse json: {resp.text}") from exception
+        self.id += 1
+
+        if "error" in response:
+            error = response["error"]
+            # some errors don't contain 'data': workaround for ZBX-9340
+            if "data" not in error:
+                error["data"] = "No data"
+            raise ZabbixAPIException(
+                f"Error {error['code']}: {error['message']}, {error['data']}",
+                error["code"],
+                error=error,
+            )
+        return response
 
 
 def pyzabbix_safe(fail_result=False):
+    """
+    Return fail_result instead of raising on Zabbix errors.
+    Connection problems are counted by circuit breaker of Zabbix object, while it is open
+    Zabbix is not called at all.
+    """
 
     def wrap(func):
-        def wrapperd_f(*args, **kwargs):
+        def wrapperd_f(self, *args, **kwargs):
+            if not self.breaker.allow():
+                logging.debug(f'Zabbix is not available (circuit breaker is {self.breaker.state}). '
+                              f'Skip {func.__name__}()')
+                return fail_result
             try:
-                return func(*args, **kwargs)
-            except (requests.ConnectionError, ZabbixAPIException) as e:
+                result = func(self, *args, **kwargs)
+            except requests.RequestException as e:
+                self.breaker.record_failure()
                 logging.error('Zabbix Error: {}'.format(e))
                 return fail_result
+            except ZabbixAPIException as e:
+                logging.error('Zabbix Error: {}'.format(e))
+                return fail_result
+            self.breaker.record_success()
+            return result
         return wrapperd_f
     return wrap
 
 
+# Fields of Zabbix objects which zabbix-cachet reads, per API call and Zabbix version.
+# Explicit output lists keep responses small on large trees.
+# tests/test_zabbix_fields.py fails if code reads a field which is not listed here.
+QUERY_FIELDS = {
+    # service.get for Zabbix 6.0+
+    'service': {
+        'output': ['serviceid', 'name', 'status', 'description'],
+        'selectChildren': ['serviceid'],
+        'selectProblemTags': ['tag', 'operator', 'value'],
+    },
+    # service.get for Zabbix < 6.0
+    'service_legacy': {
+        'output': ['serviceid', 'name', 'status', 'triggerid'],
+        'selectDependencies': ['servicedownid'],
+        'selectParentDependencies': ['serviceupid'],
+    },
+    'trigger': {
+        'output': ['triggerid', 'description', 'comments', 'priority', 'url', 'value'],
+    },
+    'event': {
+        'output': ['eventid', 'clock', 'acknowledged'],
+        # name and surname are joined from users by Zabbix when they are requested
+        'select_acknowledges': ['acknowledgeid', 'clock', 'message', 'name', 'surname'],
+    },
+    # Recovery events for propagation latency
+    'recovery_event': {
+        'output': ['eventid', 'clock'],
+    },
+    'item': {
+        'output': ['itemid', 'value_type'],
+    },
+    'history': {
+        'output': ['itemid', 'clock', 'value'],
+    },
+    'auditlog': {
+        'output': ['auditid', 'clock', 'resourceid'],
+    },
+    # Lightweight list of services to detect changes without audit log
+    'service_ids': {
+        'output': ['serviceid', 'name'],
+    },
+    'service_parents': {
+        'output': ['serviceid'],
+        'selectParents': ['serviceid'],
+    },
+    'service_parents_legacy': {
+        'output': ['serviceid'],
+        'selectParentDependencies': ['serviceupid'],
+    },
+    # Hosts of triggers behind services, for maintenance sync.
+    # Host groups are requested by _select_groups() because Zabbix 6.2 renamed selectGroups
+    'trigger_hosts': {
+        'output': ['triggerid'],
+        'selectHosts': ['hostid'],
+    },
+    'maintenance': {
+        'output': ['maintenanceid', 'name', 'description', 'active_since', 'active_till'],
+        'selectHosts': ['hostid'],
+        'selectTimeperiods': ['timeperiod_type', 'start_date', 'period'],
+    },
+}
+# Resource type of IT services in audit log
+AUDIT_RESOURCE_SERVICE = 18
+# Operator of IT service problem tag -> operator of trigger.get tag filter.
+# Problem tags use 0 - Equals, 1 - Not equal, 2 - Like, 3 - Not like,
+# trigger.get uses 0 - Like, 1 - Equals, 2 - Not like, 3 - Not equal
+PROBLEM_TAG_OPERATORS = {0: 1, 1: 3, 2: 0, 3: 2}
+
+
+def problem_tags_filter(problem_tags: List[dict]) -> List[dict]:
+    """
+    Tag filter of trigger.get which selects triggers matching problem tags of IT service
+    """
+    return [{'tag': tag['tag'], 'operator': str(PROBLEM_TAG_OPERATORS.get(int(tag.get('operator', 0)), 1)),
+             'value': tag.get('value', '')} for tag in problem_tags]
+
+
 @dataclass
 class ZabbixService:
     name: str
@@ -57,20 +221,29 @@ class ZabbixService:
 
 
 class Zabbix:
-    def __init__(self, server: str, user: str, password: str, verify: bool = True):
+    def __init__(self, server: str, user: str, password: str, verify: bool = True, breaker: CircuitBreaker = None,
+                 timeout: Union[float, Tuple[float, float]] = None, limiter: AdaptiveLimiter = None):
         """
         Init zabbix class for further needs
+        :param breaker: CircuitBreaker of Zabbix. Its probe is set to apiinfo.version
+        :param timeout: (connect, read) timeout of every API request
+        :param limiter: AdaptiveLimiter of concurrent API requests shared by all threads
         :return: pyzabbix object
         """
         self.server = server
         self.user = user
         self.password = password
+        self.breaker = breaker or CircuitBreaker('Zabbix')
+        self.breaker.probe = self._probe
         # Enable basic HTTP auth, some installations can use it
         # s = requests.Session()
         # s.auth = (user, password)
         # self.zapi = ZabbixAPI(server, s)
 
-        self.zapi = ZabbixAPI(server)
+        self.zapi = ZabbixJsonRpc(server, timeout=timeout)
+        self.zapi.limiter = limiter or AdaptiveLimiter('Zabbix')
+        # Set by get_itservices()
+        self.root_serviceid = None
         self.zapi.session.verify = verify
         if not verify:
             urllib3.disable_warnings()
@@ -87,6 +260,28 @@ class Zabbix:
             logging.error(f"Failed to compare major Zabbix version - {self.version}: {err}")
             sys.exit(1)
 
+    def _select_groups(self, query: dict) -> Tuple[dict, str]:
+        """
+        Add host groups to query
+        @return: query and property of returned objects with host groups
+        """
+        major, minor = (int(part) for part in self.version.split('.')[:2])
+        if (major, minor) >= (6, 2):
+            return {**query, 'selectHostGroups': ['groupid']}, 'hostgroups'
+        return {**query, 'selectGroups': ['groupid']}, 'groups'
+
+    def _probe(self) -> bool:
+        """
+        Cheap check of Zabbix availability for circuit breaker. Does not use breaker itself
+        """
+        return bool(self.zapi.apiinfo.version())
+
+    def prefetch(self, serviceids: List[str]) -> bool:
+        """
+        API backend reads services one by one, nothing to prefetch. See ZabbixDB.prefetch()
+        """
+        return True
+
     @pyzabbix_safe()
     def get_version(self):
         """
@@ -102,17 +297,20 @@ class Zabbix:
         """
         Get trigger information by trigger_id or tags
         https://www.zabbix.com/documentation/6.0/en/manual/api/reference/trigger/get
+        @param tags: problem tags of IT service, they are converted to tag filter of trigger.get
         """
         if triggerid:
             trigger = self.zapi.trigger.get(
+                **QUERY_FIELDS['trigger'],
                 expandComment='true',
                 expandDescription='true',
                 triggerids=triggerid)
         else:
             trigger = self.zapi.trigger.get(
+                **QUERY_FIELDS['trigger'],
                 expandComment='true',
                 expandDescription='true',
-                tags=tags,
+                tags=problem_tags_filter(tags or []),
                 only_true=True)
         return trigger
 
@@ -120,21 +318,162 @@ class Zabbix:
     def get_event(self, triggerid):
         """
         https://www.zabbix.com/documentation/current/en/manual/api/reference/event/get
-        Get event information based on triggerid
+        Get the last problem event based on triggerid
         @param triggerid: string
         @return: dict of data
         """
         zbx_event = self.zapi.event.get(
-            select_acknowledges='extend',
+            **QUERY_FIELDS['event'],
             object=0,
             value=1,
             objectids=triggerid,
-            sortfield=['clock']
+            sortfield=['clock', 'eventid'],
+            sortorder='DESC',
+            limit=1,
         )
         if len(zbx_event) >= 1:
-            return zbx_event[-1]
+            return zbx_event[0]
         return zbx_event
 
+    @pyzabbix_safe(None)
+    def get_recovery_clock(self, triggerids: List[str]) -> Union[int, None]:
+        """
+        Time of the last recovery event of triggers
+        @param triggerids: list of trigger ids
+        @return: unix time or None if triggers have no recovery events
+        """
+        events = self.zapi.event.get(
+            **QUERY_FIELDS['recovery_event'],
+            object=0,
+            value=0,
+            objectids=triggerids,
+            sortfield=['clock', 'eventid'],
+            sortorder='DESC',
+            limit=1,
+        )
+        if events:
+            return int(events[0]['clock'])
+        return None
+
+    @pyzabbix_safe([])
+    def get_items(self, itemids: List[str]) -> List[dict]:
+        """
+        https://www.zabbix.com/documentation/current/en/manual/api/reference/item/get
+        @param itemids: list of item ids
+        @return: list of items with their value_type
+        """
+        return self.zapi.item.get(**QUERY_FIELDS['item'], itemids=itemids)
+
+    @pyzabbix_safe(None)
+    def get_history(self, itemids: List[str], history: int, time_from: int, time_till: int) -> Union[List[dict], None]:
+        """
+        https://www.zabbix.com/documentation/current/en/manual/api/reference/history/get
+        Get history of items of the same value type in one request
+        @param itemids: list of item ids
+        @param history: value type of items
+        @param time_from: unix time, inclusive
+        @param time_till: unix time, inclusive
+        @return: list of values sorted by clock or None if Zabbix failed
+        """
+        return self.zapi.history.get(
+            **QUERY_FIELDS['history'],
+            history=history,
+            itemids=itemids,
+            time_from=time_from,
+            time_till=time_till,
+            sortfield='clock',
+            sortorder='ASC',
+        )
+
+    @pyzabbix_safe(None)
+    def get_service_audit(self, time_from: int) -> Union[List[dict], None]:
+        """
+        https://www.zabbix.com/documentation/current/en/manual/api/reference/auditlog/get
+        Get audit log records of IT services since time_from
+        @param time_from: unix time, inclusive
+        @return: list of records sorted by clock or None if audit log is not available
+        """
+        return self.zapi.auditlog.get(
+            **QUERY_FIELDS['auditlog'],
+            filter={'resourcetype': AUDIT_RESOURCE_SERVICE},
+            time_from=time_from,
+            sortfield='clock',
+            sortorder='ASC',
+        )
+
+    @pyzabbix_safe(None)
+    def get_service_names(self) -> Union[Dict[str, str], None]:
+        """
+        Get all IT services as serviceid -> name
+        """
+        services = self.zapi.service.get(**QUERY_FIELDS['service_ids'])
+        return {service['serviceid']: service['name'] for service in services}
+
+    @pyzabbix_safe(None)
+    def get_child_ids(self, serviceid: str) -> Union[Set[str], None]:
+        """
+        Get ids of child services
+        @return: set of ids (empty for leaf service) or None if Zabbix failed
+        """
+        services = self.zapi.service.get(output=QUERY_FIELDS['service_ids']['output'], parentids=serviceid)
+        return {service['serviceid'] for service in services}
+
+    @pyzabbix_safe(None)
+    def get_service_parents(self, serviceids: List[str]) -> Union[Dict[str, List[str]], None]:
+        """
+        Get ids of parent services
+        @param serviceids: list of service ids
+        @return: serviceid -> list of parent ids. Services which do not exist are absent
+        """
+        if self.version_major >= 6:
+            services = self.zapi.service.get(**QUERY_FIELDS['service_parents'], serviceids=serviceids)
+            return {service['serviceid']: [parent['serviceid'] for parent in service['parents']]
+                    for service in services}
+        services = self.zapi.service.get(**QUERY_FIELDS['service_parents_legacy'], serviceids=serviceids)
+        return {service['serviceid']: [parent['serviceupid'] for parent in service['parentDependencies']]
+                for service in services}
+
+    @pyzabbix_safe(None)
+    def get_service_hosts(self, serviceids: List[str]) -> Union[Dict[str, Tuple[Set[str], Set[str]]], None]:
+        """
+        Hosts and host groups of triggers behind services
+        @param serviceids: list of service ids
+        @return: serviceid -> (host ids, host group ids) or None if Zabbix failed
+        """
+        query, groups = self._select_groups(QUERY_FIELDS['trigger_hosts'])
+        result = {}
+        for service in self.get_service(serviceid=serviceids):
+            if self.version_major >= 6:
+                if not service['problem_tags']:
+                    continue
+                triggers = self.zapi.trigger.get(**query, tags=problem_tags_filter(service['problem_tags']))
+            elif service['triggerid'] and service['triggerid'] != '0':
+                triggers = self.zapi.trigger.get(**query, triggerids=service['triggerid'])
+            else:
+                continue
+            result[service['serviceid']] = ({host['hostid'] for trigger in triggers for host in trigger['hosts']},
+                                            {group['groupid'] for trigger in triggers for group in trigger[groups]})
+        return result
+
+    @pyzabbix_safe(None)
+    def get_maintenances(self, hostids: List[str], groupids: List[str]) -> Union[List[dict], None]:
+        """
+        https://www.zabbix.com/documentation/current/en/manual/api/reference/maintenance/get
+        Get maintenances of hosts or host groups with their hosts, host groups and time periods.
+        Host groups are returned as 'groups' property
+        @return: list of maintenances or None if Zabbix failed
+        """
+        query, groups = self._select_groups(QUERY_FIELDS['maintenance'])
+        maintenances = {}
+        # Maintenances are read by hosts and by groups separately, so either of them matches
+        for param, ids in (('hostids', hostids), ('groupids', groupids)):
+            if ids:
+                for maintenance in self.zapi.maintenance.get(**query, **{param: ids}):
+                    maintenances[maintenance['maintenanceid']] = maintenance
+        for maintenance in maintenances.values():
+            maintenance['groups'] = maintenance.pop(groups)
+        return list(maintenances.values())
+
     @pyzabbix_safe([])
     def get_service(self, name: str = '', serviceid: Union[List, str] = None,
                     parentids: str = '') -> List[Dict]:
@@ -143,11 +482,7 @@ class Zabbix:
         https://www.zabbix.com/documentation/6.0/en/manual/appendix/services_upgrade
         :return:
         """
-        query = {
-            'output': 'extend',
-            'selectChildren': 'extend',
-            'selectProblemTags': 'extend',
-        }
+        query = QUERY_FIELDS['service']
         if name:
             services = self.zapi.service.get(**query, filter={'name': name})
         elif serviceid:
@@ -165,17 +500,15 @@ class Zabbix:
         For old zabbix before 6.0
         :return:
         """
+        query = QUERY_FIELDS['service_legacy']
         if name:
-            services = self.zapi.service.get(selectDependencies='extend', selectParentDependencies='extend',
-                                             filter={'name': name})
+            services = self.zapi.service.get(**query, filter={'name': name})
         elif serviceid:
-            services = self.zapi.service.get(selectDependencies='extend', selectParentDependencies='extend',
-                                             serviceids=serviceid)
+            services = self.zapi.service.get(**query, serviceids=serviceid)
         elif parentids:
-            services = self.zapi.service.get(selectDependencies='extend', selectParentDependencies='extend',
-                                             parentids=parentids)
+            services = self.zapi.service.get(**query, parentids=parentids)
         else:
-            services = self.zapi.service.get(selectDependencies='extend', selectParentDependencies='extend')
+            services = self.zapi.service.get(**query)
         for service in services:
             service['children'] = service.pop('dependencies')
             service['parents'] = service.pop('parentDependencies')
@@ -188,19 +521,23 @@ class Zabbix:
             https://www.zabbix.com/documentation/current/en/manual/api/reference/service/object
         """
         logging.debug(f"Init ZabbixITService for {data.get('name')} ")
+        if self.version_major >= 6:
+            # Does not support by Zbx < 6.0
+            version_fields = {'description': data.get('description', ''),
+                              'problem_tags': data.get('problem_tags', [])}
+        else:
+            # Does not support by Zbx 6.0+
+            version_fields = {'triggerid': data.get('triggerid', None)}
         zabbix_it_service = ZabbixService(name=data.get('name'),
                                           serviceid=data.get('serviceid'),
                                           zabbix_version_major=self.version_major,
-                                          description=data.get('description', ''),
                                           status=int(data.get('status')),
-                                          # Does not support by Zbx < 6.0
-                                          problem_tags=data.get('problem_tags', []),
-                                          # Does not support by Zbx 6.0+
-                                          triggerid=data.get('triggerid', None),
+                                          **version_fields,
                                           )
-        if 'parents' in data:
+        if self.version_major < 6 and 'parents' in data:
             zabbix_it_service.is_parents = True
-        if 'children' in data:
+        # Do not ask Zabbix for children of leaf services
+        if data.get('children'):
             child_services = self.get_service(parentids=zabbix_it_service.serviceid)
             zabbix_it_service.children.extend(map(self._init_zabbix_it_service, child_services))
         return zabbix_it_service
@@ -221,14 +558,24 @@ class Zabbix:
         :return: Tree of Zabbix IT Services
         :rtype: list
         """
-        monitor_services = []
+        return list(self.iter_itservices(root_name))
+
+    def iter_itservices(self, root_name: str = None) -> Iterator[ZabbixService]:
+        """
+        Yield top level services of get_itservices() tree one by one, each with its subtree,
+        so caller can use the first of them before the whole tree is read
+        :param root_name: Name of service that will be root of tree
+        """
         if root_name:
             if not self.get_version():
                 raise ZabbixNotAvailable('Zabbix is not available...')
             root_service = self.get_service(root_name)
             if not len(root_service) == 1:
                 raise ZabbixCachetException(f'Can not find uniq "{root_name}" service in Zabbix')
-            monitor_services = self._init_zabbix_it_service(root_service[0]).children
+            self.root_serviceid = root_service[0]['serviceid']
+            if root_service[0].get('children'):
+                for child in self.get_service(parentids=self.root_serviceid):
+                    yield self._init_zabbix_it_service(child)
         else:
             # TODO: Add support after 6.0
             if self.version_major < 6:
@@ -236,11 +583,10 @@ class Zabbix:
                 for i in services:
                     # Do not proceed non-root services directly
                     if len(i['parents']) == 0:
-                        monitor_services.append(self._init_zabbix_it_service(i))
+                        yield self._init_zabbix_it_service(i)
             else:
                 raise InvalidConfig(f"settings.root_service should be defined in you config yaml file because "
                                     f"you use Zabbix version {self.version}")
-        return monitor_services
 
     def get_zabbix_service(self, serviceid: str) -> ZabbixService:
         """
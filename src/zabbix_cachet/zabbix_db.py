@@ -0,0 +1,292 @@
+"""
+Read-only backend of trigger watcher on Zabbix database (Zabbix 6.0+).
+It reads state of all mapped services with a few set-based queries per cycle
+instead of service.get, trigger.get and event.get per service through Zabbix frontend.
+Point it to a read replica. Everything else (service tree, discovery, metrics) still uses Zabbix API.
+
+Differences from API backend:
+    trigger description is taken from name of its problem, which Zabbix expands on problem creation.
+    Comments are not expanded;
+    only triggers in problem state are returned for tags (API returns recently recovered ones too).
+"""
+import logging
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+from zabbix_cachet.breaker import CircuitBreaker
+from zabbix_cachet.excepltions import InvalidConfig, ZabbixServiceNotFound
+from zabbix_cachet.profiling import PROFILER
+from zabbix_cachet.zabbix import ZabbixService, problem_tags_filter
+
+# Max ids in one IN (...) list
+CHUNK_SIZE = 1000
+
+
+def connect_from_config(db_config: dict) -> Tuple[Callable, type, str]:
+    """
+    Get connect function, Error class and paramstyle of DB-API driver of zabbix.db section of config.
+    Drivers are optional dependencies: pip install zabbix-cachet[postgresql] or zabbix-cachet[mysql]
+    """
+    engine = db_config.get('engine', 'postgresql')
+    if engine == 'postgresql':
+        try:
+            import psycopg2 as driver
+        except ImportError:
+            raise InvalidConfig('psycopg2 is required for zabbix.db.engine postgresql. '
+                                'Install zabbix-cachet[postgresql]')
+
+        def connect():
+            connection = driver.connect(host=db_config.get('host', 'localhost'), port=db_config.get('port', 5432),
+                                        dbname=db_config['name'], user=db_config.get('user'),
+                                        password=db_config.get('password'))
+            connection.set_session(readonly=True, autocommit=True)
+            return connection
+    elif engine == 'mysql':
+        try:
+            import pymysql as driver
+        except ImportError:
+            raise InvalidConfig('PyMySQL is required for zabbix.db.engine mysql. Install zabbix-cachet[mysql]')
+
+        def connect():
+            return driver.connect(host=db_config.get('host', 'localhost'), port=db_config.get('port', 3306),
+                                  database=db_config['name'], user=db_config.get('user'),
+                                  password=db_config.get('password'), autocommit=True)
+    elif engine == 'sqlite':
+        import sqlite3 as driver
+
+        def connect():
+            return driver.connect(f"file:{db_config['name']}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        raise InvalidConfig(f'Unknown zabbix.db.engine {engine}. Use postgresql, mysql or sqlite')
+    return connect, driver.Error, driver.paramstyle
+
+
+def _chunks(ids: List, size: int = CHUNK_SIZE) -> Iterable[List]:
+    for n in range(0, len(ids), size):
+        yield ids[n:n + size]
+
+
+def _match_tag(values: List[str], tag_filter: dict) -> bool:
+    """
+    Match values of one trigger tag with one condition of trigger.get tag filter
+    """
+    operator = int(tag_filter.get('operator', 0))
+    value = tag_filter.get('value', '')
+    if operator == 0:
+        return any(value.lower() in v.lower() for v in values)
+    if operator == 1:
+        return value in values
+    if operator == 2:
+        return not any(value.lower() in v.lower() for v in values)
+    if operator == 3:
+        return value not in values
+    if operator == 4:
+        return bool(values)
+    return not values
+
+
+def match_tags(trigger_tags: List[Tuple[str, str]], problem_tags: List[dict]) -> bool:
+    """
+    Check if trigger belongs to IT service by its problem tags, like trigger.get of API backend does:
+    conditions on the same tag name are OR-ed, conditions on different tag names are AND-ed
+    """
+    by_name: Dict[str, List[dict]] = {}
+    for tag_filter in problem_tags_filter(problem_tags):
+        by_name.setdefault(tag_filter['tag'], []).append(tag_filter)
+    for name, filters in by_name.items():
+        values = [value for tag, value in trigger_tags if tag == name]
+        if not any(_match_tag(values, tag_filter) for tag_filter in filters):
+            return False
+    return True
+
+
+def db_safe(fail_result=False):
+    """
+    Return fail_result instead of raising on database errors, like pyzabbix_safe does for API
+    """
+
+    def wrap(func):
+        def wrapperd_f(self, *args, **kwargs):
+            if not self.breaker.allow():
+                logging.debug(f'Zabbix DB is not available (circuit breaker is {self.breaker.state}). '
+                              f'Skip {func.__name__}()')
+                return fail_result
+            try:
+                with PROFILER.phase('zabbix_fetch'):
+                    result = func(self, *args, **kwargs)
+            except self.db_error as e:
+                self.breaker.record_failure()
+                logging.error('Zabbix DB Error: {}'.format(e))
+                self._close()
+                return fail_result
+            self.breaker.record_success()
+            return result
+        return wrapperd_f
+    return wrap
+
+
+class ZabbixDB:
+    """
+    Zabbix object for triggers_watcher which reads Zabbix database.
+    Call prefetch() with all mapped service ids before each cycle,
+    then get_zabbix_service(), get_trigger() and get_event() are answered from memory.
+    """
+
+    def __init__(self, connect: Callable, db_error: type = Exception, paramstyle: str = 'qmark',
+                 breaker: CircuitBreaker = None):
+        """
+        @param connect: function which returns DB-API connection
+        @param db_error: base exception class of DB-API driver
+        @param paramstyle: paramstyle of DB-API driver
+        @param breaker: CircuitBreaker of Zabbix DB. Its probe reads Zabbix DB version
+        """
+        self.connect = connect
+        self.db_error = db_error
+        self.placeholder = '?' if paramstyle == 'qmark' else '%s'
+        self._connection = None
+        self.breaker = breaker or CircuitBreaker('Zabbix DB')
+        self.breaker.probe = self._probe
+        self._services: Dict[str, ZabbixService] = {}
+        # triggerid -> trigger
+        self._triggers: Dict[str, dict] = {}
+        self._trigger_tags: Dict[str, List[Tuple[str, str]]] = {}
+        # triggerid -> the last problem event with acknowledges
+        self._events: Dict[str, dict] = {}
+        self.version = self.get_version()
+        if not self.version:
+            raise InvalidConfig('Failed to read version of Zabbix database')
+        self.version_major = int(self.version.split('.')[0])
+        if self.version_major < 6:
+            raise InvalidConfig(f'Zabbix DB backend supports Zabbix 6.0+. Database is of Zabbix {self.version}')
+
+    @classmethod
+    def from_config(cls, db_config: dict, breaker: CircuitBreaker = None) -> 'ZabbixDB':
+        connect, db_error, paramstyle = connect_from_config(db_config)
+        return cls(connect, db_error, paramstyle, breaker=breaker)
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except self.db_error:
+                pass
+            self._connection = None
+
+    def _query(self, sql: str, params: Iterable = ()) -> List[tuple]:
+        if self._connection is None:
+            self._connection = self.connect()
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute(sql.replace('?', self.placeholder), tuple(params))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _query_in(self, sql: str, ids: List) -> List[tuple]:
+        """
+        Run query with {ids} placeholder for every chunk of ids
+        """
+        rows = []
+        for chunk in _chunks(list(ids)):
+            rows.extend(self._query(sql.format(ids=', '.join('?' * len(chunk))), chunk))
+        return rows
+
+    def _read_version(self) -> str:
+        mandatory = int(self._query('SELECT mandatory FROM dbversion')[0][0])
+        return f'{mandatory // 1000000}.{mandatory // 10000 % 100}'
+
+    def _probe(self) -> bool:
+        try:
+            return bool(self._read_version())
+        except self.db_error:
+            self._close()
+            return False
+
+    @db_safe()
+    def get_version(self):
+        """
+        Version of Zabbix database. It is used to check if Zabbix DB is available
+        :return: str
+        """
+        return self._read_version()
+
+    @db_safe(False)
+    def prefetch(self, serviceids: List[str]) -> bool:
+        """
+        Read services, triggers in problem state and their last problems with acknowledges at once
+        @param serviceids: all mapped service ids
+        @return: False if Zabbix DB is not available
+        """
+        serviceids = sorted({str(serviceid) for serviceid in serviceids if serviceid})
+        services = {}
+        for serviceid, name, status, description in self._query_in(
+                'SELECT serviceid, name, status, description FROM services WHERE serviceid IN ({ids})', serviceids):
+            services[str(serviceid)] = ZabbixService(name=name, serviceid=str(serviceid), status=int(status),
+                                                     zabbix_version_major=self.version_major,
+                                                     description=description or '')
+        for serviceid, tag, operator, value in self._query_in(
+                'SELECT serviceid, tag, operator, value FROM service_problem_tag WHERE serviceid IN ({ids})',
+                serviceids):
+            services[str(serviceid)].problem_tags.append({'tag': tag, 'operator': str(operator), 'value': value})
+
+        triggers = {}
+        for triggerid, description, comments, priority, url, value in self._query(
+                'SELECT triggerid, description, comments, priority, url, value FROM triggers '
+                'WHERE value = 1 AND status = 0 AND flags IN (0, 4)'):
+            triggers[str(triggerid)] = {'triggerid': str(triggerid), 'description': description,
+                                        'comments': comments, 'priority': str(priority), 'url': url,
+                                        'value': str(value)}
+        trigger_tags: Dict[str, List[Tuple[str, str]]] = {}
+        for triggerid, tag, value in self._query_in(
+                'SELECT triggerid, tag, value FROM trigger_tag WHERE triggerid IN ({ids})', list(triggers)):
+            trigger_tags.setdefault(str(triggerid), []).append((tag, value))
+
+        events = {}
+        for eventid, objectid, clock, acknowledged, name in self._query_in(
+                'SELECT eventid, objectid, clock, acknowledged, name FROM problem '
+                'WHERE source = 0 AND object = 0 AND r_eventid IS NULL AND objectid IN ({ids})', list(triggers)):
+            last = events.get(str(objectid))
+            if last is None or int(eventid) > int(last['eventid']):
+                events[str(objectid)] = {'eventid': str(eventid), 'clock': str(clock),
+                                         'acknowledged': str(acknowledged), 'name': name, 'acknowledges': []}
+        event_triggers = {event['eventid']: triggerid for triggerid, event in events.items()}
+        for acknowledgeid, eventid, clock, message, name, surname in self._query_in(
+                'SELECT a.acknowledgeid, a.eventid, a.clock, a.message, u.name, u.surname FROM acknowledges a '
+                'LEFT JOIN users u ON u.userid = a.userid WHERE a.eventid IN ({ids}) '
+                'ORDER BY a.clock DESC, a.acknowledgeid DESC', list(event_triggers)):
+            events[event_triggers[str(eventid)]]['acknowledges'].append(
+                {'acknowledgeid': str(acknowledgeid), 'clock': str(clock), 'message': message,
+                 'name': name or '', 'surname': surname or ''})
+        for triggerid, event in events.items():
+            if event['name']:
+                triggers[triggerid]['description'] = event['name']
+
+        self._services, self._triggers, self._trigger_tags, self._events = services, triggers, trigger_tags, events
+        logging.debug(f'Prefetched {len(services)} services, {len(triggers)} triggers in problem state '
+                      f'and {len(events)} problems from Zabbix DB')
+        return True
+
+    def get_zabbix_service(self, serviceid: str) -> ZabbixService:
+        service = self._services.get(str(serviceid))
+        if service is None:
+            raise ZabbixServiceNotFound(f"No one service returned by serviceid - {serviceid}")
+        return service
+
+    def get_trigger(self, triggerid: str = '', tags: List = None) -> List[dict]:
+        if triggerid:
+            trigger = self._triggers.get(str(triggerid))
+            return [trigger] if trigger else []
+        return [trigger for triggerid, trigger in self._triggers.items()
+                if match_tags(self._trigger_tags.get(triggerid, []), tags or [])]
+
+    def get_event(self, triggerid) -> dict:
+        return self._events.get(str(triggerid), {})
+
+    @db_safe(None)
+    def get_recovery_clock(self, triggerids: List[str]) -> Union[int, None]:
+        """
+        Time of the last recovery of triggers. Resolved problems are kept in problem table for a while
+        """
+        rows = self._query_in('SELECT MAX(r_clock) FROM problem WHERE source = 0 AND object = 0 '
+                              'AND r_eventid IS NOT NULL AND objectid IN ({ids})', list(triggerids))
+        clocks = [int(clock) for clock, in rows if clock]
+        return max(clocks) if clocks else None
@@ -1,11 +1,322 @@
+import itertools
 import os
+
 import pytest as pytest
+import yaml
 
+from zabbix_cachet import main
+from zabbix_cachet.breaker import CircuitBreaker
+from zabbix_cachet.excepltions import CachetApiException, CachetNotAvailable
 from zabbix_cachet.main import read_config
+from zabbix_cachet.zabbix import ZabbixService
 
 CONFIG_FILE = os.getenv("CONFIG_FILE")
 
+# Incident which get_incident() returns for component without incidents
+NO_INCIDENT = {'id': '0', 'name': 'Does not exist', 'status': '-1'}
+
 
 @pytest.fixture(name='config', scope='module')
 def zabbix_cachet_read_config():
     return read_config(CONFIG_FILE)
+
+
+@pytest.fixture(name='app_settings')
+def app_settings():
+    """
+    Settings section of app_config. Override it by parametrization:
+        @pytest.mark.parametrize('app_settings', [{'full_check_cycles': 3}])
+    """
+    return {}
+
+
+@pytest.fixture(name='app_templates')
+def app_templates():
+    """
+    Templates section of app_config, overridden like app_settings
+    """
+    return {}
+
+
+@pytest.fixture(name='config_file')
+def config_file(tmp_path, monkeypatch, app_settings, app_templates):
+    path = tmp_path / 'config.yml'
+    path.write_text(yaml.safe_dump({
+        'zabbix': {'server': 'http://zabbix', 'user': 'user', 'pass': 'pass', 'https-verify': True},
+        'cachet': {'server': 'http://cachet', 'token': 'token', 'https-verify': True},
+        'settings': {'root_service': 'root', **app_settings},
+        'templates': app_templates,
+    }))
+    monkeypatch.setenv('CONFIG_FILE', str(path))
+    monkeypatch.setattr(main.Config, '_instance', None)
+    return path
+
+
+@pytest.fixture(name='app_config')
+def app_config(config_file):
+    return main.Config()
+
+
+class FakeZabbix:
+    """
+    Zabbix 6 with a tree of IT services.
+    Service is failed while it is in problems, each problem is one trigger matched by the first problem tag
+    """
+    version = '6.0.0'
+    version_major = 6
+
+    def __init__(self):
+        self.root_serviceid = '1'
+        self.available = True
+        # serviceid -> (name, parent id)
+        self.services = {'1': ('root', None), '2': ('group', '1'), '3': ('component', '2'), '5': ('other', '1')}
+        # serviceid -> problem: {'triggerid', 'priority', 'clock', 'acknowledges'}, all of them are optional
+        self.problems = {}
+        self.recovery_clock = None
+        self.recovery_triggerids = None
+        self.audit = []
+        self.auditlog_available = True
+        # Services read by iter_itservices()
+        self.read = []
+        # Item history for metrics and arguments of get_history() calls
+        self.history = []
+        self.history_calls = []
+        # serviceid -> (host ids, host group ids)
+        self.service_hosts = {}
+        self.host_reads = 0
+        self.maintenances = []
+        self.maintenance_filter = None
+
+    def get_version(self):
+        return self.version
+
+    def prefetch(self, serviceids):
+        return True
+
+    def _problem(self, triggerid):
+        for serviceid, problem in self.problems.items():
+            if str(problem.get('triggerid', serviceid)) == str(triggerid):
+                return problem
+        return None
+
+    def get_zabbix_service(self, serviceid):
+        name, _ = self.services.get(serviceid, (serviceid, None))
+        children = [self.get_zabbix_service(child) for child, (_, parent) in self.services.items()
+                    if parent == serviceid]
+        problem = self.problems.get(serviceid)
+        return ZabbixService(name=name, serviceid=serviceid,
+                             status=int(problem.get('priority', 4)) if problem is not None else -1,
+                             zabbix_version_major=self.version_major, children=children,
+                             problem_tags=[{'tag': serviceid}])
+
+    def iter_itservices(self, root_name):
+        for serviceid, (_, parent) in list(self.services.items()):
+            if parent == self.root_serviceid:
+                self.read.append(serviceid)
+                yield self.get_zabbix_service(serviceid)
+
+    def get_service(self, name='', parentids=''):
+        if name:
+            return [{'serviceid': serviceid} for serviceid, (service_name, _) in self.services.items()
+                    if service_name == name]
+        return [{'serviceid': serviceid} for serviceid, (_, parent) in self.services.items() if parent == parentids]
+
+    def get_child_ids(self, serviceid):
+        if not self.available:
+            return None
+        return {child for child, (_, parent) in self.services.items() if parent == serviceid}
+
+    def get_service_audit(self, time_from):
+        if not self.auditlog_available:
+            return None
+        return [record for record in self.audit if int(record['clock']) >= time_from]
+
+    def get_service_names(self):
+        return {serviceid: name for serviceid, (name, _) in self.services.items()}
+
+    def get_service_parents(self, serviceids):
+        return {serviceid: [self.services[serviceid][1]] if self.services[serviceid][1] else []
+                for serviceid in serviceids if serviceid in self.services}
+
+    def get_trigger(self, triggerid='', tags=None):
+        serviceid = tags[0]['tag']
+        if serviceid not in self.problems:
+            return []
+        problem = self.problems[serviceid]
+        return [{'triggerid': str(problem.get('triggerid', serviceid)), 'priority': str(problem.get('priority', 4)),
+                 'description': 'down', 'comments': ''}]
+
+    def get_event(self, triggerid):
+        problem = self._problem(triggerid) or {}
+        acknowledges = problem.get('acknowledges', [])
+        return {'eventid': str(problem.get('eventid', triggerid)), 'acknowledged': '1' if acknowledges else '0',
+                'clock': str(problem.get('clock', 0)), 'acknowledges': acknowledges}
+
+    def get_recovery_clock(self, triggerids):
+        self.recovery_triggerids = triggerids
+        return self.recovery_clock
+
+    def get_items(self, itemids):
+        return [{'itemid': itemid, 'value_type': '4' if itemid == 'text' else '0'} for itemid in itemids]
+
+    def get_history(self, itemids, history, time_from, time_till):
+        self.history_calls.append((itemids, time_from, time_till))
+        return [record for record in self.history
+                if record['itemid'] in itemids and time_from <= int(record['clock']) <= time_till]
+
+    def get_service_hosts(self, serviceids):
+        self.host_reads += 1
+        return {serviceid: hosts for serviceid, hosts in self.service_hosts.items() if serviceid in serviceids}
+
+    def get_maintenances(self, hostids, groupids):
+        self.maintenance_filter = (hostids, groupids)
+        return self.maintenances
+
+
+class FakeCachet:
+    """
+    Cachet which keeps components, incidents, schedules and metric points in memory.
+    While it is not available every request fails like the real client does
+    """
+    version = '2.4.0'
+
+    def __init__(self):
+        self.available = True
+        self.breaker = CircuitBreaker('Cachet', failure_threshold=1, recovery_timeout=0, probe=lambda: self.available)
+        self.incident_updates = False
+        # Cachet before 2.4 has no incident updates API
+        self.updates_api = True
+        self.ids = itertools.count(1)
+        self.reads = 0
+        self.writes = 0
+        self.io_time = (0.0, 0.0)
+        # Names of created components and ids of components which incidents were created for, in order
+        self.created = []
+        self.created_incidents = []
+        # component id -> status
+        self.components = {}
+        # component id -> the last incident
+        self.incidents = {}
+        # incident id -> its updates
+        self.updates = {}
+        self.schedules = {}
+        # ('new' | 'upd' | 'del', schedule id) in order
+        self.schedule_writes = []
+        # Number of metric points which fail before points are accepted again
+        self.metric_failures = 0
+        # Metrics which points are rejected
+        self.rejected_metrics = set()
+        self.points = []
+
+    def _request(self, write=False):
+        if not self.available:
+            self.breaker.record_failure()
+            raise CachetNotAvailable('Failed to connect to Cachet')
+        if write:
+            self.writes += 1
+        else:
+            self.reads += 1
+
+    def _find_incident(self, incident_id):
+        for incident in self.incidents.values():
+            if str(incident['id']) == str(incident_id):
+                return incident
+        raise CachetApiException(f'Incident ID {incident_id} does not exist')
+
+    def new_components_gr(self, name):
+        self._request(write=True)
+        return {'id': 100, 'name': name}
+
+    def new_components(self, name, **kwargs):
+        self._request(write=True)
+        component_id = next(self.ids)
+        self.created.append(name)
+        self.components[component_id] = kwargs.get('status', 1)
+        return {'id': component_id, 'name': name}
+
+    def get_component(self, component_id):
+        self._request()
+        return {'data': {'id': component_id, 'status': self.components.get(component_id, 1)}}
+
+    def upd_components(self, id, **kwargs):
+        self._request(write=True)
+        self.components[id] = kwargs.get('status', self.components.get(id, 1))
+        return {'id': id, **kwargs}
+
+    def get_incident(self, component_id):
+        self._request()
+        return dict(self.incidents.get(component_id, NO_INCIDENT))
+
+    def new_incidents(self, **kwargs):
+        self._request(write=True)
+        incident = {'id': str(next(self.ids)), 'name': kwargs['name'], 'message': kwargs['message'],
+                    'status': str(kwargs['status']), 'component_id': kwargs['component_id']}
+        self.incidents[kwargs['component_id']] = incident
+        self.components[kwargs['component_id']] = kwargs.get('component_status', 1)
+        self.created_incidents.append(kwargs['component_id'])
+        return dict(incident)
+
+    def upd_incident(self, id, **kwargs):
+        self._request(write=True)
+        incident = self._find_incident(id)
+        if 'component_status' in kwargs:
+            self.components[incident['component_id']] = kwargs['component_status']
+        incident.update({key: str(value) if key == 'status' else value for key, value in kwargs.items()
+                         if key in ('name', 'message', 'status')})
+        return dict(incident)
+
+    def get_incident_updates(self, incident_id):
+        if not self.updates_api:
+            raise CachetApiException(f'Failed to get list of incidents/{incident_id}/updates')
+        self._request()
+        return list(self.updates.get(str(incident_id), []))
+
+    def new_incident_update(self, incident_id, status, message):
+        if not self.updates_api:
+            raise CachetApiException(f'Failed to add update to incident ID {incident_id}')
+        self._request(write=True)
+        incident = self._find_incident(incident_id)
+        incident['status'] = str(status)
+        update = {'id': next(self.ids), 'incident_id': incident['id'], 'status': status, 'message': message}
+        self.updates.setdefault(str(incident_id), []).append(update)
+        return dict(update)
+
+    def new_schedule(self, **kwargs):
+        self._request(write=True)
+        schedule_id = next(self.ids)
+        self.schedules[schedule_id] = kwargs
+        self.schedule_writes.append(('new', schedule_id))
+        return {'id': schedule_id, **kwargs}
+
+    def upd_schedule(self, id, **kwargs):
+        self._request(write=True)
+        if id not in self.schedules:
+            raise CachetApiException(f'Failed to update schedule ID {id}')
+        self.schedules[id] = kwargs
+        self.schedule_writes.append(('upd', id))
+        return {'id': id, **kwargs}
+
+    def del_schedule(self, id):
+        self._request(write=True)
+        del self.schedules[id]
+        self.schedule_writes.append(('del', id))
+        return True
+
+    def new_metric_point(self, metric_id, value, timestamp):
+        if self.metric_failures:
+            self.metric_failures -= 1
+            raise CachetNotAvailable('Failed to connect to Cachet')
+        self._request(write=True)
+        if metric_id in self.rejected_metrics:
+            raise CachetApiException(f'Failed to add point to metric {metric_id}')
+        self.points.append((metric_id, timestamp, value))
+
+
+@pytest.fixture(name='zapi')
+def fake_zabbix():
+    return FakeZabbix()
+
+
+@pytest.fixture(name='cachet')
+def fake_cachet():
+    return FakeCachet()
@@ -0,0 +1,48 @@
+from zabbix_cachet.acks import AckRenderer, CompiledTemplate
+
+TEMPLATE = "{message}\n\n###### {ack_time} by {author}\n\n______\n"
+
+
+def ack(ackid, message, clock=1700000000):
+    return {'acknowledgeid': ackid, 'clock': str(clock), 'message': message, 'name': 'John', 'surname': 'Doe'}
+
+
+def test_compiled_template_is_same_as_format():
+    for template in (TEMPLATE, '{message!r:>20} {{literal}}', '{0}', 'plain text'):
+        fields = {'message': 'msg', 'ack_time': 'now', 'author': 'me'}
+        try:
+            expected = template.format(**fields)
+        except IndexError:
+            continue
+        assert CompiledTemplate(template).render(**fields) == expected
+
+
+def test_render_incremental():
+    renderer = AckRenderer(TEMPLATE, '%H:%M')
+    event = {'eventid': '10', 'acknowledged': '1', 'acknowledges': [ack('2', 'same'), ack('1', 'same')]}
+    text, ack_ids = renderer.render(1, event)
+    assert ack_ids == ('2', '1')
+    # Acks with the same text are not lost
+    assert text.count('same') == 2
+
+    renderer.mark_sent(1, 100, ack_ids)
+    assert renderer.is_changed(100, ack_ids) is False
+    assert renderer.is_changed(101, ack_ids) is None
+
+    event['acknowledges'].insert(0, ack('3', 'newest'))
+    text, ack_ids = renderer.render(1, event)
+    assert renderer.is_changed(100, ack_ids) is True
+    assert text.index('same') < text.index('newest')
+
+    renderer.forget(1)
+    assert renderer.is_changed(100, ack_ids) is None
+
+
+def test_unsent_and_restore_sent():
+    renderer = AckRenderer(TEMPLATE, '%H:%M')
+    event = {'eventid': '10', 'acknowledges': [ack('2', 'second'), ack('1', 'first')]}
+    _, ack_ids = renderer.render(1, event)
+    # Incident created before restart already has the first acknowledge in its updates
+    renderer.restore_sent(1, 100, ack_ids, ['investigating', renderer.text(['1'])])
+    assert renderer.unsent(100, ack_ids) == ('2',)
+    assert 'second' in renderer.text(renderer.unsent(100, ack_ids))
@@ -0,0 +1,43 @@
+from zabbix_cachet import main
+
+SERVICE_MAP = [main.ZabbixCachetMap(cachet_component_id=1, cachet_component_name='web', zbx_serviceid='3'),
+               main.ZabbixCachetMap(cachet_component_id=2, cachet_component_name='db', zbx_serviceid='4')]
+ACKNOWLEDGE = {'acknowledgeid': '5', 'clock': '1700000000', 'message': 'On it', 'name': 'John', 'surname': 'Doe'}
+
+
+def test_backlog_is_flushed_in_order_with_latest_states(app_config, zapi, cachet):
+    state = main.WatcherState.from_config(app_config)
+    web, db = SERVICE_MAP
+    zapi.problems = {'3': {'triggerid': '300'}, '4': {'triggerid': '400'}}
+    cachet.available = False
+    main._sync_or_backlog(web, main.collect_service(web, zapi, state, app_config), cachet, state, app_config)
+    assert not cachet.breaker.is_closed
+    assert list(state.backlog) == [1]
+    main._sync_or_backlog(db, main.collect_service(db, zapi, state, app_config), cachet, state, app_config)
+    # Newer state of component replaces the pending one
+    zapi.problems['3']['acknowledges'] = [ACKNOWLEDGE]
+    main._sync_or_backlog(web, main.collect_service(web, zapi, state, app_config), cachet, state, app_config)
+    assert list(state.backlog) == [1, 2]
+    assert state.backlog[1][1].ack_ids == ('5',)
+    assert not state.fingerprints
+    assert cachet.writes == 0
+
+    cachet.available = True
+    main.flush_backlog(zapi, cachet, state, app_config)
+    assert not state.backlog
+    assert cachet.created_incidents == [1, 2]
+    # Only the latest state of component is written
+    assert cachet.writes == 2
+    assert cachet.incidents[1]['status'] == '2' and 'On it' in cachet.incidents[1]['message']
+    assert set(state.fingerprints) == {1, 2}
+
+
+def test_flush_keeps_changes_when_cachet_fails_again(app_config, zapi, cachet):
+    state = main.WatcherState.from_config(app_config)
+    zapi.problems = {'3': {'triggerid': '300'}, '4': {'triggerid': '400'}}
+    cachet.available = False
+    for i in SERVICE_MAP:
+        main._sync_or_backlog(i, main.collect_service(i, zapi, state, app_config), cachet, state, app_config)
+    main.flush_backlog(zapi, cachet, state, app_config)
+    assert list(state.backlog) == [1, 2]
+    assert cachet.writes == 0
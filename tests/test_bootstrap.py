@@ -0,0 +1,38 @@
+import time
+
+from zabbix_cachet import main
+from zabbix_cachet.service_map import ServiceMapHandoff
+
+
+def slow_connect(backend):
+    def connect(*args, **kwargs):
+        time.sleep(0.2)
+        return backend
+    return connect
+
+
+def test_backends_are_connected_in_parallel(app_config, zapi, cachet, monkeypatch):
+    monkeypatch.setattr(main, 'Zabbix', slow_connect(zapi))
+    monkeypatch.setattr(main, 'Cachet', slow_connect(cachet))
+    started = time.monotonic()
+    connected_zapi, connected_cachet, watcher_zapi = main.connect_backends(app_config)
+    assert time.monotonic() - started < 0.35
+    assert (connected_zapi, connected_cachet, watcher_zapi) == (zapi, cachet, zapi)
+
+
+def test_partial_map_is_handed_over_during_bootstrap(zapi, cachet):
+    zapi.services['4'] = ('another', '1')
+    handoff = ServiceMapHandoff()
+    published = []
+    publish = handoff.publish
+
+    def record(service_map):
+        # Map is handed over before the rest of services is read from Zabbix
+        published.append(([i.zbx_serviceid for i in service_map], list(zapi.read)))
+        return publish(service_map)
+
+    handoff.publish = record
+    service_map = main.bootstrap_cachet(handoff, zapi, cachet, 'root', publish_interval=60)
+    assert zapi.read == ['2', '5', '4']
+    assert [i.zbx_serviceid for i in service_map] == ['3', '5', '4']
+    assert published == [(['3'], ['2'])]
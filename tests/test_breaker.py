@@ -0,0 +1,29 @@
+import time
+
+from zabbix_cachet.breaker import CircuitBreaker
+
+
+def test_breaker_opens_and_recovers_with_probe():
+    available = False
+    breaker = CircuitBreaker('test', failure_threshold=2, recovery_timeout=0.05, probe=lambda: available)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    # Probe failed, breaker stays open for another recovery_timeout
+    time.sleep(0.06)
+    assert not breaker.allow()
+    assert breaker.state == CircuitBreaker.OPEN
+    available = True
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.is_closed
+
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker('test', failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.is_closed
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from zabbix_cachet.budget import Deadline, Watchdog, timeout_from_config
+from zabbix_cachet.stats import Stats
+
+
+def test_deadline():
+    assert not Deadline(None).expired
+    assert Deadline(None).remaining is None
+    deadline = Deadline(0.01)
+    assert not deadline.expired
+    time.sleep(0.02)
+    assert deadline.expired
+    assert deadline.remaining == 0
+
+
+def test_timeout_from_config():
+    assert timeout_from_config({}) == (5.0, 30.0)
+    assert timeout_from_config({'timeout': 10}) == (10.0, 10.0)
+    assert timeout_from_config({'timeout': {'connect': 3}}) == (3.0, 30.0)
+
+
+def test_watchdog_reports_overrun_once(tmp_path):
+    stats = Stats()
+    metrics_file = tmp_path / 'zabbix_cachet.prom'
+    watchdog = Watchdog(stats=stats, metrics_file=str(metrics_file))
+    stalled = threading.Event()
+    release = threading.Event()
+
+    def cycle():
+        watchdog.watch('worker', Deadline(0.01))
+        stalled.set()
+        release.wait(1)
+        watchdog.done('worker')
+
+    thread = threading.Thread(target=cycle)
+    thread.start()
+    stalled.wait(1)
+    time.sleep(0.02)
+    watchdog.check()
+    watchdog.check()
+    release.set()
+    thread.join()
+    assert stats.get('zabbix_cachet_cycle_overruns_total', cycle='worker') == 1
+    assert stats.get('zabbix_cachet_cycle_duration_seconds', cycle='worker') > 0
+    assert 'zabbix_cachet_cycle_overruns_total{cycle="worker"} 1' in metrics_file.read_text()
@@ -0,0 +1,127 @@
+import pytest
+import requests
+
+from zabbix_cachet import cachet as cachet_module
+from zabbix_cachet.breaker import CircuitBreaker
+from zabbix_cachet.cachet import Cachet
+from zabbix_cachet.excepltions import CachetNotAvailable
+
+
+class FakeCachetApi:
+    """
+    Fake of Cachet list endpoint which limits page size like a real server
+    """
+    def __init__(self, items, max_per_page):
+        self.items = items
+        self.max_per_page = max_per_page
+        # Cachet 2.3+ filters and sorts list of incidents
+        self.filters = True
+        self.requests = []
+        # incident id -> its updates
+        self.updates = {}
+
+    def http_get(self, url, params=None):
+        params = params or {}
+        self.requests.append((url, params))
+        if url == 'version':
+            return {'data': '2.3.0'}
+        items = self.items
+        if url.endswith('/updates'):
+            items = self.updates.get(int(url.split('/')[1]), [])
+        if self.filters and 'component_id' in params:
+            items = [i for i in items if i['component_id'] == params['component_id']]
+        if self.filters and params.get('sort') == 'id':
+            items = sorted(items, key=lambda i: i['id'], reverse=params.get('order') == 'desc')
+        per_page = min(int(params.get('per_page', 20)), self.max_per_page)
+        page = int(params.get('page', 1))
+        total_pages = max(1, -(-len(items) // per_page))
+        return {
+            'meta': {'pagination': {'per_page': per_page, 'total_pages': total_pages}},
+            'data': items[(page - 1) * per_page:page * per_page],
+        }
+
+
+@pytest.fixture(name='cachet_api')
+def fake_cachet_api(monkeypatch):
+    api = FakeCachetApi([{'id': n, 'name': f'component {n}', 'component_id': n % 7, 'status': 1}
+                         for n in range(1, 1001)], max_per_page=100)
+    monkeypatch.setattr(Cachet, '_http_get', lambda self, url, params=None: api.http_get(url, params))
+    return api
+
+
+def test_paginate_returns_all_items_in_order(cachet_api):
+    cachet = Cachet('http://cachet', 'token', page_workers=3)
+    components = cachet.get_components()
+    assert [c['id'] for c in components] == list(range(1, 1001))
+    # All pages after the first one are requested with page size returned by server
+    assert {params['per_page'] for _, params in cachet_api.requests[2:]} == {100}
+
+
+def test_get_incident_returns_last_one(cachet_api):
+    cachet = Cachet('http://cachet', 'token')
+    cachet_api.requests = []
+    assert cachet.get_incident(3)['id'] == 997
+    assert cachet.get_incident(100)['id'] == '0'
+    # Only the last incident of component is requested
+    assert len(cachet_api.requests) == 2
+    # Server which ignores filter is searched through all pages
+    cachet_api.filters = False
+    assert cachet.get_incident(3)['id'] == 997
+    assert cachet.get_incident(100)['id'] == '0'
+
+
+def test_written_incidents_win_over_stale_list(cachet_api, monkeypatch):
+    cachet = Cachet('http://cachet', 'token')
+    monkeypatch.setattr(Cachet, '_http_post', lambda self, url, params: {'data': {'id': 1001, **params}})
+    monkeypatch.setattr(Cachet, '_http_put', lambda self, url, params: {
+        'data': {'id': 1001, 'component_id': 3, 'status': params['status'], 'human_status': 'Fixed'}})
+    cachet.new_incidents(name='down', message='Host is down', status=1, component_id=3, component_status=4)
+    # Cached list does not have the new incident yet
+    assert cachet.get_incident(3)['id'] == 1001
+    cachet.upd_incident(1001, status=4)
+    assert cachet.get_incident(3)['status'] == '4'
+    cachet.incident_record.ttl = 0
+    assert cachet.get_incident(3)['id'] == 997
+
+
+def test_incident_updates(cachet_api, monkeypatch):
+    cachet = Cachet('http://cachet', 'token')
+    posted = []
+
+    def http_post(self, url, params):
+        posted.append((url, params))
+        return {'data': {'id': 5000 + len(posted), **params}}
+
+    monkeypatch.setattr(Cachet, '_http_post', http_post)
+    cachet.new_incidents(name='down', message='Host is down', status=1, component_id=3, component_status=4)
+    cachet.new_incident_update(5001, status=2, message='On it')
+    assert posted[1] == ('incidents/5001/updates', {'status': 2, 'message': 'On it'})
+    # Status of incident follows its last update while Cachet returns stale list
+    assert cachet.get_incident(3)['status'] == '2'
+    assert cachet.get_incident(3)['message'] == 'Host is down'
+
+    cachet_api.updates[997] = [{'id': n, 'incident_id': 997, 'status': 2, 'message': f'update {n}'}
+                               for n in range(1, 251)]
+    updates = cachet.get_incident_updates(997)
+    assert [update['id'] for update in updates] == list(range(1, 251))
+    assert cachet.get_incident_updates(1) == []
+
+
+def test_request_fails_fast_while_breaker_is_open(cachet_api, monkeypatch):
+    cachet = Cachet('http://cachet', 'token',
+                    breaker=CircuitBreaker('Cachet', failure_threshold=2, recovery_timeout=3600))
+    sent = []
+
+    def request(method, url, **kwargs):
+        sent.append((method, url))
+        raise requests.exceptions.ConnectionError('Connection refused')
+
+    monkeypatch.setattr(cachet_module.requests, 'request', request)
+    for _ in range(2):
+        with pytest.raises(CachetNotAvailable, match='Failed to connect'):
+            cachet._request('GET', 'components', {})
+    assert cachet.breaker.state == CircuitBreaker.OPEN
+    # Open breaker does not let requests through
+    with pytest.raises(CachetNotAvailable, match='circuit breaker is open'):
+        cachet._request('PUT', 'incidents/1', {'status': 4})
+    assert len(sent) == 2
@@ -0,0 +1,60 @@
+import pytest
+from pyzabbix import ZabbixAPIException
+
+from zabbix_cachet import codec
+from zabbix_cachet.zabbix import ZabbixJsonRpc
+
+
+@pytest.fixture(name='backend', params=['orjson', 'json'])
+def codec_backend(request, monkeypatch):
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+    else:
+        monkeypatch.setattr(codec, 'orjson', None)
+    return request.param
+
+
+def test_loads_and_dumps(backend):
+    data = {'id': 1, 'name': 'Сервис', 'status': None, 'tags': [1.5, True]}
+    encoded = codec.dumps(data)
+    assert encoded == '{"id":1,"name":"Сервис","status":null,"tags":[1.5,true]}'.encode('utf-8')
+    assert codec.loads(encoded) == data
+    assert codec.loads(encoded.decode('utf-8')) == data
+    with pytest.raises(ValueError):
+        codec.loads(b'<html>Bad gateway</html>')
+
+
+def test_project():
+    items = [{'id': 1, 'name': 'web', 'message': 'long text'}, {'id': 2, 'status': 4}]
+    projected = codec.project(items, ['id', 'name'])
+    assert projected == [{'id': 1, 'name': 'web'}, {'id': 2}]
+    assert projected[0] is not items[0]
+
+
+class Response:
+    status_code = 200
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.text = content.decode('utf-8')
+
+    def raise_for_status(self):
+        pass
+
+
+def test_do_request_raises_on_error_payload(backend, monkeypatch):
+    zapi = ZabbixJsonRpc('http://zabbix', detect_version=False)
+    sent = []
+
+    def post(url, data, headers, timeout):
+        sent.append(codec.loads(data))
+        if sent[-1]['method'] == 'service.get':
+            return Response(b'{"jsonrpc":"2.0","result":[{"serviceid":"1"}],"id":0}')
+        return Response(b'{"jsonrpc":"2.0","error":{"code":-32602,"message":"Invalid params."},"id":1}')
+
+    monkeypatch.setattr(zapi.session, 'post', post)
+    assert zapi.do_request('service.get', {'output': ['serviceid']})['result'] == [{'serviceid': '1'}]
+    with pytest.raises(ZabbixAPIException, match='Error -32602: Invalid params., No data') as err:
+        zapi.do_request('trigger.get', {'output': ['triggerid']})
+    assert err.value.error['code'] == -32602
+    assert [(request['method'], request['id']) for request in sent] == [('service.get', 0), ('trigger.get', 1)]
@@ -0,0 +1,88 @@
+import itertools
+
+from zabbix_cachet import main
+from zabbix_cachet.discovery import ServiceChangeDetector
+
+
+def test_detector_reads_audit_log_once(zapi):
+    clock = itertools.count(1000)
+    detector = ServiceChangeDetector(zapi, clock=lambda: next(clock))
+    detector.reset()
+    zapi.audit = [{'auditid': 'a1', 'clock': '1001', 'resourceid': '3'},
+                  {'auditid': 'a2', 'clock': '1001', 'resourceid': '4'}]
+    assert detector.poll() == {'3', '4'}
+    zapi.audit.append({'auditid': 'a3', 'clock': '1001', 'resourceid': '6'})
+    assert detector.poll() == {'6'}
+
+
+def test_detector_falls_back_to_service_list(zapi):
+    zapi.auditlog_available = False
+    detector = ServiceChangeDetector(zapi, auditlog_failures=1)
+    assert detector.poll() == set()
+    assert not detector.use_auditlog
+    zapi.services['4'] = ('new component', '2')
+    zapi.services['5'] = ('renamed', '1')
+    assert detector.poll() == {'4', '5'}
+
+
+def test_detector_returns_to_audit_log(zapi):
+    clock = [1000]
+    detector = ServiceChangeDetector(zapi, clock=lambda: clock[0], auditlog_failures=2, auditlog_retry=600)
+    detector.reset()
+    # Single failure does not switch to list of services
+    zapi.auditlog_available = False
+    assert detector.poll() is None
+    assert detector.use_auditlog
+    zapi.auditlog_available = True
+    assert detector.poll() == set()
+    zapi.auditlog_available = False
+    assert detector.poll() is None
+    assert detector.use_auditlog
+    # Failures in a row do
+    assert detector.poll() == set()
+    assert not detector.use_auditlog
+
+    # Audit log is tried again after auditlog_retry, changes since the last poll are not lost
+    zapi.auditlog_available = True
+    zapi.services['4'] = ('new component', '2')
+    clock[0] += 300
+    assert detector.poll() == {'4'}
+    assert not detector.use_auditlog
+    zapi.services['6'] = ('another component', '2')
+    clock[0] += 300
+    assert detector.poll() == {'6'}
+    assert detector.use_auditlog
+    zapi.audit = [{'auditid': 'a1', 'clock': str(clock[0] + 1), 'resourceid': '3'}]
+    assert detector.poll() == {'3'}
+
+
+def test_changes_made_while_audit_log_fails_are_found_after_fallback(zapi):
+    clock = [1000]
+    detector = ServiceChangeDetector(zapi, clock=lambda: clock[0], auditlog_failures=2)
+    detector.reset()
+    zapi.services['4'] = ('new component', '2')
+    zapi.audit = [{'auditid': 'a1', 'clock': '1001', 'resourceid': '4'}]
+    clock[0] += 1
+    assert detector.poll() == {'4'}
+    # Service is added during the first failure of audit log and renamed at fallback
+    zapi.auditlog_available = False
+    zapi.services['6'] = ('another component', '2')
+    assert detector.poll() is None
+    zapi.services['5'] = ('renamed', '1')
+    assert detector.poll() == {'5', '6'}
+    assert not detector.use_auditlog
+    assert detector.poll() == set()
+
+
+def test_resync_only_changed_services(zapi, cachet):
+    service_map = main.init_cachet(zapi.get_zabbix_service('1').children, zapi, cachet)
+    assert cachet.created == ['component', 'other']
+    zapi.services['4'] = ('new component', '2')
+    cachet.created = []
+    new_map = main.resync_services({'4'}, service_map, zapi, cachet)
+    assert cachet.created == ['component', 'new component']
+    assert sorted(i.zbx_serviceid for i in new_map) == ['3', '4', '5']
+    # Deleted service disappears from map
+    del zapi.services['5']
+    new_map = main.resync_services({'5'}, new_map, zapi, cachet)
+    assert sorted(i.zbx_serviceid for i in new_map) == ['3', '4']
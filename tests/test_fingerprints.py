@@ -0,0 +1,37 @@
+import pytest
+
+from zabbix_cachet import main
+from zabbix_cachet.stats import STATS
+
+SERVICE_MAP = [main.ZabbixCachetMap(cachet_component_id=1, cachet_component_name='web', zbx_serviceid='3')]
+
+
+@pytest.mark.parametrize('app_settings', [{'full_check_cycles': 3}])
+def test_only_changed_services_are_synced(app_config, zapi, cachet):
+    state = main.WatcherState.from_config(app_config)
+    zapi.problems['3'] = {'triggerid': '200', 'priority': 4}
+    skipped = STATS.get('zabbix_cachet_skipped_services_total')
+    # The first cycle is a full check
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert cachet.writes == 1
+    reads = cachet.reads
+
+    # Unchanged fingerprint is neither read from Cachet nor written
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert (cachet.reads, cachet.writes) == (reads, 1)
+    assert state.skipped_total == 1
+    assert STATS.get('zabbix_cachet_skipped_services_total') == skipped + 1
+
+    # Changed fingerprint is written once
+    zapi.problems['3']['acknowledges'] = [{'acknowledgeid': '5', 'clock': '0', 'message': 'On it',
+                                           'name': 'John', 'surname': 'Doe'}]
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert cachet.writes == 2
+    assert cachet.incidents[1]['status'] == '2'
+
+    # Every full_check_cycles cycle unchanged services are checked in Cachet anyway, without writes
+    reads = cachet.reads
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert cachet.reads > reads
+    assert cachet.writes == 2
+    assert state.skipped_total == 1
@@ -0,0 +1,51 @@
+from zabbix_cachet.flap import FlapSuppressor
+
+
+class Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_disabled_syncs_every_change():
+    flaps = FlapSuppressor()
+    assert flaps.should_sync(1, False)
+    assert flaps.should_sync(1, True)
+
+
+def test_problem_and_ok_delays():
+    clock = Clock()
+    flaps = FlapSuppressor(problem_delay=60, ok_delay=120, clock=clock)
+    # Unknown state of Cachet is synced at once
+    assert flaps.should_sync(1, True)
+    flaps.synced(1, True)
+    assert not flaps.should_sync(1, False)
+    clock.now = 60
+    assert flaps.should_sync(1, False)
+    flaps.synced(1, False)
+    clock.now = 70
+    assert not flaps.should_sync(1, True)
+    clock.now = 190
+    assert flaps.should_sync(1, True)
+
+
+def test_flapping_service_keeps_one_incident():
+    clock = Clock()
+    flaps = FlapSuppressor(problem_delay=300, window=600, threshold=3, clock=clock)
+    assert flaps.should_sync(1, True)
+    flaps.synced(1, True)
+    states = [False, True, False]
+    for n, is_ok in enumerate(states):
+        clock.now = (n + 1) * 60
+        flaps.should_sync(1, is_ok)
+    assert flaps.is_flapping(1)
+    # Flapping problem opens incident without waiting for problem_delay
+    assert flaps.should_sync(1, False)
+    flaps.synced(1, False)
+    clock.now = 240
+    assert not flaps.should_sync(1, True)
+    # Calm down: changes have left the window
+    clock.now = 900
+    assert not flaps.is_flapping(1)
+    assert flaps.should_sync(1, True)
@@ -0,0 +1,71 @@
+import pytest
+
+from zabbix_cachet import main
+
+SERVICE_MAP = [main.ZabbixCachetMap(cachet_component_id=1, cachet_component_name='web', zbx_serviceid='3')]
+ACKNOWLEDGE = {'acknowledgeid': '5', 'clock': '1700000000', 'message': 'On it', 'name': 'John', 'surname': 'Doe'}
+
+pytestmark = [
+    pytest.mark.parametrize('app_settings', [{'full_check_cycles': 1}]),
+    pytest.mark.parametrize('app_templates', [{'investigating': '{component} is down', 'resolving': 'Resolved. '}]),
+]
+
+
+def test_new_acknowledge_is_posted_once(app_config, zapi, cachet):
+    cachet.incident_updates = True
+    state = main.WatcherState.from_config(app_config)
+    zapi.problems['3'] = {'triggerid': '200'}
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    incident = cachet.incidents[1]
+    assert (incident['message'], incident['status']) == ('web is down', '1')
+
+    zapi.problems['3']['acknowledges'] = [ACKNOWLEDGE]
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    updates = cachet.updates[incident['id']]
+    assert len(updates) == 1
+    assert 'On it' in updates[0]['message'] and updates[0]['status'] == 2
+    # Incident body is not sent again
+    assert (incident['message'], incident['status']) == ('web is down', '2')
+
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert len(cachet.updates[incident['id']]) == 1
+    # After restart sent acknowledges are found in updates of incident
+    state = main.WatcherState.from_config(app_config)
+    writes = cachet.writes
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert len(cachet.updates[incident['id']]) == 1
+    assert cachet.writes == writes
+
+
+def test_recovery_is_posted_as_update(app_config, zapi, cachet):
+    cachet.incident_updates = True
+    state = main.WatcherState.from_config(app_config)
+    zapi.problems['3'] = {'triggerid': '200', 'acknowledges': [ACKNOWLEDGE]}
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    incident = cachet.incidents[1]
+    message = incident['message']
+
+    del zapi.problems['3']
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert (incident['message'], incident['status']) == (message, '4')
+    assert cachet.components[1] == 1
+    assert [(update['status'], update['message']) for update in cachet.updates[incident['id']]] == [
+        (4, 'Resolved. ')]
+
+
+def test_incident_message_is_rewritten_without_updates_api(app_config, zapi, cachet):
+    cachet.updates_api = False
+    state = main.WatcherState.from_config(app_config)
+    zapi.problems['3'] = {'triggerid': '200'}
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    incident = cachet.incidents[1]
+
+    zapi.problems['3']['acknowledges'] = [ACKNOWLEDGE]
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert 'On it' in incident['message'] and incident['status'] == '2'
+    message = incident['message']
+
+    del zapi.problems['3']
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert (incident['message'], incident['status']) == ('Resolved. ' + message, '4')
+    assert not cachet.updates
@@ -0,0 +1,87 @@
+import logging
+import time
+
+import pytest
+
+from zabbix_cachet import main
+from zabbix_cachet.latency import LatencyTracker, Propagation, quantile
+from zabbix_cachet.stats import Stats
+
+LATENCY_SETTINGS = {'full_check_cycles': 1, 'propagation_latency': {'slow_threshold': 10}}
+SERVICE_MAP = [main.ZabbixCachetMap(cachet_component_id=1, cachet_component_name='web', cachet_group_name='Site',
+                                    zbx_serviceid='3')]
+
+
+def test_quantile():
+    values = list(range(1, 101))
+    assert quantile(values, 0.5) == 50
+    assert quantile(values, 0.99) == 99
+    assert quantile([7], 0.9) == 7
+    assert quantile([], 0.5) == 0
+
+
+def test_tracker_exports_percentiles_per_group(caplog):
+    stats = Stats()
+    tracker = LatencyTracker(window=3, slow_threshold=5, log_slowest=1, stats=stats)
+    for seconds in (1, 2, 3, 20):
+        tracker.record(Propagation(component='web', group='Site', event='problem', seconds=seconds,
+                                   breakdown={'poll_wait': seconds}))
+    tracker.record(Propagation(component='db', group='', event='recovery', seconds=8, breakdown={}))
+    with caplog.at_level(logging.WARNING):
+        tracker.cycle_end()
+    # Only the last 3 propagations of group are in window
+    assert stats.get('zabbix_cachet_propagation_seconds', group='Site', quantile=0.5) == 3
+    assert stats.get('zabbix_cachet_propagation_seconds', group='Site', quantile=0.99) == 20
+    assert stats.get('zabbix_cachet_propagation_seconds', group='', quantile=0.5) == 8
+    assert stats.get('zabbix_cachet_propagations_total', group='Site', event='problem') == 4
+    assert 'problem of Site | web took 20.0s (poll_wait 20.0s' in caplog.text
+    assert 'db' not in caplog.text
+
+
+@pytest.mark.parametrize('app_settings', [LATENCY_SETTINGS])
+def test_watcher_records_problem_and_recovery(app_config, zapi, cachet):
+    state = main.WatcherState.from_config(app_config)
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert not state.latency.percentiles('Site')[0.5]
+
+    zapi.problems['3'] = {'triggerid': '200', 'clock': int(time.time()) - 30}
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert 30 <= state.latency.percentiles('Site')[0.5] < 35
+    # Full check of unchanged service is not an event
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert len(state.latency._samples['Site']) == 1
+
+    del zapi.problems['3']
+    zapi.recovery_clock = int(time.time()) - 100
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert zapi.recovery_triggerids == ['200']
+    assert 100 <= state.latency.percentiles('Site')[0.99] < 105
+    assert len(state.latency._samples['Site']) == 2
+
+
+@pytest.mark.parametrize('app_settings', [LATENCY_SETTINGS])
+def test_watcher_records_changes_delivered_after_outage(app_config, zapi, cachet):
+    state = main.WatcherState.from_config(app_config)
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+
+    # Problem is kept in backlog while Cachet is not available
+    zapi.problems['3'] = {'triggerid': '200', 'clock': int(time.time()) - 30}
+    cachet.available = False
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert 1 in state.backlog
+    assert not state.latency._samples.get('Site')
+
+    # and is recorded when backlog is flushed
+    cachet.available = True
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert not state.backlog
+    assert len(state.latency._samples['Site']) == 1
+    assert 30 <= state.latency.percentiles('Site')[0.5] < 35
+
+
+@pytest.mark.parametrize('app_settings', [LATENCY_SETTINGS])
+def test_watcher_records_problem_after_restart(app_config, zapi, cachet):
+    state = main.WatcherState.from_config(app_config)
+    zapi.problems['3'] = {'triggerid': '200', 'clock': int(time.time()) - 30}
+    main.triggers_watcher(SERVICE_MAP, zapi, cachet, state)
+    assert len(state.latency._samples['Site']) == 1
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+import requests
+
+from zabbix_cachet.limiter import AdaptiveLimiter
+from zabbix_cachet.stats import Stats
+
+
+def make_limiter(**kwargs):
+    clock = [0.0]
+    stats = Stats()
+    limiter = AdaptiveLimiter('Cachet', clock=lambda: clock[0], stats=stats, **kwargs)
+    return limiter, clock, stats
+
+
+def run_window(limiter, latency, concurrent):
+    """
+    Complete one window of requests with concurrent of them in flight at once
+    """
+    for _ in range(limiter.window // concurrent):
+        for _ in range(concurrent):
+            limiter.acquire()
+        for _ in range(concurrent):
+            limiter.release(latency)
+
+
+def test_limit_grows_after_healthy_windows():
+    limiter, clock, stats = make_limiter(initial=2, max_limit=3, window=6)
+    assert stats.get('zabbix_cachet_concurrency_limit', backend='Cachet') == 2
+    run_window(limiter, 0.1, 2)
+    assert limiter.limit == 3
+    run_window(limiter, 0.1, 3)
+    assert limiter.limit == 3
+    # Successful requests grow the limit even if they do not use all of it
+    limiter.max_limit = 10
+    run_window(limiter, 0.1, 1)
+    assert limiter.limit == 4
+    assert stats.get('zabbix_cachet_concurrency_limit', backend='Cachet') == 4
+
+
+def test_limit_recovers_after_slow_period():
+    limiter, clock, stats = make_limiter(initial=8, window=4)
+    run_window(limiter, 0.1, 1)
+    assert limiter.limit == 9
+    clock[0] += 1
+    run_window(limiter, 0.5, 1)
+    clock[0] += 1
+    run_window(limiter, 0.5, 2)
+    assert limiter.limit == 2
+    # Backend is fast again
+    clock[0] += 1
+    for _ in range(7):
+        run_window(limiter, 0.1, 2)
+    assert limiter.limit == 9
+    assert limiter.baseline < 0.11
+
+
+def test_from_config():
+    limiter = AdaptiveLimiter.from_config('Cachet', {'initial': 4, 'min': 2, 'max': 16, 'window': 10,
+                                                     'tolerance': 3.0, 'backoff': 0.75})
+    assert (limiter.limit, limiter.min_limit, limiter.max_limit, limiter.window) == (4, 2, 16, 10)
+    assert (limiter.tolerance, limiter.backoff) == (3.0, 0.75)
+    assert AdaptiveLimiter.from_config('Zabbix').backoff == 0.5
+
+
+def test_limit_is_cut_on_overload_and_slow_latency():
+    limiter, clock, stats = make_limiter(initial=8, window=4)
+    run_window(limiter, 0.1, 1)
+    assert limiter.baseline == 0.1
+    stale = limiter.slot().__enter__()
+    # Latency over tolerance times baseline
+    clock[0] += 1
+    run_window(limiter, 0.5, 1)
+    assert limiter.limit == 4
+    # Request sent before the decrease fails after read timeout and does not cut it again
+    clock[0] += 30
+    assert not stale.__exit__(requests.exceptions.Timeout, requests.exceptions.Timeout(), None)
+    assert limiter.limit == 4
+    with limiter.slot() as slot:
+        clock[0] += 1
+        slot.overloaded = True
+    assert limiter.limit == 2
+    assert stats.get('zabbix_cachet_backend_overloads_total', backend='Cachet', reason='timeout') == 1
+    assert stats.get('zabbix_cachet_backend_overloads_total', backend='Cachet', reason='overload') == 1
+    # Application errors tell nothing about load
+    clock[0] += 1
+    with pytest.raises(ValueError):
+        with limiter.slot():
+            raise ValueError()
+    assert limiter.limit == 2 and limiter.in_flight == 0
+
+
+def test_acquire_waits_for_free_slot():
+    limiter, _, _ = make_limiter(initial=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def request():
+        limiter.acquire()
+        acquired.set()
+        limiter.release(0.1)
+
+    thread = threading.Thread(target=request)
+    thread.start()
+    assert not acquired.wait(0.05)
+    limiter.release(0.1)
+    assert acquired.wait(1)
+    thread.join(1)
+    assert limiter.in_flight == 0
@@ -0,0 +1,81 @@
+import datetime
+
+from zabbix_cachet import main
+from zabbix_cachet.maintenance import SCHEDULE_COMPLETE, SCHEDULE_UPCOMING, MaintenanceSync, maintenance_windows
+
+NOW = 1700000000
+
+
+def maintenance(maintenanceid='1', start=NOW + 3600, period=7200, hosts=('10',), groups=()):
+    return {'maintenanceid': maintenanceid, 'name': 'DB upgrade', 'description': 'New version',
+            'active_since': str(NOW), 'active_till': str(NOW + 86400),
+            'hosts': [{'hostid': hostid} for hostid in hosts], 'groups': [{'groupid': groupid} for groupid in groups],
+            'timeperiods': [{'timeperiod_type': '0', 'start_date': str(start), 'period': str(period)},
+                            {'timeperiod_type': '2', 'start_date': '0', 'period': '3600'}]}
+
+
+SERVICE_HOSTS = {'3': ({'10'}, {'2'}), '4': ({'11'}, {'5'})}
+SERVICE_MAP = [main.ZabbixCachetMap(cachet_component_id=1, cachet_component_name='Database', zbx_serviceid='3'),
+               main.ZabbixCachetMap(cachet_component_id=2, cachet_component_name='Web', zbx_serviceid='4')]
+
+
+def test_maintenance_windows():
+    assert maintenance_windows(maintenance(start=NOW - 60)) == [('1:' + str(NOW - 60), NOW, NOW + 7140)]
+    # Recurring periods are skipped
+    assert len(maintenance_windows(maintenance())) == 1
+
+
+def test_only_changed_schedules_are_written(tmp_path, zapi, cachet):
+    zapi.service_hosts, zapi.maintenances = SERVICE_HOSTS, [maintenance()]
+    state_file = str(tmp_path / 'maintenance.json')
+    clock = [NOW]
+    sync = MaintenanceSync(zapi, cachet, state_file=state_file, tz=datetime.timezone.utc, clock=lambda: clock[0])
+    assert sync.sync(1, SERVICE_MAP)
+    assert zapi.maintenance_filter == (['10', '11'], ['2', '5'])
+    assert cachet.schedule_writes == [('new', 1)]
+    schedule = cachet.schedules[1]
+    assert schedule['status'] == SCHEDULE_UPCOMING
+    assert schedule['scheduled_at'] == '2023-11-14 23:13'
+    assert schedule['message'] == 'New version\n\nAffected components: Database'
+    assert sync.sync(1, SERVICE_MAP)
+    assert cachet.schedule_writes == [('new', 1)]
+    assert zapi.host_reads == 1
+
+    # Maintenance of host group of Web and end of the first window
+    zapi.maintenances.append(maintenance('2', hosts=(), groups=('5',)))
+    clock[0] = NOW + 86400
+    assert sync.sync(1, SERVICE_MAP)
+    assert cachet.schedule_writes[1:] == [('upd', 1), ('new', 2)]
+    assert cachet.schedules[1]['status'] == SCHEDULE_COMPLETE
+
+    # Restart reads ids from state file
+    sync = MaintenanceSync(zapi, cachet, state_file=state_file, tz=datetime.timezone.utc, clock=lambda: clock[0])
+    zapi.maintenances = zapi.maintenances[1:]
+    assert sync.sync(2, SERVICE_MAP)
+    assert cachet.schedule_writes[3:] == [('del', 1)]
+
+    # Schedule deleted in Cachet is created again
+    del cachet.schedules[2]
+    zapi.maintenances[0]['name'] = 'Network upgrade'
+    assert sync.sync(2, SERVICE_MAP)
+    assert cachet.schedule_writes[4:] == [('new', 3)]
+
+
+def test_records_are_kept_when_cachet_is_not_available(zapi, cachet):
+    zapi.service_hosts, zapi.maintenances = SERVICE_HOSTS, [maintenance()]
+    clock = [NOW]
+    sync = MaintenanceSync(zapi, cachet, tz=datetime.timezone.utc, clock=lambda: clock[0])
+    assert sync.sync(1, SERVICE_MAP)
+    record = dict(sync.records)
+
+    # Update is not replaced by a new schedule
+    cachet.available = False
+    zapi.maintenances[0]['name'] = 'Network upgrade'
+    assert not sync.sync(1, SERVICE_MAP)
+    assert sync.records == record
+    assert cachet.schedule_writes == [('new', 1)]
+
+    # Deleted maintenance is not forgotten
+    zapi.maintenances = []
+    assert not sync.sync(1, SERVICE_MAP)
+    assert sync.records == record
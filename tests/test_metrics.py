@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from zabbix_cachet.excepltions import InvalidConfig
+from zabbix_cachet.metrics import MetricMap, MetricPoint, MetricsForwarder, downsample
+from zabbix_cachet.stats import STATS
+
+
+def test_downsample_skips_current_bucket():
+    history = [{'clock': '60', 'value': '1'}, {'clock': '90', 'value': '3'}, {'clock': '120', 'value': '5'}]
+    assert downsample(history, 60, 'avg', until=150) == [(60, 2.0)]
+    assert downsample(history, 60, 'max', until=180) == [(60, 3.0), (120, 5.0)]
+
+
+def test_invalid_metric_config():
+    with pytest.raises(InvalidConfig):
+        MetricMap.from_config({'itemid': 1, 'metric_id': 1, 'aggregation': 'median'})
+
+
+def test_collect_moves_high_water_mark(zapi, cachet):
+    zapi.history = [{'itemid': '1', 'clock': str(clock), 'value': str(clock)} for clock in range(540, 720, 10)]
+    metrics = [MetricMap('1', metric_id=10, resolution=60), MetricMap('text', metric_id=11)]
+    forwarder = MetricsForwarder(metrics, zapi, cachet)
+    assert forwarder.collect(now=660) == 1
+    assert forwarder.collect(now=660) == 0
+    assert forwarder.collect(now=725) == 1
+    points = [forwarder.queue.get_nowait() for _ in range(2)]
+    assert points == [MetricPoint(10, 600, 625.0), MetricPoint(10, 660, 685.0)]
+    # Non numeric item is dropped, all items of one value type are read in one request
+    assert forwarder.metrics == metrics[:1]
+    assert zapi.history_calls[-1] == (['1'], 660, 725)
+
+
+def test_full_queue_postpones_reading(zapi, cachet):
+    zapi.history = [{'itemid': '1', 'clock': str(clock), 'value': '1'} for clock in range(0, 600, 60)]
+    forwarder = MetricsForwarder([MetricMap('1', metric_id=10)], zapi, cachet,
+                                 queue_size=2, enqueue_timeout=0)
+    forwarder.high_water[forwarder.metrics[0]] = 0
+    assert forwarder.collect(now=600) == 2
+    forwarder.queue.get_nowait()
+    forwarder.queue.get_nowait()
+    assert forwarder.collect(now=600) == 2
+    assert forwarder.queue.get_nowait().timestamp == 120
+
+
+def test_send_batch_retries_when_cachet_is_not_available(cachet):
+    cachet.metric_failures = 1
+    forwarder = MetricsForwarder([], None, cachet, retry_interval=0)
+    batch = [MetricPoint(10, 60, 1.0), MetricPoint(10, 120, 2.0)]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        forwarder.send_batch(pool, batch)
+    assert sorted(cachet.points) == [(10, 60, 1.0), (10, 120, 2.0)]
+
+
+def test_rejected_points_are_not_counted_as_sent(cachet):
+    cachet.metric_failures = 1
+    cachet.rejected_metrics = {11}
+    forwarder = MetricsForwarder([], None, cachet, retry_interval=0)
+    sent = STATS.get('zabbix_cachet_metric_points_sent_total')
+    dropped = STATS.get('zabbix_cachet_metric_points_dropped_total')
+    batch = [MetricPoint(10, 60, 1.0), MetricPoint(11, 60, 2.0), MetricPoint(10, 120, 3.0)]
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        forwarder.send_batch(pool, batch)
+    assert sorted(cachet.points) == [(10, 60, 1.0), (10, 120, 3.0)]
+    assert STATS.get('zabbix_cachet_metric_points_sent_total') == sent + 2
+    assert STATS.get('zabbix_cachet_metric_points_dropped_total') == dropped + 1
@@ -0,0 +1,47 @@
+import time
+import tracemalloc
+
+from zabbix_cachet.profiling import Profiler
+
+
+def test_profiler_is_off_by_default():
+    profiler = Profiler()
+    profiler.cycle_start()
+    with profiler.phase('zabbix_fetch'):
+        pass
+    profiler.cycle_end()
+    assert not profiler.active
+    assert profiler._phases == {}
+
+
+def test_profile_requested_cycles(tmp_path):
+    profiler = Profiler()
+    profiler.configure(output_dir=str(tmp_path), sample_interval=0.001)
+    profiler.request(2)
+    for _ in range(3):
+        profiler.cycle_start()
+        with profiler.phase('sync'):
+            with profiler.phase('cachet_write'):
+                time.sleep(0.02)
+        profiler.cycle_end()
+    assert not profiler.active
+    phases = next(tmp_path.glob('*.phases.txt')).read_text()
+    assert phases.count('cycle ') == 2
+    assert 'cachet_write' in phases
+    collapsed = next(tmp_path.glob('*.collapsed')).read_text()
+    assert 'test_profiling.py:test_profile_requested_cycles' in collapsed
+    assert next(tmp_path.glob('*.tracemalloc.txt')).read_text().count('cycle ') == 2
+
+
+def test_tracing_started_by_others_is_kept(tmp_path):
+    profiler = Profiler()
+    profiler.configure(output_dir=str(tmp_path), sample_interval=0.001)
+    tracemalloc.start()
+    try:
+        profiler.request(1)
+        profiler.cycle_start()
+        profiler.cycle_end()
+        assert not profiler.active
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
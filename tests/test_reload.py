@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+
+import pytest
+import yaml
+
+from zabbix_cachet import main
+from zabbix_cachet.excepltions import CachetNotAvailable
+from zabbix_cachet.reload import ConfigWatcher
+from zabbix_cachet.service_map import ServiceMapHandoff
+
+RELOAD_SETTINGS = {'log_level': 'INFO', 'log_level_requests': 'WARNING', 'update_inc_interval': 60}
+
+
+def update_config(path, section: str, **values):
+    config = yaml.safe_load(path.read_text())
+    config[section].update(values)
+    path.write_text(yaml.safe_dump(config))
+
+
+@pytest.mark.parametrize('app_settings', [RELOAD_SETTINGS])
+@pytest.mark.parametrize('app_templates', [{'acknowledgement': '{message}'}])
+def test_reload_applies_only_changed_parts(config_file, app_config):
+    handoff = ServiceMapHandoff()
+    watcher = ConfigWatcher(app_config, handoff, poll_interval=0)
+    state = main.WatcherState.from_config(app_config)
+    state.fingerprints[1] = main.ServiceFingerprint(zbx_status=-1)
+    assert watcher.check(force=True) == set()
+    assert app_config.generation == 0
+
+    update_config(config_file, 'settings', log_level='DEBUG')
+    update_config(config_file, 'templates', acknowledgement='{message} by {author}')
+    update_config(config_file, 'zabbix', server='http://zabbix2')
+    woken = []
+    waiter = threading.Thread(target=lambda: woken.append(handoff.wait(5)))
+    waiter.start()
+    time.sleep(0.05)
+    root_level = logging.getLogger().level
+    try:
+        assert watcher.check(force=True) == {'settings.log_level', 'templates.acknowledgement', 'zabbix.server'}
+        assert logging.getLogger().level == logging.DEBUG
+    finally:
+        logging.getLogger().setLevel(root_level)
+    assert app_config.generation == 1
+    assert app_config.templates.acknowledgement == '{message} by {author}'
+    # Waiters are woken up to pick up new app_config
+    waiter.join(1)
+    assert woken == [True]
+    state.apply_config(app_config)
+    assert state.acks.template.template == '{message} by {author}'
+    assert 1 in state.fingerprints
+
+    # Broken app_config is ignored
+    config_file.write_text('settings: [')
+    assert watcher.check(force=True) == set()
+    assert app_config.generation == 1
+
+
+@pytest.mark.parametrize('app_settings', [RELOAD_SETTINGS])
+@pytest.mark.parametrize('app_templates', [{'acknowledgement': '{message}'}])
+def test_reload_replaces_all_sections_at_once(config_file, app_config):
+    sections = app_config.sections
+    update_config(config_file, 'settings', log_level='DEBUG')
+    update_config(config_file, 'templates', acknowledgement='{message} by {author}')
+    assert app_config.reload() == {'settings.log_level', 'templates.acknowledgement'}
+    # Sections read before reload are not changed under reader
+    assert sections.app_settings['log_level'] == 'INFO'
+    assert sections.templates.acknowledgement == '{message}'
+    assert app_config.app_settings['log_level'] == 'DEBUG'
+    assert app_config.templates.acknowledgement == '{message} by {author}'
+
+    # Invalid config does not replace any section
+    sections = app_config.sections
+    update_config(config_file, 'settings', log_level='INFO', time_zone='Mars/Olympus')
+    assert app_config.reload() == set()
+    assert app_config.sections is sections
+
+
+def test_switch_root_syncs_only_added_services(zapi, cachet):
+    zapi.services.update({'10': ('new root', None), '11': ('other', '10')})
+    service_map = main.init_cachet([zapi.get_zabbix_service('2')], zapi, cachet)
+    # group is moved under new root
+    zapi.services['2'] = ('group', '10')
+    cachet.created = []
+    # Failure of Zabbix is not taken for a root without children
+    zapi.available = False
+    assert main.switch_root('new root', service_map, zapi, cachet) is None
+    assert zapi.root_serviceid == '1'
+    zapi.available = True
+    cachet.available = False
+    with pytest.raises(CachetNotAvailable):
+        main.switch_root('new root', service_map, zapi, cachet)
+    assert zapi.root_serviceid == '1'
+    cachet.available = True
+    new_map = main.switch_root('new root', service_map, zapi, cachet)
+    assert zapi.root_serviceid == '10'
+    assert cachet.created == ['other']
+    assert new_map[0] is service_map[0]
+    assert sorted(i.zbx_serviceid for i in new_map) == ['11', '3']
+    assert main.switch_root('missing', new_map, zapi, cachet) is None
+
+
+@pytest.mark.parametrize('app_settings', [RELOAD_SETTINGS])
+def test_failed_switch_of_root_keeps_watching(config_file, app_config, zapi, cachet):
+    handoff = ServiceMapHandoff()
+    zapi.services.update({'10': ('new root', None), '11': ('other', '10')})
+    service_map = main.init_cachet([zapi.get_zabbix_service('2')], zapi, cachet)
+    cachet.available = False
+    zapi.services['2'] = ('group', '10')
+    detector = type('Detector', (), {'reset': lambda self: None})()
+
+    def reload():
+        time.sleep(0.05)
+        update_config(config_file, 'settings', root_service='new root', update_inc_interval=0)
+        app_config.reload()
+        handoff.wake()
+
+    thread = threading.Thread(target=reload)
+    thread.start()
+    new_map = main.watch_service_changes(handoff, detector, 0, 0.3, service_map, zapi, cachet, root_name='root',
+                                         timeout_setting='update_inc_interval')
+    thread.join(1)
+    assert new_map is service_map
+    assert handoff.snapshot()[0] == 0
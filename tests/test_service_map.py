@@ -0,0 +1,24 @@
+import threading
+import time
+
+from zabbix_cachet.service_map import ServiceMapHandoff
+
+
+def test_publish_wakes_up_waiter():
+    handoff = ServiceMapHandoff()
+    version, service_map = handoff.snapshot()
+    assert version == 0 and service_map == []
+    threading.Timer(0.1, handoff.publish, args=(['component'],)).start()
+    started = time.monotonic()
+    assert handoff.wait(10, seen_version=version)
+    assert time.monotonic() - started < 5
+    assert handoff.snapshot() == (1, ['component'])
+
+
+def test_stop_wakes_up_sleep():
+    handoff = ServiceMapHandoff()
+    threading.Timer(0.1, handoff.stop).start()
+    assert handoff.wait(10)
+    assert handoff.stopped
+    # Without new version or stop wait just times out
+    assert not ServiceMapHandoff().wait(0.01, seen_version=0)
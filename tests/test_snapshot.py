@@ -0,0 +1,21 @@
+import gzip
+import json
+
+from zabbix_cachet.snapshot import SnapshotExporter
+
+COMPONENT = {'id': 1, 'name': 'Web <frontend>', 'group': 'Site', 'status': 4,
+             'incident': {'id': 10, 'name': 'Site | Web is down', 'status': 1, 'message': 'Ping failed'}}
+
+
+def test_snapshot_is_written_only_on_change(tmp_path):
+    exporter = SnapshotExporter(str(tmp_path))
+    assert exporter.export([COMPONENT])
+    assert not exporter.export([COMPONENT])
+    assert exporter.export([dict(COMPONENT, status=1, incident=None)])
+    document = json.loads((tmp_path / 'status.json').read_bytes())
+    assert document['version'] == 2
+    assert document['components'][0]['status'] == 1
+    assert gzip.decompress((tmp_path / 'status.json.gz').read_bytes()) == (tmp_path / 'status.json').read_bytes()
+    assert 'Web &lt;frontend&gt;: Operational' in (tmp_path / 'index.html').read_text()
+    # Versions continue after restart
+    assert SnapshotExporter(str(tmp_path)).version == 2
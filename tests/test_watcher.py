@@ -0,0 +1,23 @@
+import pytest
+
+from zabbix_cachet import main
+
+# serviceid -> priority of its failed trigger
+PRIORITIES = {'1': 2, '2': 5, '3': 3, '4': 5}
+
+
+@pytest.mark.parametrize('app_settings', [{'max_writes_per_cycle': 2}])
+def test_severe_changes_are_synced_first(app_config, zapi, cachet):
+    zapi.problems = {serviceid: {'priority': priority} for serviceid, priority in PRIORITIES.items()}
+    service_map = [main.ZabbixCachetMap(cachet_component_id=int(serviceid), cachet_component_name=serviceid,
+                                        zbx_serviceid=serviceid) for serviceid in PRIORITIES]
+    state = main.WatcherState.from_config(app_config)
+    main.triggers_watcher(service_map, zapi, cachet, state)
+    assert cachet.created_incidents == [2, 4]
+    assert set(state.waiting_since) == {1, 3}
+    # Synced components are kept for status snapshot
+    assert set(state.components) == {2, 4}
+    assert state.components[2]['incident']['id'] == int(cachet.incidents[2]['id'])
+    main.triggers_watcher(service_map, zapi, cachet, state)
+    assert cachet.created_incidents == [2, 4, 3, 1]
+    assert not state.waiting_since
@@ -0,0 +1,93 @@
+import sqlite3
+
+import pytest
+
+from zabbix_cachet import main
+from zabbix_cachet.zabbix_db import ZabbixDB, connect_from_config, match_tags
+
+# Subset of Zabbix 6.0 schema which is read by ZabbixDB
+SCHEMA = """
+CREATE TABLE dbversion (mandatory INTEGER, optional INTEGER);
+CREATE TABLE services (serviceid INTEGER PRIMARY KEY, name TEXT, status INTEGER, algorithm INTEGER,
+                       sortorder INTEGER, weight INTEGER, propagation_rule INTEGER, propagation_value INTEGER,
+                       description TEXT, uuid TEXT, created_at INTEGER);
+CREATE TABLE service_problem_tag (service_problem_tagid INTEGER PRIMARY KEY, serviceid INTEGER, tag TEXT,
+                                  operator INTEGER, value TEXT);
+CREATE TABLE triggers (triggerid INTEGER PRIMARY KEY, expression TEXT, description TEXT, url TEXT, status INTEGER,
+                       value INTEGER, priority INTEGER, lastchange INTEGER, comments TEXT, error TEXT,
+                       templateid INTEGER, type INTEGER, state INTEGER, flags INTEGER);
+CREATE TABLE trigger_tag (triggertagid INTEGER PRIMARY KEY, triggerid INTEGER, tag TEXT, value TEXT);
+CREATE TABLE problem (eventid INTEGER PRIMARY KEY, source INTEGER, object INTEGER, objectid INTEGER, clock INTEGER,
+                      ns INTEGER, r_eventid INTEGER, r_clock INTEGER, r_ns INTEGER, correlationid INTEGER,
+                      userid INTEGER, name TEXT, acknowledged INTEGER, severity INTEGER);
+CREATE TABLE acknowledges (acknowledgeid INTEGER PRIMARY KEY, userid INTEGER, eventid INTEGER, clock INTEGER,
+                           message TEXT, action INTEGER, old_severity INTEGER, new_severity INTEGER);
+CREATE TABLE users (userid INTEGER PRIMARY KEY, username TEXT, name TEXT, surname TEXT);
+
+INSERT INTO dbversion VALUES (6000000, 6000015);
+INSERT INTO services VALUES (3, 'component', 4, 1, 0, 0, 0, 0, 'Component', 'c', 0);
+INSERT INTO services VALUES (4, 'healthy', -1, 1, 0, 0, 0, 0, '', 'd', 0);
+INSERT INTO service_problem_tag VALUES (1, 3, 'scope', 0, 'availability');
+INSERT INTO triggers VALUES (200, '{1}=0', 'Host {HOST.NAME} is down', 'https://wiki', 0, 1, 4, 0, 'Ping failed',
+                             '', 0, 0, 0, 0);
+INSERT INTO triggers VALUES (201, '{2}=0', 'Disk is full', '', 0, 1, 2, 0, '', '', 0, 0, 0, 0);
+INSERT INTO trigger_tag VALUES (1, 200, 'scope', 'availability');
+INSERT INTO trigger_tag VALUES (2, 201, 'scope', 'capacity');
+INSERT INTO problem VALUES (99, 0, 0, 200, 1699999000, 0, 98, 0, 0, 0, 0, 'Host web is down', 1, 4);
+INSERT INTO problem VALUES (100, 0, 0, 200, 1700000000, 0, NULL, 0, 0, 0, 0, 'Host web is down', 1, 4);
+INSERT INTO acknowledges VALUES (1, 1, 100, 1700000100, 'On it', 6, 0, 0);
+INSERT INTO acknowledges VALUES (2, 1, 100, 1700000200, 'Fixing', 6, 0, 0);
+INSERT INTO users VALUES (1, 'admin', 'John', 'Doe');
+"""
+
+
+@pytest.fixture(name='zabbix_db')
+def zabbix_db(tmp_path):
+    path = str(tmp_path / 'zabbix.db')
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    connection.close()
+    return ZabbixDB(*connect_from_config({'engine': 'sqlite', 'name': path}))
+
+
+@pytest.mark.parametrize('operator, value, matched', [
+    # Equals
+    ('0', 'availability', True), ('0', 'avail', False),
+    # Not equal
+    ('1', 'availability', False), ('1', 'capacity', True),
+    # Like
+    ('2', 'AVAIL', True), ('2', 'capac', False),
+    # Not like
+    ('3', 'avail', False), ('3', 'capac', True),
+])
+def test_match_tags_operator(operator, value, matched):
+    assert match_tags([('scope', 'availability')], [{'tag': 'scope', 'operator': operator, 'value': value}]) is matched
+
+
+def test_match_tags():
+    tags = [('scope', 'availability'), ('service', 'web')]
+    # Conditions on the same tag are OR-ed, on different tags are AND-ed
+    assert match_tags(tags, [{'tag': 'scope', 'operator': '0', 'value': 'capacity'},
+                             {'tag': 'scope', 'operator': '0', 'value': 'availability'}])
+    assert not match_tags(tags, [{'tag': 'scope', 'operator': '2', 'value': 'avail'},
+                                 {'tag': 'service', 'operator': '0', 'value': 'db'}])
+    assert match_tags(tags, [{'tag': 'scope', 'operator': '2', 'value': 'avail'},
+                             {'tag': 'service', 'operator': '0', 'value': 'web'}])
+
+
+def test_collect_service_from_database(zabbix_db, app_config):
+    assert zabbix_db.version == '6.0'
+    assert zabbix_db.prefetch(['3', '4'])
+    state = main.WatcherState.from_config(app_config)
+    healthy = main.collect_service(main.ZabbixCachetMap(2, 'healthy', zbx_serviceid='4'), zabbix_db, state,
+                                   app_config)
+    assert healthy.is_ok
+    service_state = main.collect_service(main.ZabbixCachetMap(1, 'component', zbx_serviceid='3'), zabbix_db,
+                                         state, app_config)
+    assert service_state.trigger_ids == ('200',)
+    assert service_state.inc_name == 'Host web is down'
+    assert service_state.ack_ids == ('2', '1')
+    # Acknowledges are read newest first like event.get returns them
+    assert service_state.inc_msg.index('On it') < service_state.inc_msg.index('Fixing')
+    assert 'John Doe' in service_state.inc_msg
+    assert service_state.priority == 4
@@ -0,0 +1,217 @@
+"""
+Check that zabbix-cachet reads only fields of Zabbix objects which are requested in QUERY_FIELDS
+"""
+import pytest
+
+from zabbix_cachet import main, zabbix
+from zabbix_cachet.maintenance import MaintenanceSync
+from zabbix_cachet.zabbix import QUERY_FIELDS, Zabbix
+
+# select* parameter -> property of returned object
+SELECT_PROPERTIES = {
+    'selectChildren': 'children',
+    'selectParents': 'parents',
+    'selectProblemTags': 'problem_tags',
+    'selectDependencies': 'dependencies',
+    'selectParentDependencies': 'parentDependencies',
+    'select_acknowledges': 'acknowledges',
+    'selectHosts': 'hosts',
+    'selectGroups': 'groups',
+    'selectHostGroups': 'hostgroups',
+    'selectTimeperiods': 'timeperiods',
+}
+
+ACKNOWLEDGE = {'acknowledgeid': '1', 'userid': '1', 'eventid': '100', 'clock': '1700000000', 'message': 'On it',
+               'action': '6', 'old_severity': '0', 'new_severity': '0', 'username': 'admin', 'name': 'John',
+               'surname': 'Doe'}
+TRIGGER = {'triggerid': '200', 'description': 'Host is down', 'comments': 'Ping failed', 'priority': '4',
+           'url': 'https://wiki', 'value': '1', 'expression': '{1}=0', 'status': '0', 'state': '0',
+           'lastchange': '1700000000', 'error': '', 'templateid': '0', 'type': '0', 'flags': '0',
+           'hosts': [{'hostid': '10', 'host': 'web'}], 'groups': [{'groupid': '2', 'name': 'Linux servers'}]}
+EVENT = {'eventid': '100', 'source': '0', 'object': '0', 'objectid': '200', 'clock': '1700000000', 'value': '1',
+         'acknowledged': '1', 'ns': '0', 'name': 'Host is down', 'severity': '4', 'r_eventid': '0',
+         'acknowledges': [ACKNOWLEDGE]}
+SERVICES = {
+    6: [
+        {'serviceid': '1', 'name': 'root', 'status': '5', 'description': '', 'algorithm': '1', 'sortorder': '0',
+         'weight': '0', 'propagation_rule': '0', 'propagation_value': '0', 'uuid': 'a', 'created_at': '0',
+         'readonly': False, 'children': [{'serviceid': '2', 'name': 'group'}], 'problem_tags': []},
+        {'serviceid': '2', 'name': 'group', 'status': '5', 'description': '', 'algorithm': '1', 'sortorder': '0',
+         'weight': '0', 'propagation_rule': '0', 'propagation_value': '0', 'uuid': 'b', 'created_at': '0',
+         'readonly': False, 'children': [{'serviceid': '3', 'name': 'component'}], 'problem_tags': []},
+        {'serviceid': '3', 'name': 'component', 'status': '4', 'description': 'Component', 'algorithm': '1',
+         'sortorder': '0', 'weight': '0', 'propagation_rule': '0', 'propagation_value': '0', 'uuid': 'c',
+         'created_at': '0', 'readonly': False, 'children': [],
+         'problem_tags': [{'tag': 'scope', 'operator': '0', 'value': 'availability'}]},
+    ],
+    5: [
+        {'serviceid': '1', 'name': 'root', 'status': '4', 'algorithm': '1', 'triggerid': '0', 'showsla': '0',
+         'goodsla': '99.9', 'sortorder': '0', 'dependencies': [{'linkid': '1', 'serviceupid': '1',
+                                                                 'servicedownid': '2', 'soft': '0'}],
+         'parentDependencies': []},
+        {'serviceid': '2', 'name': 'group', 'status': '4', 'algorithm': '1', 'triggerid': '0', 'showsla': '0',
+         'goodsla': '99.9', 'sortorder': '0', 'dependencies': [{'linkid': '2', 'serviceupid': '2',
+                                                                 'servicedownid': '3', 'soft': '0'}],
+         'parentDependencies': [{'linkid': '1', 'serviceupid': '1', 'servicedownid': '2', 'soft': '0'}]},
+        {'serviceid': '3', 'name': 'component', 'status': '4', 'algorithm': '1', 'triggerid': '200', 'showsla': '0',
+         'goodsla': '99.9', 'sortorder': '0', 'dependencies': [],
+         'parentDependencies': [{'linkid': '2', 'serviceupid': '2', 'servicedownid': '3', 'soft': '0'}]},
+    ],
+}
+PARENTS = {'2': '1', '3': '2'}
+MAINTENANCE = {'maintenanceid': '7', 'name': 'Upgrade', 'maintenance_type': '0', 'description': '',
+               'active_since': '1700000000', 'active_till': '1700086400', 'tags_evaltype': '0',
+               'hosts': [{'hostid': '10', 'host': 'web'}], 'groups': [],
+               'timeperiods': [{'timeperiod_type': '0', 'every': '1', 'month': '0', 'dayofweek': '0', 'day': '0',
+                                'start_time': '0', 'period': '3600', 'start_date': '1700003600'}]}
+AUDIT = {'auditid': 'a1', 'userid': '1', 'username': 'Admin', 'clock': '1700000000', 'ip': '127.0.0.1',
+         'action': '1', 'resourcetype': '18', 'resourceid': '3', 'resource_cuid': '', 'resourcename': 'component',
+         'recordsetid': 'r1', 'details': '{}'}
+
+
+class StrictDict(dict):
+    """
+    Zabbix object which fails on reading of field that was not requested
+    """
+    def __init__(self, data, requested):
+        super().__init__(data)
+        self.requested = set(requested)
+
+    def _check(self, key):
+        assert key in self.requested, f'Field {key!r} is read but not requested from Zabbix'
+
+    def __getitem__(self, key):
+        self._check(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self._check(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self._check(key)
+        return super().__contains__(key)
+
+    def pop(self, key, *args):
+        self._check(key)
+        self.requested.discard(key)
+        return super().pop(key, *args)
+
+    def __setitem__(self, key, value):
+        self.requested.add(key)
+        super().__setitem__(key, value)
+
+
+def project(obj: dict, params: dict) -> StrictDict:
+    output = params.get('output')
+    assert isinstance(output, list), f'Output of Zabbix query is not explicit: {params}'
+    requested = set(output)
+    data = {key: value for key, value in obj.items() if key in output}
+    for select, prop in SELECT_PROPERTIES.items():
+        if select in params:
+            assert isinstance(params[select], list), f'{select} of Zabbix query is not explicit: {params}'
+            requested.add(prop)
+            data[prop] = [StrictDict({k: v for k, v in item.items() if k in params[select]}, params[select])
+                          for item in obj.get(prop, [])]
+    return StrictDict(data, requested)
+
+
+class FakeZabbixAPI:
+    version_major = 6
+
+    def __init__(self, server, *args, **kwargs):
+        self.session = type('Session', (), {'verify': True})()
+
+    def login(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        api = self
+
+        class ApiObject:
+            @staticmethod
+            def version():
+                return f'{api.version_major}.0.0'
+
+            @staticmethod
+            def get(**params):
+                return api.get(name, params)
+        return ApiObject
+
+    def get(self, name, params):
+        if name == 'service':
+            services = SERVICES[self.version_major]
+            if 'filter' in params:
+                services = [s for s in services if s['name'] == params['filter']['name']]
+            elif 'serviceids' in params:
+                services = [s for s in services if s['serviceid'] in params['serviceids']]
+            elif 'parentids' in params:
+                services = [s for s in services if PARENTS.get(s['serviceid']) == params['parentids']]
+            return [project(s, params) for s in services]
+        if name == 'trigger':
+            return [project(TRIGGER, params)]
+        if name == 'event':
+            return [project(EVENT, params)]
+        if name == 'maintenance':
+            return [project(MAINTENANCE, params)]
+        if name == 'auditlog':
+            return [project(AUDIT, params)]
+        raise AssertionError(f'Unexpected call of {name}.get')
+
+
+@pytest.fixture(name='zapi', params=[5, 6])
+def zabbix_with_fake_api(request, monkeypatch):
+    monkeypatch.setattr(FakeZabbixAPI, 'version_major', request.param)
+    monkeypatch.setattr(zabbix, 'ZabbixJsonRpc', FakeZabbixAPI)
+    return Zabbix('http://zabbix', 'user', 'pass')
+
+
+def test_itservices_fields(zapi, cachet):
+    services = zapi.get_itservices('root')
+    assert services[0].children[0].name == 'component'
+    service_map = main.init_cachet(services, zapi, cachet)
+    assert len(service_map) == 1
+
+
+@pytest.mark.parametrize('app_templates', [
+    {'investigating': '{group} | {component} - {time} {trigger_name} {trigger_description}'}])
+@pytest.mark.parametrize('acknowledged', ['0', '1'])
+def test_triggers_watcher_fields(zapi, cachet, app_config, acknowledged, monkeypatch):
+    monkeypatch.setitem(EVENT, 'acknowledged', acknowledged)
+    services = zapi.get_itservices('root')
+    service_map = main.init_cachet(services, zapi, cachet)
+    state = main.WatcherState.from_config(app_config)
+    service_state = main.collect_service(service_map[0], zapi, state, app_config)
+    assert service_state.trigger_ids == ('200',)
+    if acknowledged == '1':
+        assert service_state.ack_ids == ('1',)
+        assert 'On it' in service_state.inc_msg
+    else:
+        assert 'Ping failed' in service_state.inc_msg
+
+
+def test_problem_tags_are_converted_to_trigger_filter(zapi, monkeypatch):
+    queries = []
+    get = zapi.zapi.get
+    monkeypatch.setattr(zapi.zapi, 'get', lambda name, params: queries.append((name, params)) or get(name, params))
+    zapi.get_trigger(tags=[{'tag': 'scope', 'operator': '0', 'value': 'availability'},
+                           {'tag': 'service', 'operator': '2', 'value': 'web'}])
+    assert queries == [('trigger', queries[0][1])]
+    assert queries[0][1]['tags'] == [{'tag': 'scope', 'operator': '1', 'value': 'availability'},
+                                     {'tag': 'service', 'operator': '0', 'value': 'web'}]
+
+
+def test_discovery_fields(zapi):
+    assert zapi.get_service_audit(time_from=0)[0]['resourceid'] == '3'
+    assert zapi.get_service_names()['3'] == 'component'
+    assert list(zapi.get_service_parents(['3'])) == ['3']
+    assert zapi.get_child_ids('2') == {'3'}
+
+
+def test_maintenance_fields(zapi):
+    assert zapi.get_service_hosts(['3']) == {'3': ({'10'}, {'2'})}
+    maintenances = zapi.get_maintenances(['10'], ['2'])
+    assert MaintenanceSync(zapi, None).desired(maintenances) == {}
+    sync = MaintenanceSync(zapi, None)
+    sync.refresh_hosts(1, [main.ZabbixCachetMap(1, 'component', zbx_serviceid='3')])
+    assert list(sync.desired(maintenances)) == ['7:1700003600']